@@ -0,0 +1,221 @@
+"""
+Microbenchmarks for the packet codecs, run over the packets in benchmarks.corpus.
+
+    python -m benchmarks.codec [--iterations N] [--packet NAME] [--output FILE]
+                               [--baseline benchmarks/baseline.json]
+
+Results are printed (or written) as JSON. Given a baseline, each benchmark also gets the
+ratio of its mean time to the baseline's, so that a change can be checked against the
+committed numbers.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+from hiiragi.protocol.binary import BinaryEncoding
+from hiiragi.protocol.lz77 import Lz77
+from hiiragi.protocol.node import Node
+from hiiragi.protocol.protocol import EAmuseProtocol
+from hiiragi.protocol.xml import XmlEncoding
+
+from .corpus import CORPUS
+
+ENCODING = EAmuseProtocol.SHIFT_JIS
+KEY = "1-5f000000-0001"
+
+# Keys for encrypting with a new key every time, which must never repeat between packets
+# since the RC4 key schedule for a key is cached
+KEYS = itertools.count()
+
+# Which benchmarks make up each direction of the full round trip
+ENCODE_STAGES = ["binary.encode", "lz77.compress", "rc4.crypt"]
+DECODE_STAGES = ["rc4.crypt", "lz77.decompress", "binary.decode"]
+
+
+def percentile(samples: List[int], fraction: float) -> int:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def measure(
+    func: Callable[[], Any], size: int, iterations: int, warmup: int
+) -> Dict[str, Any]:
+    """
+    Time a function, returning latency and throughput along with the peak memory
+    allocated by a single call.
+
+    Parameters:
+        func - The function to benchmark.
+        size - The number of bytes the function processes, for throughput.
+        iterations - The number of timed calls.
+        warmup - The number of untimed calls before timing, to fill caches.
+    """
+    for _ in range(warmup):
+        func()
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        func()
+        samples.append(time.perf_counter_ns() - start)
+    samples.sort()
+
+    # Tracing slows everything down, so this is a separate call
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+    mean = sum(samples) / len(samples)
+    return {
+        "bytes": size,
+        "mean_us": round(mean / 1000, 3),
+        "p50_us": round(percentile(samples, 0.5) / 1000, 3),
+        "p99_us": round(percentile(samples, 0.99) / 1000, 3),
+        "min_us": round(samples[0] / 1000, 3),
+        "ops_per_sec": round(1e9 / mean, 1),
+        "mb_per_sec": round(size / mean * 1e9 / (1024 * 1024), 3),
+        "peak_bytes": peak,
+    }
+
+
+def benchPacket(tree: Node, iterations: int, warmup: int) -> Dict[str, Any]:
+    binary = BinaryEncoding()
+    xml = XmlEncoding()
+    lz = Lz77()
+    protocol = EAmuseProtocol()
+
+    packet = binary.encode(tree, ENCODING)
+    document = xml.encode(tree, ENCODING)
+    compressed = lz.compress(packet)
+    key = EAmuseProtocol._derive_key(KEY)
+    wire = protocol.encode("lz77", KEY, tree, ENCODING, EAmuseProtocol.BINARY)
+
+    # Every response is encrypted with a new key, so only the schedule_cached variant
+    # reuses one
+    fresh = iter(
+        [
+            EAmuseProtocol._derive_key(f"1-{next(KEYS):08x}-0001")
+            for _ in range(warmup + iterations + 1)
+        ]
+    )
+
+    benches: Dict[str, Any] = {
+        "binary.encode": (lambda: binary.encode(tree, ENCODING), len(packet)),
+        "binary.decode": (lambda: binary.decode_packet(packet), len(packet)),
+        "xml.encode": (lambda: xml.encode(tree, ENCODING), len(document)),
+        "xml.decode": (lambda: xml.decode_packet(document), len(document)),
+        "lz77.compress": (lambda: lz.compress(packet), len(packet)),
+        "lz77.decompress": (lambda: lz.decompress(compressed), len(packet)),
+        "rc4.crypt": (
+            lambda: protocol._rc4_crypt(compressed, next(fresh)),
+            len(compressed),
+        ),
+        # Only the key schedule is cached, the keystream is generated every time
+        "rc4.crypt.schedule_cached": (
+            lambda: protocol._rc4_crypt(compressed, key),
+            len(compressed),
+        ),
+        "protocol.encode": (
+            lambda: protocol.encode(
+                "lz77", KEY, tree, ENCODING, EAmuseProtocol.BINARY
+            ),
+            len(packet),
+        ),
+        "protocol.decode": (
+            lambda: protocol.decode_context("lz77", KEY, wire),
+            len(packet),
+        ),
+    }
+
+    results = {
+        name: measure(func, size, iterations, warmup)
+        for name, (func, size) in benches.items()
+    }
+
+    def stages(names: List[str]) -> Dict[str, float]:
+        return {name: results[name]["mean_us"] for name in names}
+
+    return {
+        "sizes": {
+            "binary": len(packet),
+            "xml": len(document),
+            "compressed": len(compressed),
+        },
+        "benchmarks": results,
+        "roundtrip": {
+            "mean_us": round(
+                results["protocol.encode"]["mean_us"]
+                + results["protocol.decode"]["mean_us"],
+                3,
+            ),
+            "encode_stages_us": stages(ENCODE_STAGES),
+            "decode_stages_us": stages(DECODE_STAGES),
+        },
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> None:
+    """
+    Annotate every benchmark with how its mean compares to the baseline's, where
+    a ratio below 1.0 means it got faster.
+    """
+    for packet, result in report["packets"].items():
+        old = baseline.get("packets", {}).get(packet, {}).get("benchmarks", {})
+        for name, stats in result["benchmarks"].items():
+            if name in old and old[name]["mean_us"] > 0:
+                stats["vs_baseline"] = round(stats["mean_us"] / old[name]["mean_us"], 3)
+
+
+def run(
+    iterations: int, warmup: int, packets: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    report: Dict[str, Any] = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "iterations": iterations,
+        "packets": {},
+    }
+    for name in packets or list(CORPUS):
+        report["packets"][name] = benchPacket(CORPUS[name](), iterations, warmup)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the packet codecs.")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument(
+        "--packet",
+        action="append",
+        choices=list(CORPUS),
+        help="Only benchmark this packet, can be given more than once",
+    )
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="A previous report to compare against")
+    args = parser.parse_args()
+
+    report = run(args.iterations, args.warmup, args.packet)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
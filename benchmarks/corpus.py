@@ -0,0 +1,174 @@
+import random
+from typing import Callable, Dict
+
+from hiiragi.protocol.node import Node
+
+MODEL = "NBT:J:A:A:2020"
+
+
+def request(module: str, method: str, model: str = MODEL) -> Node:
+    """
+    Build the request a cabinet sends for an action, without any arguments.
+    """
+    call = Node.void("call")
+    call.set_attribute("model", model)
+    call.set_attribute("srcid", "0120FEDCBA9876543210")
+    call.set_attribute("tag", "4a5d2a7f")
+    body = Node.void(module)
+    body.set_attribute("method", method)
+    call.add_child(body)
+    return call
+
+
+def servicesGet() -> Node:
+    response = Node.void("response")
+    services = Node.void("services")
+    services.set_attribute("method", "get")
+    services.set_attribute("expire", "10800")
+    services.set_attribute("mode", "operation")
+    services.set_attribute("status", "0")
+
+    for name in [
+        "ntp",
+        "keepalive",
+        "cardmng",
+        "facility",
+        "message",
+        "numbering",
+        "package",
+        "pcbevent",
+        "pcbtracker",
+        "pkglist",
+        "posevent",
+        "userdata",
+        "userid",
+        "eacoin",
+        "local",
+        "local2",
+        "lobby",
+        "lobby2",
+        "dlstatus",
+        "netlog",
+        "sidmgr",
+        "globby",
+    ]:
+        item = Node.void("item")
+        item.set_attribute("name", name)
+        item.set_attribute("url", "http://localhost:8083")
+        services.add_child(item)
+
+    response.add_child(services)
+    return response
+
+
+def facilityGet() -> Node:
+    response = Node.void("response")
+    facility = Node.void("facility")
+    facility.set_attribute("status", "0")
+
+    location = Node.void("location")
+    location.add_child(Node.string("id", "ea"))
+    location.add_child(Node.string("country", "AX"))
+    location.add_child(Node.string("region", "1"))
+    location.add_child(Node.string("name", "CORE"))
+    location.add_child(Node.u8("type", 0))
+    location.add_child(Node.string("countryname", "UNKNOWN"))
+    location.add_child(Node.string("countryjname", "不明"))
+    location.add_child(Node.string("regionname", "CORE"))
+    location.add_child(Node.string("regionjname", "CORE"))
+    location.add_child(Node.string("customercode", "AXUSR"))
+    location.add_child(Node.string("companycode", "AXCPY"))
+    location.add_child(Node.s32("latitude", 6666))
+    location.add_child(Node.s32("longitude", 6666))
+    location.add_child(Node.u8("accuracy", 0))
+    facility.add_child(location)
+
+    line = Node.void("line")
+    line.add_child(Node.string("id", "."))
+    line.add_child(Node.u8("class", 0))
+    facility.add_child(line)
+
+    portfw = Node.void("portfw")
+    portfw.add_child(Node.ipv4("globalip", "127.0.0.1"))
+    portfw.add_child(Node.s16("globalport", 5700))
+    portfw.add_child(Node.s16("privateport", 5700))
+    facility.add_child(portfw)
+
+    public = Node.void("public")
+    public.add_child(Node.u8("flag", 1))
+    public.add_child(Node.string("name", "UNKNOWN"))
+    public.add_child(Node.s32("latitude", 0))
+    public.add_child(Node.s32("longitude", 0))
+    facility.add_child(public)
+
+    response.add_child(facility)
+    return response
+
+
+def pcbtrackerAlive() -> Node:
+    response = Node.void("response")
+    pcbtracker = Node.void("pcbtracker")
+    pcbtracker.set_attribute("status", "0")
+    pcbtracker.set_attribute("expire", "1200")
+    pcbtracker.set_attribute("ecenable", "1")
+    pcbtracker.set_attribute("eclimit", "0")
+    pcbtracker.set_attribute("limit", "0")
+    pcbtracker.set_attribute("time", "1700000000")
+    response.add_child(pcbtracker)
+    return response
+
+
+def scoreArrays(musics: int = 500) -> Node:
+    """
+    A player's full score list, the largest thing a game usually asks for.
+    """
+    rng = random.Random(musics)
+    response = Node.void("response")
+    player = Node.void("player")
+    player.set_attribute("status", "0")
+
+    for musicId in range(musics):
+        music = Node.void("music")
+        music.add_child(Node.s32("music_id", musicId))
+        music.add_child(
+            Node.s32_array("score", [rng.randint(0, 1000000) for _ in range(4)])
+        )
+        music.add_child(Node.u16_array("clear", [rng.randint(0, 5) for _ in range(4)]))
+        music.add_child(Node.u8_array("grade", [rng.randint(0, 9) for _ in range(4)]))
+        music.add_child(Node.bool("favorite", rng.random() < 0.1))
+        music.add_child(Node.u64("updated", 1700000000000 + musicId))
+        player.add_child(music)
+
+    response.add_child(player)
+    return response
+
+
+def shiftJisStrings(count: int = 200) -> Node:
+    """
+    Rival and news lists, which are mostly Shift-JIS text.
+    """
+    names = ["ひいらぎ", "ＤＪ．ＴＥＳＴ", "ビートストリーム", "不明", "テスト用"]
+    response = Node.void("response")
+    message = Node.void("message")
+    message.set_attribute("status", "0")
+
+    for i in range(count):
+        item = Node.void("item")
+        item.set_attribute("name", names[i % len(names)])
+        item.add_child(Node.string("title", f"お知らせ {i} 「{names[(i + 1) % 5]}」"))
+        item.add_child(Node.string("body", "本日のメンテナンスは終了しました。" * 3))
+        item.add_child(Node.s32("id", i))
+        message.add_child(item)
+
+    response.add_child(message)
+    return response
+
+
+# Name of each packet, along with how to build it
+CORPUS: Dict[str, Callable[[], Node]] = {
+    "pcbtracker.alive": pcbtrackerAlive,
+    "services.get": servicesGet,
+    "facility.get": facilityGet,
+    "scores": scoreArrays,
+    "shift-jis": shiftJisStrings,
+}
@@ -0,0 +1,298 @@
+"""
+A load generator that simulates a fleet of cabinets talking to hiiragi.
+
+    python -m benchmarks.loadgen [--cabinets N] [--duration SECONDS] [--url URL]
+
+Every cabinet boots the way a real one does (services.get, facility.get, package.list,
+message.get and pcbevent.put) and then sends pcbtracker.alive periodically, using lz77
+compressed and encrypted packets. All cabinets boot within --boot-spread seconds of each
+other, so a small spread simulates the boot storm when an arcade opens. Without --url
+the app is driven in-process, otherwise requests go to a running server. In-process,
+the app stores everything in a temporary database unless --database is given, so that
+the real one isn't filled with made up calls.
+
+The report is JSON, with requests per second, error rates and latency percentiles per
+action.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+
+from hiiragi.protocol.node import Node
+from hiiragi.protocol.protocol import EAmuseProtocol
+from hiiragi.utils import generateKey
+
+from .corpus import MODEL, request
+
+protocol = EAmuseProtocol()
+
+BOOT_SEQUENCE = [
+    "services.get",
+    "facility.get",
+    "package.list",
+    "message.get",
+    "pcbevent.put",
+]
+ALIVE = "pcbtracker.alive"
+
+
+def pcbeventPut(call: Node) -> None:
+    body = call.children[0]
+    body.add_child(Node.time("time", int(time.time())))
+    body.add_child(Node.u32("seq", 0))
+    item = Node.void("item")
+    item.add_child(Node.string("name", "boot"))
+    item.add_child(Node.s32("value", 1))
+    item.add_child(Node.time("time", int(time.time())))
+    body.add_child(item)
+
+
+def pcbtrackerAlive(call: Node) -> None:
+    call.children[0].set_attribute("ecflag", "1")
+
+
+# Extra arguments for requests that have any
+ARGUMENTS: Dict[str, Callable[[Node], None]] = {
+    "pcbevent.put": pcbeventPut,
+    ALIVE: pcbtrackerAlive,
+}
+
+
+class Stats:
+    """
+    Latencies and errors of every request sent, per action.
+    """
+
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+
+    def record(self, action: str, latency: float, error: Optional[str]) -> None:
+        self.latencies.setdefault(action, []).append(latency)
+        if error is not None:
+            errors = self.errors.setdefault(action, {})
+            errors[error] = errors.get(error, 0) + 1
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        def percentile(samples: List[float], fraction: float) -> float:
+            return round(
+                samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 3
+            )
+
+        actions: Dict[str, Any] = {}
+        total = 0
+        failed = 0
+        for action, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            errors = self.errors.get(action, {})
+            total += len(latencies)
+            failed += sum(errors.values())
+            actions[action] = {
+                "requests": len(latencies),
+                "errors": errors,
+                "error_rate": round(sum(errors.values()) / len(latencies), 4),
+                "p50_ms": percentile(latencies, 0.5),
+                "p99_ms": percentile(latencies, 0.99),
+                "p999_ms": percentile(latencies, 0.999),
+                "max_ms": round(latencies[-1] * 1000, 3),
+            }
+
+        return {
+            "elapsed": round(elapsed, 3),
+            "requests": total,
+            "requests_per_sec": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+            "error_rate": round(failed / total, 4) if total else 0.0,
+            "actions": actions,
+        }
+
+
+@asynccontextmanager
+async def inProcess(
+    limits: httpx.Limits, database: Optional[str] = None
+) -> AsyncIterator[httpx.AsyncClient]:
+    """
+    Start the app in-process, giving a client that sends requests straight to it.
+
+    Parameters:
+        limits - Connection limits for the client.
+        database - The database the app uses, a temporary one if None.
+    """
+    from hiiragi.database import database as storage
+    from main import app, lifespan
+
+    with tempfile.TemporaryDirectory() as directory:
+        # Nothing has been opened yet, since connections are opened on first use
+        storage.path = database or os.path.join(directory, "hiiragi.db")
+        async with lifespan(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://hiiragi", limits=limits
+            ) as client:
+                yield client
+
+
+async def send(client: httpx.AsyncClient, action: str, stats: Stats) -> None:
+    """
+    Send a request for an action the way a cabinet would, and check the response.
+    """
+    module, method = action.split(".")
+    call = request(module, method)
+    if action in ARGUMENTS:
+        ARGUMENTS[action](call)
+
+    key, _ = generateKey()
+    data = protocol.encode(
+        "lz77",
+        key,
+        call,
+        text_encoding=EAmuseProtocol.SHIFT_JIS,
+        packet_encoding=EAmuseProtocol.BINARY,
+    )
+
+    error = None
+    start = time.perf_counter()
+    try:
+        response = await client.post(
+            "/",
+            params={"model": MODEL, "module": module, "method": method, "f": action},
+            content=data,
+            headers={"X-Eamuse-Info": key, "X-Compress": "lz77"},
+        )
+        latency = time.perf_counter() - start
+
+        if response.status_code != 200:
+            error = f"HTTP {response.status_code}"
+        else:
+            compress = response.headers.get("x-compress", "none")
+            tree = protocol.decode_context(
+                None if compress == "none" else compress,
+                response.headers.get("x-eamuse-info"),
+                response.content,
+            ).tree
+            if tree.name != "response" or tree.child(module) is None:
+                error = "unexpected response"
+    except Exception as e:
+        # Either the request failed or the response couldn't be decoded
+        latency = time.perf_counter() - start
+        error = type(e).__name__
+
+    stats.record(action, latency, error)
+
+
+async def cabinet(
+    client: httpx.AsyncClient,
+    stats: Stats,
+    bootDelay: float,
+    aliveInterval: float,
+    deadline: float,
+) -> None:
+    await asyncio.sleep(bootDelay)
+    for action in BOOT_SEQUENCE:
+        if time.monotonic() >= deadline:
+            return
+        await send(client, action, stats)
+
+    while True:
+        # Cabinets aren't synchronized, so spread the heartbeats out a little
+        await asyncio.sleep(aliveInterval * random.uniform(0.9, 1.1))
+        if time.monotonic() >= deadline:
+            return
+        await send(client, ALIVE, stats)
+
+
+async def run(
+    cabinets: int,
+    duration: float,
+    bootSpread: float,
+    aliveInterval: float,
+    url: Optional[str] = None,
+    database: Optional[str] = None,
+) -> Dict[str, Any]:
+    stats = Stats()
+
+    async def fleet(client: httpx.AsyncClient) -> float:
+        start = time.monotonic()
+        deadline = start + duration
+        await asyncio.gather(
+            *[
+                cabinet(
+                    client,
+                    stats,
+                    random.uniform(0, bootSpread),
+                    aliveInterval,
+                    deadline,
+                )
+                for _ in range(cabinets)
+            ]
+        )
+        return time.monotonic() - start
+
+    limits = httpx.Limits(max_connections=cabinets, max_keepalive_connections=cabinets)
+    if url is not None:
+        async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+            elapsed = await fleet(client)
+    else:
+        async with inProcess(limits, database) as client:
+            elapsed = await fleet(client)
+
+    report = stats.report(elapsed)
+    report["cabinets"] = cabinets
+    report["mode"] = "http" if url is not None else "in-process"
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Simulate a fleet of cabinets.")
+    parser.add_argument("--cabinets", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument(
+        "--boot-spread",
+        type=float,
+        default=5.0,
+        help="Cabinets boot within this many seconds of each other",
+    )
+    parser.add_argument(
+        "--alive-interval",
+        type=float,
+        default=5.0,
+        help="Seconds between pcbtracker.alive calls, real cabinets wait minutes",
+    )
+    parser.add_argument("--url", help="Server to send to, e.g. http://localhost:8083")
+    parser.add_argument(
+        "--database",
+        help="Database for the in-process app, a temporary one is used by default",
+    )
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(
+        run(
+            args.cabinets,
+            args.duration,
+            args.boot_spread,
+            args.alive_interval,
+            url=args.url,
+            database=args.database,
+        )
+    )
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Replays captured traffic against hiiragi and checks every response against the one
+that was captured.
+
+    python -m benchmarks.replay CAPTURE [--speed N] [--concurrency N] [--url URL]
+
+CAPTURE is a capture segment, or a directory of them, as written by the proxy (see
+hiiragi.capture). Calls are sent with the gaps between them that they were captured
+with, divided by --speed, so 1 replays in real time and 0 sends them as fast as
+--concurrency allows. Without --url the app is driven in-process, otherwise requests go
+to a running server. In-process, the app stores everything in a temporary database
+unless --database is given, so that replayed calls don't end up in the real one.
+
+A response matches when its tree is equal to the captured one. Anything that is
+expected to differ between runs, like the server time, can be left out of the
+comparison with --ignore, as a path below the response and optionally an attribute:
+
+    --ignore pcbtracker@time --ignore facility/location/id
+
+The report is JSON with the same numbers as the load generator, where mismatched
+responses count as errors. The first few mismatches are printed as diffs, and the exit
+status is non-zero if any call failed or mismatched.
+"""
+
+import argparse
+import asyncio
+import difflib
+import json
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from hiiragi.capture import CaptureRecord, readCapture
+from hiiragi.protocol.node import Node
+from hiiragi.protocol.protocol import EAmuseProtocol
+
+from .loadgen import Stats, inProcess
+
+protocol = EAmuseProtocol()
+
+# Only meaningful for the connection the call was captured on
+SKIPPED_HEADERS = {"host", "connection", "content-length", "transfer-encoding"}
+
+
+class Ignored:
+    """
+    A node value or attribute that is left out of the comparison.
+    """
+
+    def __init__(self, spec: str):
+        path, _, attribute = spec.partition("@")
+        self.path = path
+        self.attribute = attribute or None
+
+    def apply(self, actual: Node, expected: Node) -> None:
+        """
+        Copy what is ignored from the expected tree over to the actual one, so that it
+        compares equal whatever it was.
+        """
+        left = actual.child(self.path) if self.path else actual
+        right = expected.child(self.path) if self.path else expected
+        if left is None or right is None:
+            return
+        if self.attribute is not None:
+            value = right.attribute(self.attribute)
+            if value is not None and left.attribute(self.attribute) is not None:
+                left.set_attribute(self.attribute, value)
+        elif (
+            left.type == right.type
+            and not left.is_composite
+            and right.value is not None
+        ):
+            left.set_value(right.value)
+
+
+class Replay:
+    """
+    Sends captured calls and compares the responses, keeping count as it goes.
+    """
+
+    def __init__(self, ignored: List[Ignored], diffs: int):
+        self.ignored = ignored
+        self.diffs = diffs
+        self.stats = Stats()
+        self.unreadable = 0
+        self.mismatches: List[str] = []
+        self.elapsed = 0.0
+
+    def compare(self, record: CaptureRecord, actual: Node) -> bool:
+        try:
+            expected = record.responseTree()
+        except Exception:
+            # Nothing to compare against, so only the latency counts
+            self.unreadable += 1
+            return True
+
+        for ignored in self.ignored:
+            ignored.apply(actual, expected)
+        if actual == expected:
+            return True
+
+        if len(self.mismatches) < self.diffs:
+            self.mismatches.append(
+                "".join(
+                    difflib.unified_diff(
+                        str(expected).splitlines(keepends=True),
+                        str(actual).splitlines(keepends=True),
+                        fromfile=f"captured {record.action}",
+                        tofile=f"replayed {record.action}",
+                    )
+                )
+            )
+        return False
+
+    async def send(self, client: httpx.AsyncClient, record: CaptureRecord) -> None:
+        error = None
+        start = time.perf_counter()
+        try:
+            response = await client.request(
+                record.method,
+                record.path,
+                content=record.requestBody,
+                headers={
+                    key: value
+                    for key, value in record.requestHeaders.items()
+                    if key not in SKIPPED_HEADERS
+                },
+            )
+            latency = time.perf_counter() - start
+
+            if response.status_code != record.status:
+                error = f"HTTP {response.status_code}"
+            else:
+                compress = response.headers.get("x-compress", "none")
+                actual = protocol.decode_context(
+                    None if compress == "none" else compress,
+                    response.headers.get("x-eamuse-info"),
+                    response.content,
+                ).tree
+                if not self.compare(record, actual):
+                    error = "mismatch"
+        except Exception as e:
+            latency = time.perf_counter() - start
+            error = type(e).__name__
+
+        self.stats.record(record.action, latency, error)
+
+
+async def run(
+    path: str,
+    speed: float,
+    concurrency: int,
+    ignored: List[Ignored],
+    actions: Optional[List[str]] = None,
+    diffs: int = 5,
+    url: Optional[str] = None,
+    database: Optional[str] = None,
+) -> Replay:
+    replay = Replay(ignored, diffs)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(client: httpx.AsyncClient, record: CaptureRecord) -> None:
+        try:
+            await replay.send(client, record)
+        finally:
+            slots.release()
+
+    async def dispatch(client: httpx.AsyncClient) -> float:
+        tasks = set()
+        start = time.monotonic()
+        first: Optional[float] = None
+        # Read as they're sent, so that a whole day of traffic needn't fit in memory
+        for record in readCapture(path):
+            if actions and record.action not in actions:
+                continue
+            if first is None:
+                first = record.timestamp
+            if speed > 0:
+                delay = start + (record.timestamp - first) / speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            await slots.acquire()
+            task = asyncio.create_task(one(client, record))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+        return time.monotonic() - start
+
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    if url is not None:
+        async with httpx.AsyncClient(base_url=url, limits=limits) as client:
+            elapsed = await dispatch(client)
+    else:
+        async with inProcess(limits, database) as client:
+            elapsed = await dispatch(client)
+
+    replay.elapsed = elapsed
+    return replay
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay captured traffic.")
+    parser.add_argument("capture", help="A capture segment or a directory of them")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="How many times faster than captured to replay, 0 for no waiting",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=64,
+        help="Most calls in flight at once",
+    )
+    parser.add_argument(
+        "--ignore",
+        action="append",
+        default=[],
+        help="Leave path[@attribute] out of the comparison, can be given more than "
+        "once",
+    )
+    parser.add_argument(
+        "--action",
+        action="append",
+        help="Only replay this action (f=), can be given more than once",
+    )
+    parser.add_argument(
+        "--diffs", type=int, default=5, help="Most mismatches to print diffs of"
+    )
+    parser.add_argument("--url", help="Server to send to, e.g. http://localhost:8083")
+    parser.add_argument(
+        "--database",
+        help="Database for the in-process app, a temporary one is used by default",
+    )
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.concurrency <= 0:
+        parser.error("--concurrency must be positive")
+
+    replay = asyncio.run(
+        run(
+            args.capture,
+            args.speed,
+            args.concurrency,
+            [Ignored(spec) for spec in args.ignore],
+            actions=args.action,
+            diffs=args.diffs,
+            url=args.url,
+            database=args.database,
+        )
+    )
+
+    report: Dict[str, Any] = replay.stats.report(replay.elapsed)
+    report["speed"] = args.speed
+    report["concurrency"] = args.concurrency
+    report["unreadable_captures"] = replay.unreadable
+    report["mode"] = "http" if args.url is not None else "in-process"
+
+    for diff in replay.mismatches:
+        sys.stderr.write(diff + "\n")
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+    if report["error_rate"] > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
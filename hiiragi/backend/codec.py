@@ -0,0 +1,178 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from typing_extensions import Final
+
+from hiiragi.protocol.node import Node
+from hiiragi.protocol.protocol import EAmuseContext
+from hiiragi.utils import protocol
+
+
+def decodePacket(
+    compression: Optional[str],
+    encryption: Optional[str],
+    data: bytes,
+    timed: bool = False,
+) -> EAmuseContext:
+    """
+    Decrypt, decompress and decode a request, returning its context.
+    """
+    return protocol.decode_context(compression, encryption, data, timed=timed)
+
+
+def encodePacket(tree: Node, text_encoding: str, packet_encoding: int) -> bytes:
+    """
+    Encode a response tree without compressing or encrypting it.
+    """
+    return protocol.encode(
+        None, None, tree, text_encoding=text_encoding, packet_encoding=packet_encoding
+    )
+
+
+def wrapPacket(
+    compression: Optional[str],
+    encryption: Optional[str],
+    data: bytes,
+    level: Optional[str] = None,
+) -> bytes:
+    """
+    Compress and encrypt an encoded response.
+    """
+    return protocol.wrap(compression, encryption, data, level=level)
+
+
+class CodecExecutor:
+    """
+    Runs packet codec work (RC4, lz77 and binary/XML coding) for the route. Small packets
+    are handled inline since handing them off costs more than coding them, while anything
+    above the threshold is run on a thread or process pool so that a few cabinets sending
+    big packets don't stall every other request on the event loop.
+
+    In process mode, trees are pickled to and from the workers. Nodes use __slots__ and
+    store their values natively, so this is about as compact as the tree itself.
+    """
+
+    INLINE: Final[str] = "inline"
+    THREAD: Final[str] = "thread"
+    PROCESS: Final[str] = "process"
+
+    # Packets (in bytes) and response trees (in nodes) at or above these sizes are offloaded.
+    DEFAULT_THRESHOLD: Final[int] = 16 * 1024
+    DEFAULT_NODE_THRESHOLD: Final[int] = 512
+
+    def __init__(
+        self,
+        mode: str = THREAD,
+        threshold: int = DEFAULT_THRESHOLD,
+        nodeThreshold: int = DEFAULT_NODE_THRESHOLD,
+        workers: Optional[int] = None,
+    ):
+        if mode not in (self.INLINE, self.THREAD, self.PROCESS):
+            raise ValueError(f"Unknown codec executor mode {mode}")
+        self.mode = mode
+        self.threshold = threshold
+        self.nodeThreshold = nodeThreshold
+        self.workers = workers
+        self.__pool: Optional[Executor] = None
+
+    @classmethod
+    def fromEnvironment(cls) -> "CodecExecutor":
+        """
+        Configure an executor from HIIRAGI_CODEC_MODE, HIIRAGI_CODEC_THRESHOLD,
+        HIIRAGI_CODEC_NODE_THRESHOLD and HIIRAGI_CODEC_WORKERS.
+        """
+        workers = os.environ.get("HIIRAGI_CODEC_WORKERS")
+        return cls(
+            mode=os.environ.get("HIIRAGI_CODEC_MODE", cls.THREAD),
+            threshold=int(
+                os.environ.get("HIIRAGI_CODEC_THRESHOLD", cls.DEFAULT_THRESHOLD)
+            ),
+            nodeThreshold=int(
+                os.environ.get(
+                    "HIIRAGI_CODEC_NODE_THRESHOLD", cls.DEFAULT_NODE_THRESHOLD
+                )
+            ),
+            workers=int(workers) if workers else None,
+        )
+
+    def __getPool(self) -> Executor:
+        # Created on first use, so that importing this doesn't spawn processes
+        if self.__pool is None:
+            if self.mode == self.PROCESS:
+                self.__pool = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self.__pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="codec"
+                )
+        return self.__pool
+
+    async def __run(self, offload: bool, func: Callable[..., Any], *args: Any) -> Any:
+        if not offload or self.mode == self.INLINE:
+            return func(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__getPool(), func, *args)
+
+    def __isLarge(self, tree: Node) -> bool:
+        # Count nodes until we know the tree is over the threshold
+        count = 0
+        stack = [tree]
+        while stack:
+            count += 1
+            if count >= self.nodeThreshold:
+                return True
+            stack.extend(stack.pop().children)
+        return False
+
+    async def decode(
+        self,
+        compression: Optional[str],
+        encryption: Optional[str],
+        data: bytes,
+        timed: bool = False,
+    ) -> EAmuseContext:
+        return await self.__run(
+            len(data) >= self.threshold,
+            decodePacket,
+            compression,
+            encryption,
+            data,
+            timed,
+        )
+
+    async def encode(self, tree: Node, context: EAmuseContext) -> bytes:
+        # Only the encodings are sent along, not the whole request context
+        return await self.__run(
+            self.__isLarge(tree),
+            encodePacket,
+            tree,
+            context.text_encoding,
+            context.packet_encoding,
+        )
+
+    async def wrap(
+        self,
+        compression: Optional[str],
+        encryption: Optional[str],
+        data: bytes,
+        level: Optional[str] = None,
+    ) -> bytes:
+        # Nothing to do unless the packet gets compressed or encrypted
+        work = compression not in (None, "none") or bool(encryption)
+        return await self.__run(
+            work and len(data) >= self.threshold,
+            wrapPacket,
+            compression,
+            encryption,
+            data,
+            level,
+        )
+
+    def shutdown(self):
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False, cancel_futures=True)
+            self.__pool = None
+
+
+executor = CodecExecutor.fromEnvironment()
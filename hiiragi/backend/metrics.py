@@ -0,0 +1,187 @@
+import ipaddress
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from typing_extensions import Final
+
+
+class StageTimer:
+    """
+    Times the stages of handling a single request, each stage running from the end of
+    the previous one to when it is marked.
+    """
+
+    enabled: Final[bool] = True
+
+    def __init__(self, metrics: "Metrics", game: str, action: str):
+        self.metrics = metrics
+        self.game = game
+        self.action = action
+        self.start = time.perf_counter()
+        self.last = self.start
+        self.stages: List[Tuple[str, float, int]] = []
+
+    def mark(self, stage: str, size: int = 0):
+        """
+        End a stage, recording how long it took since the last one and how many
+        bytes it produced.
+        """
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last, size))
+        self.last = now
+
+    def add(self, prefix: str, stages: Dict[str, Tuple[float, int]]):
+        """
+        Record stages timed elsewhere, such as inside the codec, without ending the
+        current stage.
+        """
+        for stage, (seconds, size) in stages.items():
+            self.stages.append((f"{prefix}.{stage}", seconds, size))
+
+    def finish(self):
+        self.stages.append(("total", time.perf_counter() - self.start, 0))
+        self.metrics.record(self.game, self.action, self.stages)
+
+    def serverTiming(self) -> str:
+        # Durations are in milliseconds
+        return ", ".join(
+            f"{stage.replace('.', '-')};dur={seconds * 1000:.3f}"
+            for stage, seconds, _ in self.stages
+        )
+
+
+class NullTimer:
+    """
+    Stands in for a StageTimer when metrics are disabled, so that timing costs no
+    more than a few empty calls.
+    """
+
+    enabled: Final[bool] = False
+
+    def mark(self, stage: str, size: int = 0):
+        pass
+
+    def add(self, prefix: str, stages: Dict[str, Tuple[float, int]]):
+        pass
+
+    def finish(self):
+        pass
+
+
+class Metrics:
+    """
+    Per-stage durations and sizes of requests by game and action, exposed in the
+    Prometheus text format. Everything is recorded on the event loop, so each worker
+    process keeps and exposes its own numbers.
+    """
+
+    # Only the machine itself can see the metrics unless told otherwise
+    DEFAULT_ALLOW: Final[Tuple[str, ...]] = ("127.0.0.1", "::1")
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        serverTiming: bool = False,
+        allow: Iterable[str] = DEFAULT_ALLOW,
+    ):
+        self.enabled = enabled
+        self.serverTiming = serverTiming
+        # Addresses or networks, such as 10.0.0.0/8, that may read the metrics
+        self.allow = [
+            ipaddress.ip_network(entry.strip(), strict=False) for entry in allow
+        ]
+        self.__null = NullTimer()
+        # Calls, seconds and bytes by game, action and stage
+        self.__stages: Dict[Tuple[str, str, str], List[float]] = {}
+
+    @classmethod
+    def fromEnvironment(cls) -> "Metrics":
+        """
+        Configure metrics from HIIRAGI_METRICS, HIIRAGI_SERVER_TIMING and
+        HIIRAGI_METRICS_ALLOW.
+        """
+
+        def flag(name: str) -> bool:
+            return os.environ.get(name, "").lower() in ("1", "true", "yes", "on")
+
+        allow = os.environ.get("HIIRAGI_METRICS_ALLOW", ",".join(cls.DEFAULT_ALLOW))
+        return cls(
+            enabled=flag("HIIRAGI_METRICS"),
+            serverTiming=flag("HIIRAGI_SERVER_TIMING"),
+            allow=[entry for entry in allow.split(",") if entry.strip()],
+        )
+
+    def allows(self, host: Optional[str]) -> bool:
+        """
+        Whether a client may read the metrics.
+
+        Parameters:
+            host - The client's address, or None if it isn't known.
+        """
+        if not self.enabled or host is None:
+            return False
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return False
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            # IPv4 clients of a dual stack socket
+            address = address.ipv4_mapped
+        return any(address in network for network in self.allow)
+
+    def timer(self, game: str, action: str) -> Union[StageTimer, NullTimer]:
+        # A Server-Timing header needs the timings, even if they aren't exposed
+        if not self.enabled and not self.serverTiming:
+            return self.__null
+        return StageTimer(self, game, action)
+
+    def record(self, game: str, action: str, stages: List[Tuple[str, float, int]]):
+        if not self.enabled:
+            return
+        for stage, seconds, size in stages:
+            totals = self.__stages.get((game, action, stage))
+            if totals is None:
+                totals = self.__stages[(game, action, stage)] = [0, 0.0, 0]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += size
+
+    def render(self) -> str:
+        """
+        Render everything recorded so far in the Prometheus text exposition format.
+        """
+
+        def escape(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        seconds = [
+            "# HELP hiiragi_stage_seconds Time spent in each stage of handling a request.",
+            "# TYPE hiiragi_stage_seconds summary",
+        ]
+        sizes = [
+            "# HELP hiiragi_stage_bytes Bytes produced by each stage of handling a request.",
+            "# TYPE hiiragi_stage_bytes summary",
+        ]
+        for (game, action, stage), (calls, total, size) in sorted(
+            self.__stages.items()
+        ):
+            labels = ",".join(
+                [
+                    f'game="{escape(game)}"',
+                    f'action="{escape(action)}"',
+                    f'stage="{escape(stage)}"',
+                ]
+            )
+            seconds.append(f"hiiragi_stage_seconds_sum{{{labels}}} {total:.9f}")
+            seconds.append(f"hiiragi_stage_seconds_count{{{labels}}} {calls}")
+            sizes.append(f"hiiragi_stage_bytes_sum{{{labels}}} {size}")
+            sizes.append(f"hiiragi_stage_bytes_count{{{labels}}} {calls}")
+
+        return "\n".join(seconds + sizes) + "\n"
+
+    def reset(self):
+        self.__stages.clear()
+
+
+metrics = Metrics.fromEnvironment()
@@ -3,12 +3,20 @@ from fastapi import APIRouter, Request, Response
 from hiiragi.log import logger
 from hiiragi.plugin import PluginManager
 from hiiragi.protocol.node import Node
-from hiiragi.protocol.protocol import EAmuseProtocol
-from hiiragi.utils import generateKey, protocol
+from hiiragi.protocol.template import FilledTemplate
+from hiiragi.utils import generateKey
 
 from . import exceptions
+from .codec import executor
+from .metrics import metrics
 
 router = APIRouter()
+# Kept apart from the routes games call, so that it can be mounted separately
+metricsRouter = APIRouter()
+
+# Responses smaller than this are sent uncompressed even if the request was compressed,
+# since lz77 only adds overhead for tiny packets.
+COMPRESS_THRESHOLD = 256
 
 
 @router.post("//{model}/{module}/{method}")
@@ -21,16 +29,31 @@ async def index(request: Request):
     return await handle(request, **dict(request.query_params.items()))
 
 
-async def handle(request: Request, **kwargs):
-    body = await request.body()
-    xeamuse = request.headers.get("x-eamuse-info", "")
+@metricsRouter.get("/metrics")
+async def exposeMetrics(request: Request):
+    # Anyone not allowed gets the same as when metrics are off
+    if not metrics.allows(request.client.host if request.client else None):
+        return Response(status_code=404)
+    return Response(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
-    compress = "lz77" if request.headers.get("x-compress", "none") != "none" else None
-    node = protocol.decode(compress, xeamuse, body)
 
+async def handle(request: Request, **kwargs):
     game = kwargs["model"].split(":")[0]
     action = kwargs["f"]
 
+    # Nothing is kept until finish(), which unknown games and actions never reach
+    timer = metrics.timer(game, action)
+    body = await request.body()
+    timer.mark("read", len(body))
+    xeamuse = request.headers.get("x-eamuse-info")
+
+    compress = "lz77" if request.headers.get("x-compress", "none") != "none" else None
+    context = await executor.decode(compress, xeamuse, body, timed=timer.enabled)
+    timer.mark("decode")
+    timer.add("decode", context.stages)
+
     plugin = PluginManager.getPlugin(game)
     if not plugin:
         logger.error(f'Game "{game}" plugin is missing and cannot process your request')
@@ -40,27 +63,68 @@ async def handle(request: Request, **kwargs):
         logger.error(f'Undefined action "{action}"')
         return
 
-    response = await do(request, node)
+    cache = plugin.cache(action)
+    cached = None
+    if cache is not None:
+        cached = cache.get(
+            request,
+            context.tree,
+            context.text_encoding,
+            context.packet_encoding,
+            context.compression,
+        )
 
-    if response is None or not isinstance(response, Node):
-        raise exceptions.WrongResponse()
+    if cached is not None:
+        # Static response, already encoded and compressed
+        data, compress = cached
+        timer.mark("cache", len(data))
+    else:
+        response = await do(request, context.tree)
+        timer.mark("handler")
 
-    xeamuse, date = generateKey()
-    return Response(
-        protocol.encode(
-            None,
-            xeamuse,
-            response,
-            text_encoding=EAmuseProtocol.SHIFT_JIS,
-            packet_encoding=EAmuseProtocol.XML,
-        ),
-        headers={
-            "X-Powered-By": "Hiiragi",
-            "X-Compress": "none",
-            "X-Eamuse-Info": xeamuse,
-            "Date": date,
-            "Connection": "keep-alive",
-            "Keep-Alive": "timeout=5",
-        },
-        media_type="application/octet-stream",
-    )
+        # Reply the same way the request was sent
+        if isinstance(response, FilledTemplate):
+            # Pre-encoded, only the changing fields need patching in
+            packet = response.encode(context.text_encoding, context.packet_encoding)
+        elif isinstance(response, Node):
+            packet = await executor.encode(response, context)
+        else:
+            raise exceptions.WrongResponse()
+        timer.mark("encode", len(packet))
+
+        if len(packet) < COMPRESS_THRESHOLD:
+            compress = None
+        data = await executor.wrap(compress, None, packet, level=plugin.level(action))
+        timer.mark("compress", len(data))
+
+        if cache is not None:
+            cache.put(
+                request,
+                context.tree,
+                context.text_encoding,
+                context.packet_encoding,
+                context.compression,
+                data,
+                compress,
+            )
+
+    key, date = generateKey()
+    headers = {
+        "X-Powered-By": "Hiiragi",
+        "X-Compress": compress or "none",
+        "Date": date,
+        "Connection": "keep-alive",
+        "Keep-Alive": "timeout=5",
+    }
+    if xeamuse:
+        # Only encrypt if the game encrypted its request
+        xeamuse = key
+        headers["X-Eamuse-Info"] = xeamuse
+
+    data = await executor.wrap(None, xeamuse, data)
+    timer.mark("encrypt", len(data))
+    timer.finish()
+    if metrics.serverTiming:
+        headers["Server-Timing"] = timer.serverTiming()
+
+    return Response(data, headers=headers, media_type="application/octet-stream")
@@ -0,0 +1,361 @@
+"""
+Captures raw request and response packets to rotating, gzipped JSON lines segments.
+
+Packets are queued as they are, without being decoded, and written by a single
+background thread, so capturing costs a request little more than a queue put. Segments
+can be rendered as XML afterwards:
+
+    python -m hiiragi.capture captures/ [--action services.get] [--responses DIR]
+"""
+
+import argparse
+import asyncio
+import base64
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Any, Dict, Iterator, List, Mapping, Optional
+
+from typing_extensions import Final
+
+from hiiragi.log import logger
+from hiiragi.protocol.node import Node
+from hiiragi.protocol.protocol import EAmuseProtocol
+
+protocol = EAmuseProtocol()
+
+
+class CaptureException(Exception):
+    pass
+
+
+class CaptureRecord:
+    """
+    A single call as it was sent over the wire, along with its response.
+    """
+
+    def __init__(
+        self,
+        action: str,
+        method: str,
+        path: str,
+        requestHeaders: Mapping[str, str],
+        requestBody: bytes,
+        status: int,
+        responseHeaders: Mapping[str, str],
+        responseBody: bytes,
+        timestamp: Optional[float] = None,
+    ):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.action = action
+        self.method = method
+        self.path = path
+        self.requestHeaders = {
+            key.lower(): value for key, value in requestHeaders.items()
+        }
+        self.requestBody = requestBody
+        self.status = status
+        self.responseHeaders = {
+            key.lower(): value for key, value in responseHeaders.items()
+        }
+        self.responseBody = responseBody
+
+    def toJson(self) -> Dict[str, Any]:
+        return {
+            "time": self.timestamp,
+            "action": self.action,
+            "method": self.method,
+            "path": self.path,
+            "request": {
+                "headers": self.requestHeaders,
+                "body": base64.b64encode(self.requestBody).decode("ascii"),
+            },
+            "response": {
+                "status": self.status,
+                "headers": self.responseHeaders,
+                "body": base64.b64encode(self.responseBody).decode("ascii"),
+            },
+        }
+
+    @classmethod
+    def fromJson(cls, data: Dict[str, Any]) -> "CaptureRecord":
+        try:
+            return cls(
+                action=data["action"],
+                method=data["method"],
+                path=data["path"],
+                requestHeaders=data["request"]["headers"],
+                requestBody=base64.b64decode(data["request"]["body"]),
+                status=data["response"]["status"],
+                responseHeaders=data["response"]["headers"],
+                responseBody=base64.b64decode(data["response"]["body"]),
+                timestamp=data["time"],
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise CaptureException(f"Invalid capture record: {e}")
+
+    @staticmethod
+    def __decode(headers: Mapping[str, str], body: bytes) -> Node:
+        compress = "lz77" if headers.get("x-compress", "none") != "none" else None
+        return protocol.decode_context(
+            compress, headers.get("x-eamuse-info"), body
+        ).tree
+
+    def requestTree(self) -> Node:
+        return self.__decode(self.requestHeaders, self.requestBody)
+
+    def responseTree(self) -> Node:
+        return self.__decode(self.responseHeaders, self.responseBody)
+
+    def render(self) -> str:
+        """
+        Render the request and response as XML, one after the other.
+        """
+        return str(self.requestTree()) + "\n\n" + str(self.responseTree())
+
+
+class CaptureWriter:
+    """
+    Appends captured calls to gzipped JSON lines segments in a directory. A segment is
+    closed once it reaches the size limit, and the oldest segments are deleted so that
+    no more than the given number are kept.
+
+    The queue is bounded. When the disk can't keep up, calls are dropped and counted
+    rather than letting the queue grow or making requests wait.
+    """
+
+    PREFIX: Final[str] = "capture-"
+    SUFFIX: Final[str] = ".jsonl.gz"
+
+    DEFAULT_DIRECTORY: Final[str] = "./captures"
+    # Compressed bytes per segment
+    DEFAULT_SEGMENT_SIZE: Final[int] = 64 * 1024 * 1024
+    DEFAULT_SEGMENTS: Final[int] = 16
+    DEFAULT_QUEUE_SIZE: Final[int] = 4096
+
+    def __init__(
+        self,
+        directory: str = DEFAULT_DIRECTORY,
+        segmentSize: int = DEFAULT_SEGMENT_SIZE,
+        segments: int = DEFAULT_SEGMENTS,
+        queueSize: int = DEFAULT_QUEUE_SIZE,
+        enabled: bool = True,
+    ):
+        if segmentSize <= 0 or segments <= 0 or queueSize <= 0:
+            raise ValueError("Capture sizes must be positive")
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.segments = segments
+        self.queueSize = queueSize
+        self.enabled = enabled
+        self.written = 0
+        self.dropped = 0
+        self.__queue: Optional[asyncio.Queue] = None
+        self.__task: Optional[asyncio.Task] = None
+        self.__io: Optional[ThreadPoolExecutor] = None
+        self.__raw: Optional[IO[bytes]] = None
+        self.__file: Optional[gzip.GzipFile] = None
+        self.__sequence = 0
+
+    @classmethod
+    def fromEnvironment(cls) -> "CaptureWriter":
+        """
+        Configure a writer from HIIRAGI_CAPTURE, HIIRAGI_CAPTURE_DIR,
+        HIIRAGI_CAPTURE_SEGMENT_SIZE, HIIRAGI_CAPTURE_SEGMENTS and
+        HIIRAGI_CAPTURE_QUEUE_SIZE.
+        """
+        return cls(
+            directory=os.environ.get("HIIRAGI_CAPTURE_DIR", cls.DEFAULT_DIRECTORY),
+            segmentSize=int(
+                os.environ.get("HIIRAGI_CAPTURE_SEGMENT_SIZE", cls.DEFAULT_SEGMENT_SIZE)
+            ),
+            segments=int(
+                os.environ.get("HIIRAGI_CAPTURE_SEGMENTS", cls.DEFAULT_SEGMENTS)
+            ),
+            queueSize=int(
+                os.environ.get("HIIRAGI_CAPTURE_QUEUE_SIZE", cls.DEFAULT_QUEUE_SIZE)
+            ),
+            enabled=os.environ.get("HIIRAGI_CAPTURE", "on").lower()
+            in ("1", "true", "yes", "on"),
+        )
+
+    def start(self):
+        if not self.enabled or self.__task is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.__queue = asyncio.Queue(maxsize=self.queueSize)
+        # A single thread, so that segments are only ever touched by one writer
+        self.__io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="capture")
+        self.__task = asyncio.get_running_loop().create_task(self.__run())
+
+    async def stop(self):
+        """
+        Write out everything still queued and close the current segment.
+        """
+        if self.__task is None:
+            return
+        await self.__queue.put(None)
+        await self.__task
+        await asyncio.get_running_loop().run_in_executor(self.__io, self.__close)
+        self.__io.shutdown(wait=True)
+        self.__task = None
+        self.__queue = None
+        self.__io = None
+
+    def capture(self, record: CaptureRecord):
+        """
+        Queue a call to be written, without waiting. Nothing is captured until the
+        writer is started.
+        """
+        if self.__queue is None:
+            return
+        try:
+            self.__queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Write whatever built up while the last batch was being written in one go
+            batch: List[CaptureRecord] = []
+            record = await self.__queue.get()
+            while record is not None:
+                batch.append(record)
+                if self.__queue.empty():
+                    break
+                record = self.__queue.get_nowait()
+
+            if batch:
+                try:
+                    await loop.run_in_executor(self.__io, self.__write, batch)
+                    self.written += len(batch)
+                except Exception as e:
+                    # Losing some captures is better than stopping capture entirely
+                    self.dropped += len(batch)
+                    logger.error(f"Couldn't write captures: {e}")
+            if record is None:
+                return
+
+    def __write(self, batch: List[CaptureRecord]):
+        if self.__file is None:
+            self.__open()
+        self.__file.write(
+            b"".join(
+                json.dumps(record.toJson(), ensure_ascii=False).encode("utf-8") + b"\n"
+                for record in batch
+            )
+        )
+        # Sync flush, so that a segment being written can already be read up to here
+        self.__file.flush(zlib.Z_SYNC_FLUSH)
+        if self.__raw.tell() >= self.segmentSize:
+            self.__close()
+
+    def __open(self):
+        self.__sequence += 1
+        name = (
+            f"{self.PREFIX}{time.strftime('%Y%m%d-%H%M%S')}-"
+            f"{self.__sequence:06d}{self.SUFFIX}"
+        )
+        self.__raw = open(os.path.join(self.directory, name), "wb")
+        self.__file = gzip.GzipFile(fileobj=self.__raw, mode="wb")
+        self.__prune()
+
+    def __close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__raw.close()
+            self.__file = None
+            self.__raw = None
+
+    def __prune(self):
+        existing = segmentPaths(self.directory)
+        for path in existing[: max(0, len(existing) - self.segments)]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Couldn't remove old capture {path}: {e}")
+
+
+def segmentPaths(path: str) -> List[str]:
+    """
+    The segments at a path, oldest first. A path to a file is a single segment.
+    """
+    if not os.path.isdir(path):
+        return [path]
+    # Names start with the time they were opened, so they sort oldest first
+    return [
+        os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if name.startswith(CaptureWriter.PREFIX) and name.endswith(CaptureWriter.SUFFIX)
+    ]
+
+
+def readCapture(path: str) -> Iterator[CaptureRecord]:
+    """
+    Read every call captured in a segment, or in every segment in a directory.
+    Segments that are still being written or were never closed are read up to the
+    last complete call.
+
+    Parameters:
+        path - A segment or a directory of segments.
+    """
+    for segment in segmentPaths(path):
+        with gzip.open(segment, "rb") as f:
+            while True:
+                try:
+                    line = f.readline()
+                except (EOFError, gzip.BadGzipFile, zlib.error):
+                    # No trailer, so the segment wasn't closed
+                    break
+                if not line:
+                    break
+                if not line.endswith(b"\n"):
+                    # Cut off in the middle of a call
+                    break
+                yield CaptureRecord.fromJson(json.loads(line))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Render captured calls as XML.")
+    parser.add_argument("path", help="A capture segment or a directory of them")
+    parser.add_argument(
+        "--action",
+        action="append",
+        help="Only render this action (f=), can be given more than once",
+    )
+    parser.add_argument(
+        "--responses",
+        help="Write the latest call of every action to {action}.txt in this directory",
+    )
+    args = parser.parse_args()
+
+    for record in readCapture(args.path):
+        if args.action and record.action not in args.action:
+            continue
+        try:
+            rendered = record.render()
+        except Exception as e:
+            # Anything can come through a proxy, so skip what isn't a packet
+            logger.warning(f"Couldn't decode {record.action}: {e}")
+            continue
+        if args.responses:
+            os.makedirs(args.responses, exist_ok=True)
+            with open(
+                os.path.join(args.responses, f"{record.action}.txt"),
+                "w",
+                encoding="utf-8",
+            ) as f:
+                f.write(rendered)
+        else:
+            sys.stdout.write(
+                f"# {record.action} at {record.timestamp}\n{rendered}\n\n"
+            )
+
+
+if __name__ == "__main__":
+    main()
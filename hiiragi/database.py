@@ -0,0 +1,297 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, NamedTuple, Optional, TypeVar, Union
+
+from typing_extensions import Final
+
+from hiiragi.log import logger
+
+T = TypeVar("T")
+
+# A migration is SQL (any number of statements) or a function given the connection
+Migration = Union[str, Callable[[sqlite3.Connection], None]]
+
+
+class DatabaseException(Exception):
+    pass
+
+
+class ExecuteResult(NamedTuple):
+    rowcount: int
+    lastrowid: Optional[int]
+
+
+class Database:
+    """
+    SQLite storage shared by every plugin, used from async handlers without blocking
+    the event loop.
+
+    The database is in WAL mode, so reads never wait for a write. Reads run on a pool of
+    threads with a connection each. Writes and transactions all run on a single writer
+    thread, because SQLite only allows one writer at a time. Queuing them there costs
+    less than having connections wait on each other's locks.
+
+    Every connection keeps its recently used statements prepared, keyed by their SQL.
+    Always pass values as parameters rather than formatting them into the SQL.
+    """
+
+    DEFAULT_PATH: Final[str] = "./hiiragi.db"
+    DEFAULT_CONNECTIONS: Final[int] = 4
+    # Prepared statements kept per connection
+    STATEMENT_CACHE_SIZE: Final[int] = 256
+    # Seconds a connection waits on a lock held by another process
+    BUSY_TIMEOUT: Final[float] = 5.0
+
+    def __init__(
+        self, path: str = DEFAULT_PATH, connections: int = DEFAULT_CONNECTIONS
+    ):
+        if connections <= 0:
+            raise ValueError("A database needs at least one reader connection")
+        self.path = path
+        self.connections = connections
+        self.__local = threading.local()
+        self.__opened: List[sqlite3.Connection] = []
+        self.__lock = threading.Lock()
+        self.__readers: Optional[ThreadPoolExecutor] = None
+        self.__writer: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def fromEnvironment(cls) -> "Database":
+        """
+        Configure a database from HIIRAGI_DATABASE and HIIRAGI_DATABASE_CONNECTIONS.
+        """
+        return cls(
+            path=os.environ.get("HIIRAGI_DATABASE", cls.DEFAULT_PATH),
+            connections=int(
+                os.environ.get("HIIRAGI_DATABASE_CONNECTIONS", cls.DEFAULT_CONNECTIONS)
+            ),
+        )
+
+    def __connection(self) -> sqlite3.Connection:
+        # Every pool thread opens its own connection the first time it's used
+        connection = getattr(self.__local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path,
+                timeout=self.BUSY_TIMEOUT,
+                cached_statements=self.STATEMENT_CACHE_SIZE,
+                check_same_thread=False,
+                # Transactions are begun and ended explicitly
+                isolation_level=None,
+            )
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            # Safe with WAL, only the last transactions can be lost on power loss
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            self.__local.connection = connection
+            with self.__lock:
+                self.__opened.append(connection)
+        return connection
+
+    def __getReaders(self) -> ThreadPoolExecutor:
+        if self.__readers is None:
+            self.__readers = ThreadPoolExecutor(
+                max_workers=self.connections, thread_name_prefix="database"
+            )
+        return self.__readers
+
+    def __getWriter(self) -> ThreadPoolExecutor:
+        if self.__writer is None:
+            self.__writer = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="database-writer"
+            )
+        return self.__writer
+
+    def __transaction(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        connection = self.__connection()
+        # Immediate, so that the write lock is held from the start
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(connection)
+            connection.execute("COMMIT")
+        except BaseException:
+            # The commit can fail too, which leaves the transaction open. It has to be
+            # ended either way, or every later write on this thread would fail.
+            if connection.in_transaction:
+                try:
+                    connection.execute("ROLLBACK")
+                except sqlite3.Error as e:
+                    logger.error(f"Couldn't roll back a failed transaction: {e}")
+            raise
+        return result
+
+    async def __read(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.__getReaders(), lambda: func(self.__connection())
+        )
+
+    async def __write(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__getWriter(), self.__transaction, func)
+
+    async def fetchOne(
+        self, sql: str, parameters: Iterable[Any] = ()
+    ) -> Optional[sqlite3.Row]:
+        """
+        Run a query, returning its first row or None if there were none.
+
+        Parameters:
+            sql - A single SQL statement, with ? for each parameter.
+            parameters - The values of the parameters.
+
+        Returns:
+            A row, whose columns can be looked up by name or position.
+        """
+        values = tuple(parameters)
+        return await self.__read(
+            lambda connection: connection.execute(sql, values).fetchone()
+        )
+
+    async def fetchAll(
+        self, sql: str, parameters: Iterable[Any] = ()
+    ) -> List[sqlite3.Row]:
+        """
+        Run a query, returning every row.
+        """
+        values = tuple(parameters)
+        return await self.__read(
+            lambda connection: connection.execute(sql, values).fetchall()
+        )
+
+    async def execute(self, sql: str, parameters: Iterable[Any] = ()) -> ExecuteResult:
+        """
+        Run a statement that changes something, in a transaction of its own.
+
+        Returns:
+            How many rows were changed, and the ID of the last row inserted if any.
+        """
+
+        values = tuple(parameters)
+
+        def execute(connection: sqlite3.Connection) -> ExecuteResult:
+            cursor = connection.execute(sql, values)
+            return ExecuteResult(cursor.rowcount, cursor.lastrowid)
+
+        return await self.__write(execute)
+
+    async def executeMany(
+        self, sql: str, parameters: Iterable[Iterable[Any]]
+    ) -> ExecuteResult:
+        """
+        Run a statement once for every set of parameters, all in one transaction.
+        """
+        rows = [tuple(row) for row in parameters]
+
+        def execute(connection: sqlite3.Connection) -> ExecuteResult:
+            cursor = connection.executemany(sql, rows)
+            return ExecuteResult(cursor.rowcount, cursor.lastrowid)
+
+        return await self.__write(execute)
+
+    async def transaction(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        """
+        Run a function in a transaction on the writer thread. Everything it does is
+        committed if it returns, and rolled back if it raises.
+
+        Parameters:
+            func - Called with the connection, it mustn't begin or end transactions.
+
+        Returns:
+            Whatever func returns.
+        """
+        return await self.__write(func)
+
+    def migrate(self, namespace: str, migrations: List[Migration]):
+        """
+        Bring a namespace's tables up to date by applying every migration that hasn't
+        been applied yet, in order. Each migration runs in its own transaction and is
+        recorded as applied with it, so a failed one can be fixed and retried.
+
+        Migrations are only ever added to the end of the list, never changed or
+        removed. This blocks until done, so it's only for startup.
+
+        Parameters:
+            namespace - Who the migrations belong to, such as a plugin's game.
+            migrations - SQL or functions, applied from first to last.
+        """
+
+        def version(connection: sqlite3.Connection) -> int:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS hiiragi_migrations "
+                "(namespace TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+            )
+            row = connection.execute(
+                "SELECT version FROM hiiragi_migrations WHERE namespace = ?",
+                (namespace,),
+            ).fetchone()
+            return 0 if row is None else row["version"]
+
+        def apply(connection: sqlite3.Connection, index: int) -> None:
+            migration = migrations[index]
+            if isinstance(migration, str):
+                # executescript would commit the transaction, so run them one by one
+                for statement in splitStatements(migration):
+                    connection.execute(statement)
+            else:
+                migration(connection)
+            connection.execute(
+                "INSERT INTO hiiragi_migrations (namespace, version) VALUES (?, ?) "
+                "ON CONFLICT (namespace) DO UPDATE SET version = excluded.version",
+                (namespace, index + 1),
+            )
+
+        writer = self.__getWriter()
+        current = writer.submit(self.__transaction, version).result()
+        if current > len(migrations):
+            raise DatabaseException(
+                f'"{namespace}" is at migration {current}, but only '
+                f"{len(migrations)} are known"
+            )
+
+        for index in range(current, len(migrations)):
+            logger.info(f'Applying migration {index + 1} of "{namespace}"...')
+            try:
+                writer.submit(
+                    self.__transaction, lambda connection: apply(connection, index)
+                ).result()
+            except sqlite3.Error as e:
+                raise DatabaseException(
+                    f'Migration {index + 1} of "{namespace}" failed: {e}'
+                )
+
+    def close(self):
+        for pool in (self.__readers, self.__writer):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self.__readers = None
+        self.__writer = None
+        with self.__lock:
+            for connection in self.__opened:
+                connection.close()
+            self.__opened.clear()
+        self.__local = threading.local()
+
+
+def splitStatements(script: str) -> List[str]:
+    """
+    Split SQL into complete statements, so that semicolons in strings or triggers
+    don't end one early.
+    """
+    statements = []
+    current = ""
+    for char in script:
+        current += char
+        if char == ";" and sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ""
+    if current.strip():
+        raise DatabaseException(f"Incomplete SQL statement: {current.strip()}")
+    return statements
+
+
+database = Database.fromEnvironment()
@@ -1,30 +1,166 @@
 import importlib
 import os
+import time
 import types
-from typing import Awaitable, Callable, Dict, Optional
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple, Union
 
 from fastapi import Request
 
+from hiiragi.database import database
 from hiiragi.log import logger
 from hiiragi.protocol.node import Node
+from hiiragi.protocol.template import FilledTemplate
+
+# What an action returns, either a tree or a filled in response template
+ActionResponse = Union[Node, FilledTemplate]
+
+
+class ResponseCache:
+    """
+    Remembers the encoded and compressed response of an action whose response doesn't
+    change between calls, so that it can be sent again without calling the action or
+    encoding anything. Responses are kept per request key (if the action has one), text
+    encoding, packet encoding and compression, since the same action is answered
+    differently depending on how the game talks to us. Encryption uses a new key every
+    time, so it is never cached.
+    """
+
+    MAX_ENTRIES = 256
+
+    def __init__(
+        self,
+        ttl: Optional[float] = None,
+        key: Optional[Callable[[Request, Node], Hashable]] = None,
+    ):
+        self.ttl = ttl
+        self.key = key
+        self.__entries: Dict[Tuple, Tuple[float, bytes, Optional[str]]] = {}
+
+    def __entryKey(
+        self,
+        request: Request,
+        node: Node,
+        textEncoding: str,
+        packetEncoding: int,
+        compression: Optional[str],
+    ) -> Tuple:
+        requestKey = self.key(request, node) if self.key is not None else None
+        return (requestKey, textEncoding, packetEncoding, compression)
+
+    def get(
+        self,
+        request: Request,
+        node: Node,
+        textEncoding: str,
+        packetEncoding: int,
+        compression: Optional[str],
+    ) -> Optional[Tuple[bytes, Optional[str]]]:
+        """
+        Look up a cached response. Returns the response and the compression it was sent
+        with, or None if there isn't one or it expired.
+        """
+        entryKey = self.__entryKey(
+            request, node, textEncoding, packetEncoding, compression
+        )
+        entry = self.__entries.get(entryKey)
+        if entry is None:
+            return None
+        expires, data, compressed = entry
+        if expires < time.monotonic():
+            self.__entries.pop(entryKey, None)
+            return None
+        return data, compressed
+
+    def put(
+        self,
+        request: Request,
+        node: Node,
+        textEncoding: str,
+        packetEncoding: int,
+        compression: Optional[str],
+        data: bytes,
+        compressed: Optional[str],
+    ):
+        """
+        Remember a response, compressed with compressed (or None if it was sent
+        uncompressed), for requests matching the given one.
+        """
+        entryKey = self.__entryKey(
+            request, node, textEncoding, packetEncoding, compression
+        )
+        expires = float("inf") if self.ttl is None else time.monotonic() + self.ttl
+        if entryKey not in self.__entries and len(self.__entries) >= self.MAX_ENTRIES:
+            # Forget the oldest response. Only ever used on the event loop, so nothing
+            # else can change the entries in between.
+            del self.__entries[next(iter(self.__entries))]
+        self.__entries[entryKey] = (expires, data, compressed)
+
+    def invalidate(self):
+        self.__entries.clear()
 
 
 class Plugin:
     def __init__(self, module: types.ModuleType):
-        self.__dispatched: Dict[str, Callable[[Request, Node], Awaitable[Node]]] = {}
+        self.__dispatched: Dict[
+            str, Callable[[Request, Node], Awaitable[ActionResponse]]
+        ] = {}
+        self.__levels: Dict[str, str] = {}
+        self.__caches: Dict[str, ResponseCache] = {}
         self.name = module.name
         self.version = module.version
+        # Shared by every plugin, so tables should be prefixed with the plugin's game
+        self.db = database
+        migrations = getattr(module, "migrations", None)
+        if migrations:
+            # Bring the plugin's tables up to date before anything can use them
+            self.db.migrate(module.game, migrations)
         module.load(self)
 
-    def dispatch(self, action: str, func: Callable[[Request, Node], Awaitable[Node]]):
+    def dispatch(
+        self,
+        action: str,
+        func: Callable[[Request, Node], Awaitable[ActionResponse]],
+        level: Optional[str] = None,
+        cacheable: bool = False,
+        ttl: Optional[float] = None,
+        key: Optional[Callable[[Request, Node], Hashable]] = None,
+    ):
         self.__dispatched[action] = func
+        if level is not None:
+            # Compression level (see Lz77.LEVEL_*) for this action's responses
+            self.__levels[action] = level
+        if cacheable:
+            # The response only depends on key(request, node), if given, so it can be
+            # encoded once and reused for ttl seconds (forever if None)
+            self.__caches[action] = ResponseCache(ttl=ttl, key=key)
+        else:
+            self.__caches.pop(action, None)
         logger.debug(f"Dispatched action: {action}")
 
-    def get(self, action: str) -> Optional[Callable[[Request, Node], Awaitable[Node]]]:
+    def get(
+        self, action: str
+    ) -> Optional[Callable[[Request, Node], Awaitable[ActionResponse]]]:
         if action not in self.__dispatched:
             return None
         return self.__dispatched[action]
 
+    def level(self, action: str) -> Optional[str]:
+        return self.__levels.get(action)
+
+    def cache(self, action: str) -> Optional[ResponseCache]:
+        return self.__caches.get(action)
+
+    def invalidate(self, action: Optional[str] = None):
+        """
+        Forget cached responses for an action, or for every action if none is given.
+        Call this whenever something a cached response depends on changes.
+        """
+        if action is None:
+            for cache in self.__caches.values():
+                cache.invalidate()
+        elif action in self.__caches:
+            self.__caches[action].invalidate()
+
 
 class PluginManager:
     games: Dict[str, Plugin] = {}
@@ -1,5 +1,7 @@
 import struct
-from typing import Any, Dict, List, Optional
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from typing_extensions import Final
 
@@ -42,6 +44,14 @@ class PackedOrdering:
         1 4 0 0 2 2 2 2 2 2 2 0 3 3 0 0
     """
 
+    # What each byte of the body is currently used by. Only bytes and shorts can be
+    # packed next to something of the same size, so any other size is lumped together.
+    FREE: Final[int] = 0
+    BYTE: Final[int] = 1
+    SHORT: Final[int] = 2
+    OTHER: Final[int] = 3
+    MARKS: Final[List[bytes]] = [b"", b"\x01", b"\x02\x02", b"\x03"]
+
     def __init__(self, size: int, allow_expansion: bool = False) -> None:
         """
         Initialize with a known size. If this is to be used to create a packing instead of deduce
@@ -49,23 +59,75 @@ class PackedOrdering:
         needed. If this is to be used for decoding a current packing, allow_expansion should be set
         to False to ensure we don't choose locations outside the buffer.
 
+        Rather than scanning every byte of the body when looking for a spot, we keep track of
+        which 4 byte chunks still have room for a byte, a short or an integer, and search those
+        with bytearray.find() from the last spot handed out for that size.
+
         Parameters:
             size - Number of bytes to work with as an integer
             allow_expansion - Boolean describing whether to add to the end of the order when needed
         """
-        self.order: List[Optional[int]] = []
+        chunks = (size + 3) >> 2
         self.expand = allow_expansion
-
-        for _ in range(size):
-            self.order.append(None)
+        self.state = bytearray(chunks * 4)
+        self.__byte_ok = bytearray(b"\x01") * chunks
+        self.__short_ok = bytearray(b"\x01") * chunks
+        self.__int_ok = bytearray(b"\x01") * chunks
         self.__orderlen = size
         self.__lastbyte = 0
         self.__lastshort = 0
         self.__lastint = 0
 
-    def __append_empty(self) -> None:
-        self.order.append(None)
-        self.__orderlen = self.__orderlen + 1
+        if not allow_expansion and (size & 3) != 0:
+            # The tail of the last chunk is past the end of the buffer, so it can't be used
+            other = PackedOrdering.MARKS[PackedOrdering.OTHER]
+            self.state[size:] = other * (chunks * 4 - size)
+            self.__update(chunks - 1)
+
+    def __update(self, chunk: int) -> None:
+        """
+        Recompute what a 4 byte chunk still has room for.
+
+        Parameters:
+            chunk - Index of the chunk to recompute
+        """
+        state = self.state
+        i = chunk * 4
+        s0 = state[i]
+        if s0 == 0:
+            self.__byte_ok[chunk] = 1
+            self.__short_ok[chunk] = 1
+            self.__int_ok[chunk] = (
+                state[i + 1] == 0 and state[i + 2] == 0 and state[i + 3] == 0
+            )
+            return
+
+        self.__int_ok[chunk] = 0
+        if s0 == 1:
+            self.__short_ok[chunk] = 0
+            # Room for a byte if the first thing after the bytes already here is free
+            self.__byte_ok[chunk] = (
+                state[(i + 1) : (i + 4)].lstrip(b"\x01")[:1] == b"\x00"
+            )
+        else:
+            self.__byte_ok[chunk] = 0
+            self.__short_ok[chunk] = (
+                s0 == 2 and state[i + 1] == 2 and state[i + 2] == 0 and state[i + 3] == 0
+            )
+
+    def __grow(self, length: int) -> None:
+        """
+        Make room for at least length bytes, doubling so that appending one value at a
+        time doesn't copy the whole buffer every time.
+
+        Parameters:
+            length - Number of bytes that should fit
+        """
+        chunks = max((length + 3) >> 2, len(self.__int_ok) * 2) - len(self.__int_ok)
+        self.state.extend(bytes(chunks * 4))
+        self.__byte_ok.extend(b"\x01" * chunks)
+        self.__short_ok.extend(b"\x01" * chunks)
+        self.__int_ok.extend(b"\x01" * chunks)
 
     def mark_used(self, size: int, offset: int, round_to: int = 1) -> None:
         """
@@ -77,17 +139,39 @@ class PackedOrdering:
             round_to - Optional integer specifying how many bytes to round to. Valid values are 1, 2 and 4
         """
         # Round to nearest value if needed
-        while (size & (round_to - 1)) != 0:
-            size = size + 1
+        size = (size + round_to - 1) & ~(round_to - 1)
+        if size <= 0:
+            return
 
-        # Expand buffer if needed
-        if self.expand:
-            while self.__orderlen < (size + offset):
-                self.__append_empty()
+        end = size + offset
+        if end > self.__orderlen:
+            if not self.expand:
+                raise BinaryEncodingException(
+                    f"Data at offset {offset} of size {size} runs past the end of the body!"
+                )
+
+            # Expand buffer if needed
+            self.__orderlen = end
+            if end > len(self.state):
+                self.__grow(end)
 
         # Mark buffer as used
-        for i in range(size):
-            self.order[i + offset] = size
+        first = offset >> 2
+        last = (end - 1) >> 2
+        if size < PackedOrdering.OTHER:
+            self.state[offset:end] = PackedOrdering.MARKS[size]
+        else:
+            self.state[offset:end] = PackedOrdering.MARKS[PackedOrdering.OTHER] * size
+
+            # Chunks completely covered by this have no room left for anything
+            if last - first > 1:
+                self.__byte_ok[(first + 1) : last] = bytes(last - first - 1)
+                self.__short_ok[(first + 1) : last] = bytes(last - first - 1)
+                self.__int_ok[(first + 1) : last] = bytes(last - first - 1)
+
+        self.__update(first)
+        if last != first:
+            self.__update(last)
 
     def get_next_byte(self) -> Optional[int]:
         """
@@ -96,27 +180,16 @@ class PackedOrdering:
         """
         # If we expand for additions, make sure we've padded to a 4 byte boundary
         if self.expand:
-            while (self.__orderlen & 3) != 0:
-                self.__append_empty()
-
-        for i in range(self.__lastbyte, self.__orderlen, 4):
-            if self.order[i] is not None:
-                # See if this has room for a byte
-                for j in range(0, 4):
-                    if self.order[i + j] == 1:
-                        # This is okay, we can pack after this
-                        continue
-                    elif self.order[i + j] is None:
-                        # This is open, pack here
-                        self.__lastbyte = i
-                        return i + j
-                    else:
-                        # This is something else, can't pack here
-                        break
-            else:
-                # Couldn't find optimal packing, pack here
-                self.__lastbyte = i
-                return i
+            self.__orderlen = (self.__orderlen + 3) & ~3
+
+        chunk = self.__byte_ok.find(1, self.__lastbyte >> 2, (self.__orderlen + 3) >> 2)
+        if chunk >= 0:
+            # Pack after any bytes already in this chunk
+            i = chunk * 4
+            self.__lastbyte = i
+            while self.state[i] == PackedOrdering.BYTE:
+                i = i + 1
+            return i
 
         if self.expand:
             self.__lastbyte = self.__orderlen
@@ -131,26 +204,18 @@ class PackedOrdering:
         """
         # If we expand for additions, make sure we've padded to a 4 byte boundary
         if self.expand:
-            while (self.__orderlen & 3) != 0:
-                self.__append_empty()
-
-        for i in range(self.__lastshort, self.__orderlen, 4):
-            if self.order[i] is not None:
-                for j in range(0, 4, 2):
-                    if self.order[i + j] == 2 and self.order[i + j + 1] == 2:
-                        # This is okay, we can pack after this
-                        continue
-                    elif self.order[i + j] is None and self.order[i + j + 1] is None:
-                        # This is open, pack here
-                        self.__lastshort = i
-                        return i + j
-                    else:
-                        # This is something else, can't pack here
-                        break
-            else:
-                # Couldn't find optimal packing, pack here
-                self.__lastshort = i
-                return i
+            self.__orderlen = (self.__orderlen + 3) & ~3
+
+        chunk = self.__short_ok.find(
+            1, self.__lastshort >> 2, (self.__orderlen + 3) >> 2
+        )
+        if chunk >= 0:
+            # Pack after a short already in this chunk, if there is one
+            i = chunk * 4
+            self.__lastshort = i
+            if self.state[i] == PackedOrdering.SHORT:
+                return i + 2
+            return i
 
         if self.expand:
             self.__lastshort = self.__orderlen
@@ -165,21 +230,12 @@ class PackedOrdering:
         """
         # If we expand for additions, make sure we've padded to a 4 byte boundary
         if self.expand:
-            while (self.__orderlen & 3) != 0:
-                self.__append_empty()
-
-        for i in range(self.__lastint, self.__orderlen, 4):
-            if self.order[i] is not None:
-                continue
-            if self.order[i + 1] is not None:
-                continue
-            if self.order[i + 2] is not None:
-                continue
-            if self.order[i + 3] is not None:
-                continue
-
-            self.__lastint = i
-            return i
+            self.__orderlen = (self.__orderlen + 3) & ~3
+
+        chunk = self.__int_ok.find(1, self.__lastint >> 2, (self.__orderlen + 3) >> 2)
+        if chunk >= 0:
+            self.__lastint = chunk * 4
+            return chunk * 4
 
         if self.expand:
             self.__lastint = self.__orderlen
@@ -250,17 +306,297 @@ class PackedOrdering:
         return ordering
 
 
+class BinaryLayout:
+    """
+    A compiled body layout for one tree shape. Laying out a body means running the
+    above hole-fill algorithm for every value in the tree, but the result only depends
+    on the shape of the tree (names, types, attributes and the lengths of strings and
+    arrays), and games send and receive a small set of fixed shapes. So, we remember
+    the offset and struct format of every value and merge them into a single struct
+    that packs or unpacks the whole body in one call.
+    """
+
+    def __init__(
+        self, offsets: List[int], formats: List[str], lengths: List[Optional[int]]
+    ) -> None:
+        """
+        Initialize the layout.
+
+        Parameters:
+            offsets - The offset in the body of each value, in body ordering.
+            formats - The struct format of each value, without a byte order.
+            lengths - The length field found at the start of each variable length value,
+                      or None for fixed size values.
+        """
+        self.offsets = offsets
+        self.structs = [struct.Struct(">" + fmt) for fmt in formats]
+        self.counts = [len(st.unpack(bytes(st.size))) for st in self.structs]
+
+        end = max(
+            [offset + st.size for offset, st in zip(offsets, self.structs)], default=0
+        )
+        self.length = (end + 3) & ~3
+        self.order = sorted(range(len(offsets)), key=lambda i: offsets[i])
+
+        # Merge everything into one struct, padding over the holes. This only works if
+        # no two values overlap, which should never happen for a well-formed packet.
+        self.struct: Optional[struct.Struct] = None
+        self.starts: List[int] = [0] * len(offsets)
+        merged = [">"]
+        pos = 0
+        index = 0
+        for i in self.order:
+            if offsets[i] < pos:
+                break
+            if offsets[i] > pos:
+                merged.append(f"{offsets[i] - pos}x")
+            merged.append(formats[i])
+            pos = offsets[i] + self.structs[i].size
+            self.starts[i] = index
+            index += self.counts[i]
+        else:
+            self.struct = struct.Struct("".join(merged))
+        self.padding = bytes(self.length - pos)
+
+        # Variable length values each start with their length. If a body has the same
+        # lengths at the same offsets, it was laid out identically, since each offset
+        # only depends on the lengths of the values that came before it.
+        self.lengths = tuple(
+            lengths[i] for i in sorted(range(len(offsets)), key=lambda i: offsets[i])
+            if lengths[i] is not None
+        )
+        self.probe: Optional[struct.Struct] = None
+        if self.lengths and self.struct is not None:
+            probe = [">"]
+            pos = 0
+            for i in self.order:
+                if lengths[i] is None:
+                    continue
+                if offsets[i] > pos:
+                    probe.append(f"{offsets[i] - pos}x")
+                probe.append("I")
+                pos = offsets[i] + 4
+            self.probe = struct.Struct("".join(probe))
+
+    def matches(self, body: Union[bytes, memoryview]) -> bool:
+        """
+        Returns whether a body to be decoded uses this layout.
+
+        Parameters:
+            body - The body of a binary packet.
+        """
+        if self.struct is None or len(body) < self.struct.size:
+            return False
+        if self.probe is None:
+            return True
+        return self.probe.unpack_from(body) == self.lengths
+
+    def write(self, stream: OutputStream, values: List[Any]) -> None:
+        """
+        Pack a body using this layout, writing it to the end of a stream.
+
+        Parameters:
+            stream - The stream to write to.
+            values - A list of tuples, one per value in body ordering, holding the
+                     arguments to pack for that value.
+        """
+        if self.struct is not None:
+            stream.write_struct(
+                self.struct, *[arg for i in self.order for arg in values[i]]
+            )
+            stream.write_zeros(len(self.padding))
+            return
+
+        # Values overlap, so emulate writing them one after another.
+        start = stream.write_zeros(self.length)
+        for st, offset, args in zip(self.structs, self.offsets, values):
+            stream.pack_at(start + offset, st, *args)
+
+    def unpack(self, body: Union[bytes, memoryview]) -> List[Any]:
+        """
+        Unpack a body using this layout.
+
+        Parameters:
+            body - The body of a binary packet.
+
+        Returns:
+            A list of tuples, one per value in body ordering, holding the unpacked
+            values for that value.
+        """
+        if self.struct is not None:
+            unpacked = self.struct.unpack_from(body)
+            return [
+                unpacked[start : (start + count)]
+                for start, count in zip(self.starts, self.counts)
+            ]
+
+        return [
+            st.unpack_from(body, offset) for st, offset in zip(self.structs, self.offsets)
+        ]
+
+
+class BinarySchema:
+    """
+    The shape of a tree as described by a binary packet header, along with the body
+    layouts seen for it. Decoding a header we have already seen then only needs to
+    construct the nodes instead of parsing node names and walking the tree.
+    """
+
+    MAX_LAYOUTS: Final[int] = 8
+
+    def __init__(self, root: Node) -> None:
+        """
+        Initialize the schema from a tree decoded from the header.
+
+        Parameters:
+            root - The root of a tree as decoded from a header, without any values.
+        """
+        # Name, type, parent index and attribute names of each node, in preorder.
+        self.nodes: List[Tuple[str, int, int, List[str]]] = []
+        # Node index, attribute name (None for the node value) and kind of each value,
+        # in body ordering.
+        self.entries: List[Tuple[int, Optional[str], str]] = []
+        self.layouts: List[BinaryLayout] = []
+
+        stack = [(root, -1)]
+        while stack:
+            node, parent = stack.pop()
+            index = len(self.nodes)
+            self.nodes.append((node.name, node.type, parent, list(node.attributes)))
+
+            if node.data_length != 0:
+                self.entries.append((index, None, BinarySchema.kind(node)))
+            for attr in sorted(node.attributes):
+                self.entries.append((index, attr, "str"))
+
+            stack.extend((child, index) for child in reversed(node.children))
+
+    @staticmethod
+    def kind(node: Node) -> str:
+        """
+        Classify how the value of a node is stored in the body.
+
+        Returns:
+            One of 'str', 'bin', 'array', 'composite' or 'scalar'.
+        """
+        if node.is_array:
+            return "array"
+        if node.data_type in {"str", "bin"}:
+            return node.data_type
+        if node.is_composite:
+            return "composite"
+        return "scalar"
+
+    def build(self) -> List[Node]:
+        """
+        Construct a fresh tree with this schema.
+
+        Returns:
+            A list of every node in preorder, the first being the root.
+        """
+        nodes: List[Node] = []
+        for name, node_type, parent, attributes in self.nodes:
+            node = Node(name=name, type=node_type)
+            for attr in attributes:
+                node.set_attribute(attr)
+            if parent >= 0:
+                nodes[parent].add_child(node)
+            nodes.append(node)
+        return nodes
+
+    def add_layout(self, layout: BinaryLayout) -> None:
+        """
+        Remember a body layout for this schema, forgetting the oldest if needed.
+        """
+        self.layouts.insert(0, layout)
+        del self.layouts[BinarySchema.MAX_LAYOUTS :]
+
+    def find_layout(self, body: Union[bytes, memoryview]) -> Optional[BinaryLayout]:
+        """
+        Find a remembered body layout that the given body uses.
+        """
+        for layout in list(self.layouts):
+            if layout.matches(body):
+                return layout
+        return None
+
+
+class NodeNameCodec:
+    """
+    Packs node and attribute names into the 6-bit-per-character form used by compressed
+    binary headers, and back. Every node and attribute in a header has a name, but games
+    use a small vocabulary of them, so both directions are cached.
+    """
+
+    CACHE_SIZE: Final[int] = 1024
+
+    CHAR_INDEX: Final[Dict[str, int]] = {
+        ch: i for i, ch in enumerate(Node.NODE_NAME_CHARS)
+    }
+
+    @staticmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def pack(name: str) -> bytes:
+        """
+        Pack a name.
+
+        Parameters:
+            name - The name to pack.
+
+        Returns:
+            The length of the name as a single byte, followed by each character as 6 bits,
+            padded with zero bits to a whole byte.
+        """
+        bits = 0
+        try:
+            for ch in name:
+                bits = (bits << 6) | NodeNameCodec.CHAR_INDEX[ch]
+        except KeyError:
+            raise BinaryEncodingException(f"Node name '{name}' has invalid characters")
+
+        length = (len(name) * 6 + 7) // 8
+        bits <<= length * 8 - len(name) * 6
+        return bytes((len(name),)) + bits.to_bytes(length, "big")
+
+    @staticmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def unpack(length: int, packed: bytes) -> str:
+        """
+        Unpack a name.
+
+        Parameters:
+            length - The number of characters in the name.
+            packed - The characters, 6 bits each, padded to a whole byte.
+
+        Returns:
+            The name.
+        """
+        bits = int.from_bytes(packed, "big") >> (len(packed) * 8 - length * 6)
+        chars = Node.NODE_NAME_CHARS
+        return "".join(
+            [chars[(bits >> shift) & 0x3F] for shift in range((length - 1) * 6, -1, -6)]
+        )
+
+
 class BinaryDecoder:
     """
     A class capable of taking a binary blob and decoding it to a Node tree.
     """
 
-    def __init__(self, data: bytes, encoding: str, compressed: bool) -> None:
+    # Schemas decoded from headers we have seen before, keyed by the raw header.
+    SCHEMA_CACHE_SIZE: Final[int] = 256
+    SCHEMAS: Dict[Tuple[str, bool, bytes], BinarySchema] = {}
+    # Decoders run on the codec pool, so evicting and adding has to happen together
+    SCHEMAS_LOCK: Final[threading.Lock] = threading.Lock()
+
+    def __init__(
+        self, data: Union[bytes, memoryview], encoding: str, compressed: bool
+    ) -> None:
         """
         Initialize the object.
 
         Parameters:
-            - data - A binary blob of data to be decoded
+            - data - A binary blob of data to be decoded, which is read without copying
             - encoding - A string representing the text encoding for string elements. Should be either
                          'shift-jis', 'euc-jp' or 'utf-8'
         """
@@ -315,28 +651,14 @@ class BinaryDecoder:
         if length > BinaryEncoding.NAME_MAX_COMPRESSED:
             raise BinaryEncodingException("Node name length over compressed limit")
 
-        binary_length = int(((length * 6) + 7) / 8)
-
-        def int_to_bin(integer: int) -> str:
-            val = bin(integer)[2:]
-            while len(val) < 8:
-                val = "0" + val
-
-            return val
-
-        data = ""
-        for _ in range(binary_length):
-            next_byte = self.stream.read_int()
-            if next_byte is None:
-                raise BinaryEncodingException(
-                    "Ran out of data when attempting to read node name!"
-                )
-            data = data + int_to_bin(next_byte)
-        data_str = [data[i : (i + 6)] for i in range(0, len(data), 6)]
-        data_int = [int(val, 2) for val in data_str]
-        ret = "".join([Node.NODE_NAME_CHARS[val] for val in data_int])
-        ret = ret[:length]
-        return ret
+        packed = self.stream.read_blob((length * 6 + 7) // 8)
+        if packed is None:
+            if length == 0:
+                return ""
+            raise BinaryEncodingException(
+                "Ran out of data when attempting to read node name!"
+            )
+        return NodeNameCodec.unpack(length, packed)
 
     def __read_node(self, node_type: int) -> Node:
         """
@@ -387,128 +709,172 @@ class BinaryDecoder:
                 "Ran out of data when attempting to read header length!"
             )
 
-        node_type = self.stream.read_int()
-        if node_type is None:
-            raise BinaryEncodingException(
-                "Ran out of data when attempting to read root node type!"
-            )
-        root = self.__read_node(node_type)
+        header = self.stream.peek_blob(header_length)
+        if header is None:
+            raise BinaryEncodingException("Header has insufficient data")
 
-        eod = self.stream.read_int()
-        if eod != Node.END_OF_DOCUMENT:
-            raise BinaryEncodingException(f"Unknown node type {eod} at end of document")
+        key = (self.encoding, self.compressed, header)
+        schema = BinaryDecoder.SCHEMAS.get(key)
+        if schema is not None:
+            # We've seen this exact header before, skip right to the body
+            nodes = schema.build()
+            self.stream.skip(header_length)
+        else:
+            node_type = self.stream.read_int()
+            if node_type is None:
+                raise BinaryEncodingException(
+                    "Ran out of data when attempting to read root node type!"
+                )
+            root = self.__read_node(node_type)
 
-        # Skip by any padding
-        while self.stream.pos < header_length + 4:
-            self.stream.read_byte()
+            eod = self.stream.read_int()
+            if eod != Node.END_OF_DOCUMENT:
+                raise BinaryEncodingException(
+                    f"Unknown node type {eod} at end of document"
+                )
+
+            schema = BinarySchema(root)
+            if self.stream.pos <= header_length + 4:
+                # Only remember headers that were parsed without running into the body
+                with BinaryDecoder.SCHEMAS_LOCK:
+                    if len(BinaryDecoder.SCHEMAS) >= BinaryDecoder.SCHEMA_CACHE_SIZE:
+                        del BinaryDecoder.SCHEMAS[next(iter(BinaryDecoder.SCHEMAS))]
+                    BinaryDecoder.SCHEMAS[key] = schema
+            nodes = [root]
+            stack = list(reversed(root.children))
+            while stack:
+                node = stack.pop()
+                nodes.append(node)
+                stack.extend(reversed(node.children))
+
+            # Skip by any padding
+            self.stream.skip(header_length + 4 - self.stream.pos)
 
         # Read the body next
         body_length = self.stream.read_int(4)
 
         if body_length is not None and body_length > 0:
             # We have a body
-            body = self.stream.read_blob(body_length)
+            body = self.stream.read_view(body_length)
             if body is None:
                 raise BinaryEncodingException("Body has insufficient data")
 
-            ordering = PackedOrdering(body_length)
-
-            values = PackedOrdering.node_to_body_ordering(root)
+            layout = schema.find_layout(body)
+            if layout is None:
+                layout = self.__layout(schema, nodes, body)
+
+            for (index, attr, kind), val in zip(schema.entries, layout.unpack(body)):
+                node = nodes[index]
+
+                if kind == "str":
+                    # Need to convert this from encoding to standard string.
+                    # Also, need to lob off the trailing null.
+                    string = val[1][:-1]
+                    try:
+                        string = string.decode(self.encoding, "replace")
+                    except UnicodeDecodeError:
+                        # Nothing we can do here
+                        pass
+
+                    if attr is not None:
+                        node.set_attribute(attr, string)
+                    else:
+                        node.set_value(string)
+                elif kind == "bin":
+                    node.set_value(val[1])
+                elif kind == "array":
+                    node.set_value(list(val[1:]))
+                elif kind == "composite":
+                    node.set_value(list(val))
+                else:
+                    node.set_value(val[0])
 
-            for value in values:
-                node = value["node"]
+        return nodes[0]
 
-                if value["type"] == "attribute":
-                    size = None
-                    enc = "s"
-                    dtype = "str"
-                    array = False
-                    composite = False
-                else:
-                    size = node.data_length
-                    enc = node.data_encoding
-                    dtype = node.data_type
-                    array = node.is_array
-                    composite = node.is_composite
-
-                if composite and array:
-                    raise Exception("Logic error, no support for composite arrays!")
-
-                if not array:
-                    # Scalar value
-                    alignment = value["alignment"]
-
-                    if alignment == 1:
-                        loc = ordering.get_next_byte()
-                    elif alignment == 2:
-                        loc = ordering.get_next_short()
-                    elif alignment == 4:
-                        loc = ordering.get_next_int()
-                    if loc is None:
-                        raise BinaryEncodingException(
-                            "Ran out of data when attempting to read node data location!"
-                        )
+    def __layout(
+        self, schema: BinarySchema, nodes: List[Node], body: memoryview
+    ) -> BinaryLayout:
+        """
+        Work out where every value lives in a body we haven't seen the layout of before,
+        and remember it for next time.
 
-                    if size is None:
-                        # The size should be read from the first 4 bytes
-                        size = struct.unpack(">I", body[loc : (loc + 4)])[0]
-                        ordering.mark_used(size + 4, loc, round_to=4)
-                        loc = loc + 4
+        Parameters:
+            schema - The schema decoded from the header.
+            nodes - The nodes for this packet, in preorder.
+            body - The body of the packet.
 
-                        decode_data = body[loc : (loc + size)]
-                        decode_value = f">{size}{enc}"
-                    else:
-                        # The size is built-in
-                        ordering.mark_used(size, loc)
-
-                        decode_data = body[loc : (loc + size)]
-                        decode_value = f">{enc}"
-
-                    if composite:
-                        val_list = list(struct.unpack(decode_value, decode_data))
-                        if value["type"] == "attribute":
-                            raise Exception(
-                                "Logic error, shouldn't have composite attribute type!"
-                            )
-                        node.set_value(val_list)
-                        continue
-
-                    val = struct.unpack(decode_value, decode_data)[0]
-
-                    if dtype == "str":
-                        # Need to convert this from encoding to standard string.
-                        # Also, need to lob off the trailing null.
-                        try:
-                            val = val[:-1].decode(self.encoding, "replace")
-                        except UnicodeDecodeError:
-                            # Nothing we can do here
-                            pass
-
-                    if value["type"] == "attribute":
-                        node.set_attribute(value["name"], val)
-                    else:
-                        node.set_value(val)
-                else:
-                    # Array value
+        Returns:
+            A BinaryLayout describing the body.
+        """
+        ordering = PackedOrdering(len(body))
+        offsets: List[int] = []
+        formats: List[str] = []
+        lengths: List[Optional[int]] = []
+
+        for index, attr, kind in schema.entries:
+            node = nodes[index]
+
+            if attr is not None:
+                size = None
+                enc = "s"
+                array = False
+                composite = False
+                alignment = 4
+            else:
+                size = node.data_length
+                enc = node.data_encoding
+                array = node.is_array
+                composite = node.is_composite
+                alignment = 4 if size is None or size > 4 else size
+
+            if composite and array:
+                raise Exception("Logic error, no support for composite arrays!")
+
+            if not array:
+                # Scalar value
+                if alignment == 1:
+                    loc = ordering.get_next_byte()
+                elif alignment == 2:
+                    loc = ordering.get_next_short()
+                elif alignment == 4:
                     loc = ordering.get_next_int()
-                    if loc is None:
-                        raise BinaryEncodingException(
-                            "Ran out of data when attempting to read array length location!"
-                        )
+                if loc is None:
+                    raise BinaryEncodingException(
+                        "Ran out of data when attempting to read node data location!"
+                    )
 
-                    # The raw size in bytes
-                    length = struct.unpack(">I", body[loc : (loc + 4)])[0]
-                    elems = int(length / size)
+                if size is None:
+                    # The size should be read from the first 4 bytes
+                    size = struct.unpack_from(">I", body, loc)[0]
+                    ordering.mark_used(size + 4, loc, round_to=4)
+                    formats.append(f"I{size}{enc}")
+                    lengths.append(size)
+                else:
+                    # The size is built-in
+                    ordering.mark_used(size, loc)
+                    formats.append(enc)
+                    lengths.append(None)
+                offsets.append(loc)
+            else:
+                # Array value
+                loc = ordering.get_next_int()
+                if loc is None:
+                    raise BinaryEncodingException(
+                        "Ran out of data when attempting to read array length location!"
+                    )
 
-                    ordering.mark_used(length + 4, loc, round_to=4)
-                    loc = loc + 4
-                    decode_data = body[loc : (loc + length)]
-                    decode_value = f">{enc * elems}"
+                # The raw size in bytes
+                length = struct.unpack_from(">I", body, loc)[0]
+                elems = int(length / size)
 
-                    val = struct.unpack(decode_value, decode_data)
-                    node.set_value([v for v in val])
+                ordering.mark_used(length + 4, loc, round_to=4)
+                formats.append("I" + enc * elems)
+                lengths.append(length)
+                offsets.append(loc)
 
-        return root
+        layout = BinaryLayout(offsets, formats, lengths)
+        schema.add_layout(layout)
+        return layout
 
 
 class BinaryEncoder:
@@ -516,6 +882,12 @@ class BinaryEncoder:
     A class capable of taking a Node tree and encoding it into a binary format.
     """
 
+    # The encoded header and body layout for tree shapes we have seen before.
+    LAYOUT_CACHE_SIZE: Final[int] = 256
+    LAYOUTS: Dict[Tuple[str, bool, Tuple[Any, ...]], Tuple[bytes, BinaryLayout]] = {}
+    # Encoders run on the codec pool, so evicting and adding has to happen together
+    LAYOUTS_LOCK: Final[threading.Lock] = threading.Lock()
+
     def __init__(self, tree: Node, encoding: str, compressed: bool = True) -> None:
         """
         Initialize the object.
@@ -528,15 +900,12 @@ class BinaryEncoder:
         self.stream = OutputStream()
         self.encoding = encoding
         self.tree = tree
-        self.__body: List[int] = []
-        self.__body_len = 0
         self.executed = False
         self.compressed = compressed
 
-        # Generate the characer LUT
-        self.char_lut: Dict[str, int] = {}
-        for i in range(len(Node.NODE_NAME_CHARS)):
-            self.char_lut[Node.NODE_NAME_CHARS[i]] = i
+        # Where the body ended up, once encoded
+        self.layout: Optional[BinaryLayout] = None
+        self.body_offset = 0
 
     def __write_node_name(self, name: str) -> None:
         """
@@ -558,37 +927,11 @@ class BinaryEncoder:
             if length < 64:
                 self.stream.write_int(length + 0x3F)
             else:
-                length += 0x7FBF
-                self.stream.write_int((length >> 8) & 0xFF)
-                self.stream.write_int(length & 0xFF)
+                self.stream.write_int(length + 0x7FBF, size=2)
             self.stream.write_blob(encoded)
             return
 
-        def char_to_bin(ch: str) -> str:
-            index = self.char_lut[ch]
-            val = bin(index)[2:]
-
-            while len(val) < 6:
-                val = "0" + val
-
-            return val[-6:]
-
-        # Convert to six bit bytes
-        length = len(name)
-        data = "".join([char_to_bin(c) for c in name])
-
-        # Pad out the rest with zeros
-        while (len(data) & 0x7) != 0:
-            data = data + "0"
-
-        # Convert to 8-bit bytes
-        data_chunks = [data[i : (i + 8)] for i in range(0, len(data), 8)]
-        data_int = [int(val, 2) for val in data_chunks]
-
-        # Output
-        self.stream.write_int(length)
-        for val in data_int:
-            self.stream.write_int(val)
+        self.stream.write_blob(NodeNameCodec.pack(name))
 
     def __write_node(self, node: Node) -> None:
         """
@@ -618,185 +961,190 @@ class BinaryEncoder:
         # Now, write out the end of node marker
         self.stream.write_int(Node.END_OF_NODE)
 
-    def __add_data(self, data: bytes, length: int, offset: int) -> None:
-        """
-        Given some binary data, a length and an offset, add the data to the offset in the
-        output body. This function will ensure that any new bytes that aren't copied are
-        zero'd out. This includes bytes before the offset as well as any pad bytes after
-        the offset + length in order to pad this body to a 4 byte boundary.
-
-        Parameters:
-            data - A blob of binary data which should be copied into the output
-            length - Number of characters of data to copy
-            offset - Offset into the body to start copying
-        """
-        while self.__body_len < (length + offset):
-            self.__body.append(0)
-            self.__body_len = self.__body_len + 1
-
-        # Make sure its padded to 4 bytes
-        while (self.__body_len & 0x3) != 0:
-            self.__body.append(0)
-            self.__body_len = self.__body_len + 1
-
-        for i in range(length):
-            self.__body[offset + i] = data[i]
-
-    def get_data(self) -> bytes:
+    def __flatten(self) -> Tuple[Tuple[Any, ...], List[Tuple[Any, ...]], List[Any]]:
         """
-        Encode the header and body into binary formrt.
+        Walk the tree in body ordering, gathering the arguments to pack for every value
+        along with everything needed to lay out the body.
 
         Returns:
-            Binary blob of data that can be decoded by a game.
+            A tuple of a key describing the shape of the tree, a list of tuples holding the
+            alignment, struct format, mark size and mark rounding for every value, and a
+            list of tuples holding the arguments to pack for every value.
         """
-        if self.executed:
-            raise Exception("Logic error, should only call this once per instance")
-        self.executed = True
-
-        # Generate the header first
-        self.__write_node(self.tree)
-        self.stream.write_int(Node.END_OF_DOCUMENT)
-        self.stream.write_pad(4)
-
-        header_length = len(self.stream.data)
-        header = self.stream.data[:]
-
-        # Generate the body
-        values = PackedOrdering.node_to_body_ordering(self.tree)
-        if len(values) > 0:
-            ordering = PackedOrdering(0, allow_expansion=True)
-
-            for value in values:
-                node = value["node"]
-
-                if value["type"] == "attribute":
-                    size = None
-                    enc = "s"
-                    dtype = "str"
-                    array = False
-                    composite = False
-                    val = node.attribute(value["name"])
-                else:
-                    size = node.data_length
-                    enc = node.data_encoding
-                    dtype = node.data_type
-                    array = node.is_array
-                    composite = node.is_composite
-                    val = node.value
+        shape: List[Any] = []
+        fields: List[Tuple[Any, ...]] = []
+        values: List[Any] = []
+
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            attributes = sorted(node.attributes)
+            shape.append((node.name, node.type, tuple(attributes), len(node.children)))
+
+            if node.data_length != 0:
+                size = node.data_length
+                enc = node.data_encoding
+                dtype = node.data_type
+                val = node.value
 
                 if val is None:
                     raise BinaryEncodingException(
-                        f"Node '{value['name']}' has invalid value None",
+                        f"Node '{node.name}' has invalid value None",
                     )
 
-                if not array:
-                    # Scalar value
-                    alignment = value["alignment"]
-
-                    if alignment == 1:
-                        loc = ordering.get_next_byte()
-                    elif alignment == 2:
-                        loc = ordering.get_next_short()
-                    elif alignment == 4:
-                        loc = ordering.get_next_int()
-                    if loc is None:
-                        raise BinaryEncodingException(
-                            "Ran out of data when attempting to allocate node location!"
-                        )
-
-                    if dtype == "str":
-                        # Need to convert this to encoding from standard string.
-                        # Also, need to lob off the trailing null.
-                        if not isinstance(val, str):
-                            raise BinaryEncodingException(
-                                f"Node '{value['name']}' has non-string value!",
-                            )
-
-                        try:
-                            valbytes = val.encode(self.encoding) + b"\0"
-                        except UnicodeEncodeError:
-                            raise BinaryEncodingException(
-                                f"Node '{value['name']}' has un-encodable string value '{val}'"
-                            )
-                        size = len(valbytes)
-                        self.__add_data(
-                            struct.pack(">I", size) + valbytes, size + 4, loc
+                if node.is_array:
+                    if size is None:
+                        raise Exception(
+                            "Logic error, node size not set yet this is not an attribute!"
                         )
-                        ordering.mark_used(size + 4, loc, round_to=4)
-
-                        # We took care of this one
-                        continue
-                    elif dtype == "bin":
-                        # Store raw binary
-                        size = len(val)
-                        self.__add_data(struct.pack(">I", size) + val, size + 4, loc)
-                        ordering.mark_used(size + 4, loc, round_to=4)
-
-                        # We took care of this one
-                        continue
-                    elif composite:
-                        # Array, but not, somewhat silly
-                        if size is None:
-                            raise Exception(
-                                "Logic error, node size not set yet this is not an attribute!"
-                            )
-
-                        encode_value = f">{enc}"
-                        self.__add_data(struct.pack(encode_value, *val), size, loc)
-                        ordering.mark_used(size, loc)
-
-                        # We took care of this one
-                        continue
-                    elif dtype == "bool":
-                        val = 1 if val else 0
 
-                    # The size is built-in, emit it
+                    # The raw size in bytes, followed by each element
+                    length = len(val) * size
+                    if dtype == "bool":
+                        val = [1 if v else 0 for v in val]
+                    fmt = "I" + (f"{len(val)}{enc}" if len(enc) == 1 else enc * len(val))
+                    fields.append((4, fmt, length + 4, 4))
+                    values.append((length, *val))
+                    shape.append(fmt)
+                elif dtype == "str":
+                    valbytes = self.__encode_string(node.name, val)
+                    fmt = f"I{len(valbytes)}s"
+                    fields.append((4, fmt, len(valbytes) + 4, 4))
+                    values.append((len(valbytes), valbytes))
+                    shape.append(fmt)
+                elif dtype == "bin":
+                    # Store raw binary
+                    fmt = f"I{len(val)}s"
+                    fields.append((4, fmt, len(val) + 4, 4))
+                    values.append((len(val), val))
+                    shape.append(fmt)
+                elif node.is_composite:
+                    # Array, but not, somewhat silly
                     if size is None:
                         raise Exception(
                             "Logic error, node size not set yet this is not an attribute!"
                         )
-
-                    encode_value = f">{enc}"
-                    self.__add_data(struct.pack(encode_value, val), size, loc)
-                    ordering.mark_used(size, loc)
+                    fields.append((min(size, 4), enc, size, 1))
+                    values.append(tuple(val))
                 else:
-                    # Array value
-                    loc = ordering.get_next_int()
-                    if loc is None:
-                        raise BinaryEncodingException(
-                            "Ran out of data when attempting allocate array location!"
-                        )
                     if size is None:
                         raise Exception(
                             "Logic error, node size not set yet this is not an attribute!"
                         )
+                    if dtype == "bool":
+                        val = 1 if val else 0
+                    fields.append((min(size, 4), enc, size, 1))
+                    values.append((val,))
 
-                    # The raw size in bytes
-                    elems = len(val)
-                    length = elems * size
-
-                    # Write out the header (number of bytes taken up)
-                    data = struct.pack(">I", length)
-                    encode_value = f">{enc}"
-
-                    # Write out data one element at a time
-                    for v in val:
-                        if dtype == "bool":
-                            data = data + struct.pack(encode_value, 1 if v else 0)
-                        else:
-                            data = data + struct.pack(encode_value, v)
-
-                    self.__add_data(data, length + 4, loc)
-                    ordering.mark_used(length + 4, loc, round_to=4)
-
-        return b"".join(
-            [
-                struct.pack(">I", header_length),
-                header,
-                struct.pack(">I", self.__body_len),
-                bytes(self.__body),
-            ]
-        )
+            for attr in attributes:
+                valbytes = self.__encode_string(attr, node.attribute(attr))
+                fmt = f"I{len(valbytes)}s"
+                fields.append((4, fmt, len(valbytes) + 4, 4))
+                values.append((len(valbytes), valbytes))
+                shape.append(fmt)
+
+            stack.extend(reversed(node.children))
+
+        return tuple(shape), fields, values
+
+    def __encode_string(self, name: str, val: Any) -> bytes:
+        """
+        Encode a string value or attribute for the body.
+
+        Parameters:
+            name - The name of the node or attribute, for error reporting.
+            val - The string value to encode.
+
+        Returns:
+            The encoded string, including the trailing null.
+        """
+        if val is None:
+            raise BinaryEncodingException(
+                f"Node '{name}' has invalid value None",
+            )
+        if not isinstance(val, str):
+            raise BinaryEncodingException(
+                f"Node '{name}' has non-string value!",
+            )
+
+        try:
+            return val.encode(self.encoding) + b"\0"
+        except UnicodeEncodeError:
+            raise BinaryEncodingException(
+                f"Node '{name}' has un-encodable string value '{val}'"
+            )
+
+    def __layout(self, fields: List[Tuple[Any, ...]]) -> BinaryLayout:
+        """
+        Run the hole-fill algorithm over every value to lay out the body.
+
+        Parameters:
+            fields - The alignment, struct format, mark size and mark rounding for every
+                     value, as returned by __flatten.
+
+        Returns:
+            A BinaryLayout describing the body.
+        """
+        ordering = PackedOrdering(0, allow_expansion=True)
+        offsets: List[int] = []
+
+        for alignment, _, size, round_to in fields:
+            if alignment == 1:
+                loc = ordering.get_next_byte()
+            elif alignment == 2:
+                loc = ordering.get_next_short()
+            elif alignment == 4:
+                loc = ordering.get_next_int()
+            if loc is None:
+                raise BinaryEncodingException(
+                    "Ran out of data when attempting to allocate node location!"
+                )
+
+            ordering.mark_used(size, loc, round_to=round_to)
+            offsets.append(loc)
+
+        return BinaryLayout(offsets, [field[1] for field in fields], [None] * len(fields))
+
+    def get_data(self) -> bytes:
+        """
+        Encode the header and body into binary formrt.
+
+        Returns:
+            Binary blob of data that can be decoded by a game.
+        """
+        if self.executed:
+            raise Exception("Logic error, should only call this once per instance")
+        self.executed = True
+
+        shape, fields, values = self.__flatten()
+        key = (self.encoding, self.compressed, shape)
+        compiled = BinaryEncoder.LAYOUTS.get(key)
+        if compiled is None:
+            # Generate the header first, filling in its length once it is known
+            self.stream.write_zeros(4)
+            self.__write_node(self.tree)
+            self.stream.write_int(Node.END_OF_DOCUMENT)
+            self.stream.write_pad(4)
+            self.stream.patch_at(0, self.stream.length - 4, size=4)
+
+            layout = self.__layout(fields)
+            self.stream.write_int(layout.length, size=4)
+            compiled = (self.stream.data, layout)
+
+            with BinaryEncoder.LAYOUTS_LOCK:
+                if len(BinaryEncoder.LAYOUTS) >= BinaryEncoder.LAYOUT_CACHE_SIZE:
+                    del BinaryEncoder.LAYOUTS[next(iter(BinaryEncoder.LAYOUTS))]
+                BinaryEncoder.LAYOUTS[key] = compiled
+
+        header, layout = compiled
+        self.layout = layout
+        self.body_offset = len(header)
+
+        # Everything is packed into a buffer of exactly the right size
+        out = OutputStream(len(header) + layout.length)
+        out.write_blob(header)
+        layout.write(out, values)
+        return out.data
 
 
 class BinaryEncoding:
@@ -859,6 +1207,28 @@ class BinaryEncoding:
             Node object representing the root of the decoded tree, or None
             if we couldn't decode the object for some reason.
         """
+        ret = self.decode_packet(data, skip_on_exceptions=skip_on_exceptions)
+        if ret is None:
+            return None
+
+        tree, self.encoding, self.compressed = ret
+        return tree
+
+    def decode_packet(
+        self, data: bytes, skip_on_exceptions: bool = False
+    ) -> Optional[Tuple[Node, str, bool]]:
+        """
+        Given a data blob, decode the data without touching this object's state, so
+        that one instance can be shared between any number of threads.
+
+        Parameters:
+            data - Binary blob representing the data to decode
+
+        Returns:
+            A tuple of the Node object representing the root of the decoded tree, the
+            text encoding and whether node names were compressed, or None if we couldn't
+            decode the object for some reason.
+        """
         try:
             data_magic, contents, encoding_raw, encoding_swapped = struct.unpack(
                 ">BBBB", data[0:4]
@@ -872,11 +1242,11 @@ class BinaryEncoding:
         if ((~encoding_raw) & 0xFF) != encoding_swapped:
             return None
 
-        self.compressed = contents in [
+        compressed = contents in [
             BinaryEncoding.COMPRESSED_WITH_DATA,
             BinaryEncoding.COMPRESSED_WITHOUT_DATA,
         ]
-        if not self.compressed and contents not in [
+        if not compressed and contents not in [
             BinaryEncoding.DECOMPRESSED_WITH_DATA,
             BinaryEncoding.DECOMPRESSED_WITHOUT_DATA,
         ]:
@@ -885,12 +1255,11 @@ class BinaryEncoding:
         encoding = BinaryEncoding.ENCODINGS.get(encoding_raw)
 
         if encoding is not None:
-            self.encoding = encoding
             try:
                 decoder = BinaryDecoder(
-                    data[4:], self.__sanitize_encoding(encoding), self.compressed
+                    memoryview(data)[4:], self.__sanitize_encoding(encoding), compressed
                 )
-                return decoder.get_tree()
+                return decoder.get_tree(), encoding, compressed
             except BinaryEncodingException:
                 if skip_on_exceptions:
                     return None
@@ -918,6 +1287,24 @@ class BinaryEncoding:
         if encoding is None:
             raise BinaryEncodingException("Unknown encoding")
 
+        prefix, encoder = self.encoder(tree, encoding, compressed)
+        return prefix + encoder.get_data()
+
+    def encoder(
+        self, tree: Node, encoding: str, compressed: bool = True
+    ) -> Tuple[bytes, BinaryEncoder]:
+        """
+        Create an encoder for a tree, without encoding anything yet.
+
+        Parameters:
+            tree - Node tree representing the data to encode
+            encoding - The text encoding to use.
+            compressed - Whether node names should be compressed.
+
+        Returns:
+            A tuple of the packet magic that goes before the encoded data, and a
+            BinaryEncoder for the tree.
+        """
         encoding_magic = None
         for magic, encstr in BinaryEncoding.ENCODINGS.items():
             if encstr == encoding:
@@ -928,7 +1315,6 @@ class BinaryEncoding:
             raise BinaryEncodingException(f"Invalid text encoding {encoding}")
 
         encoder = BinaryEncoder(tree, self.__sanitize_encoding(encoding), compressed)
-        data = encoder.get_data()
         return (
             struct.pack(
                 ">BBBB",
@@ -938,6 +1324,6 @@ class BinaryEncoding:
                 else BinaryEncoding.DECOMPRESSED_WITH_DATA,
                 encoding_magic,
                 (~encoding_magic & 0xFF),
-            )
-            + data
+            ),
+            encoder,
         )
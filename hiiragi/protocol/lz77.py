@@ -1,5 +1,5 @@
-from collections import defaultdict
-from typing import Generator, List, MutableMapping, Optional, Set, Tuple
+from array import array
+from typing import Optional, Tuple
 
 from typing_extensions import Final
 
@@ -15,7 +15,9 @@ class Lz77Decompress:
     A class that can decompress an Lz77 stream of data. Notably, this is a different
     variant to the Lz77 found in firebeat executables and BIOS. This is used for
     over-the-wire compression of XML data, as well as compression inside a decent
-    amount of file formats found in various Konami games.
+    amount of file formats found in various Konami games. Rather than keeping a
+    separate backref ring, this writes straight into the output and resolves
+    backrefs as slices of what has already been emitted.
     """
 
     RING_LENGTH: Final[int] = 0x1000
@@ -30,174 +32,84 @@ class Lz77Decompress:
         Parameters:
             data - Binary blob representing the data to be decompressed.
         """
-        self.eof: bool = False
         self.data: bytes = data
-        self.read_pos: int = 0
-        self.left: int = len(self.data)
-        self.flags: int = 1
-        self.write_pos: int = 0
-        self.pending_copy_amount: int = 0
-        self.pending_copy_pos: int = 0
-        self.pending_copy_max: int = 0
         self.ringlength: int = backref or self.RING_LENGTH
-        self.ring: bytes = b"\x00" * self.ringlength
 
-    def _ring_read(self, copy_pos: int, copy_len: int) -> Generator[bytes, None, None]:
+    def decompress(self) -> bytes:
         """
-        Read the next bytes from the backref ring at the current copy position.
+        Go through the stream, reading the next flag byte and then processing
+        up to 8 chunks of data. Each chunk is either a run of bytes copied directly
+        from the stream or a backref into the previous output. A backref with
+        a zero position marks the end of the stream.
 
         Returns:
-            a generator which yields bytes.
+            Raw binary data.
         """
-        while copy_len > 0:
-            if copy_pos + copy_len > self.ringlength:
-                # Copy first chunk, let subsequent loop handle the next chunks
-                amount = self.ringlength - copy_pos
-            else:
-                # Copy the whole thing out, we have enough space to do so
-                amount = copy_len
-
-            ret = self.ring[copy_pos : (copy_pos + amount)]
-            self._ring_write(ret)
-            yield ret
+        data = self.data
+        ringlength = self.ringlength
+        read_pos = 0
+        left = len(data)
+        flags = 1
 
-            copy_pos = (copy_pos + amount) % self.ringlength
-            copy_len -= amount
+        # The ring starts out zero'd, so pad the front of the output with the ring's
+        # worth of zeros in order for backrefs that point before the start to work.
+        out = bytearray(ringlength)
 
-    def _ring_write(self, bytedata: bytes) -> None:
-        """
-        Write bytes into the backref ring.
-
-        Parameters:
-            byte - A byte to be written at the current write offset
-        """
         while True:
-            amount = len(bytedata)
-            if amount == 0:
-                return
-            if amount > (self.ringlength - self.write_pos):
-                amount = self.ringlength - self.write_pos
-
-            self.ring = (
-                self.ring[: self.write_pos]
-                + bytedata[:amount]
-                + self.ring[(self.write_pos + amount) :]
-            )
-            bytedata = bytedata[amount:]
-            self.write_pos = (self.write_pos + amount) % self.ringlength
-
-    def decompress_bytes(self) -> Generator[bytes, None, None]:
-        """
-        Yield the next byte from the decompressed output. If we are
-        in a backref copy, read the next byte from the backref. If
-        we aren't, read the next flag to see if we should decode
-        a byte directly or if we should start another backref read.
-        If we don't have any flags, exit reporting EOF (None). If
-        we hit the end of the stream, stop yielding to signify EOF.
-        In all cases, whatever byte we read should be added back to
-        the backref buffer.
-
-        Returns:
-            a generator that yields bytes.
-        """
-        while not self.eof:
-            if self.pending_copy_amount > 0:
-                # We had a backref that would have copied more data than we had available
-                # in the ringbuffer (because every read, even a backref, adds to the
-                # ringbuffer). So, since we read that last time and wrote it to the backbuffer
-                # we are safe to read again.
-                amount = min(self.pending_copy_amount, self.pending_copy_max)
-                yield from self._ring_read(self.pending_copy_pos, amount)
-
-                # We read this many bytes and are about to write them to the ringbuffer,
-                # so bookkeep that.
-                self.pending_copy_amount -= amount
-                self.pending_copy_max = amount
+            if flags == 1:
+                # Load the next byte for processing
+                if left == 0:
+                    # We have nothing left to read, so exit early.
+                    break
+                flags = 0x100 | data[read_pos]
+                read_pos += 1
+                left -= 1
+
+            # Shift the lowest bit out to be retrieved as a flag
+            flag = flags & 1
+            flags >>= 1
+
+            if flag == self.FLAG_COPY:
+                # Figure out how much to pull at once
+                amount = 1
+                while flags != 1 and (flags & 1) == self.FLAG_COPY:
+                    # We would do a copy next time, so pop that flag and just add to our read amount
+                    flags >>= 1
+                    amount += 1
+
+                # Grab chunk right out of the data source
+                out += data[read_pos : (read_pos + amount)]
+                read_pos += amount
+                left -= amount
             else:
-                if self.flags == 1:
-                    # Load the next byte for processing
-                    if self.left == 0:
-                        # We have nothing left to read, so skip the
-                        # ringbuffer write below and exit early.
-                        return
-                    else:
-                        self.flags = 0x100 | self.data[self.read_pos]
-                        self.read_pos += 1
-                        self.left -= 1
-
-                # Shift the lowest bit out to be retrieved as a flag
-                flag = self.flags & 1
-                self.flags >>= 1
-
-                if flag == self.FLAG_COPY:
-                    # Figure out how much to pull at once
-                    amount = 1
-                    while self.flags != 1 and (self.flags & 1) == self.FLAG_COPY:
-                        # We would do a copy next time, so pop that flag and just add to our read amount
-                        self.flags >>= 1
-                        amount += 1
-
-                    # Grab chunk right out of the data source
-                    b = self.data[self.read_pos : (self.read_pos + amount)]
-                    self._ring_write(b)
-                    yield b
-
-                    self.read_pos += amount
-                    self.left -= amount
-                elif flag == self.FLAG_BACKREF:
-                    yield from self._read_backref()
+                if left == 0:
+                    break
+                if left == 1:
+                    raise LzException("Unexpected EOF mid-backref")
+
+                hi = data[read_pos]
+                lo = data[read_pos + 1]
+                read_pos += 2
+                left -= 2
+
+                copy_len = lo & 0xF
+                copy_pos = (hi << 4) | (lo >> 4)
+                if copy_pos == 0:
+                    # End of stream marker
+                    break
+
+                copy_len += 3
+                distance = ((copy_pos - 1) % ringlength) + 1
+                start = len(out) - distance
+                if copy_len <= distance:
+                    out += out[start : (start + copy_len)]
                 else:
-                    raise Exception("Logic error!")
-
-    def _read_backref(self) -> Generator[bytes, None, None]:
-        """
-        Read a backref chunk. Grab the copy length and copy position
-        from the first two bytes and then read the first byte from
-        the backref. Sets up variables such that Lz77Decompress.__read()
-        can finish copying out of the backref on subsequent calls. Should
-        only be called by Lz77Decompress.__read(). If we discover the end
-        of stream, we don't generate any bytes and instead set the eof
-        flag which terminates the main decompression loop above.
+                    # The backref overlaps the bytes it is writing, so the last
+                    # distance bytes repeat until we've copied enough.
+                    pattern = out[start:]
+                    out += (pattern * ((copy_len // distance) + 1))[:copy_len]
 
-        Returns:
-            a generator that yields bytes.
-        """
-        if self.left == 0:
-            self.eof = True
-            return
-        if self.left == 1:
-            raise LzException("Unexpected EOF mid-backref")
-
-        hi = self.data[self.read_pos]
-        lo = self.data[self.read_pos + 1]
-        self.read_pos += 2
-        self.left -= 2
-
-        copy_len = lo & 0xF
-        copy_pos = (hi << 4) | (lo >> 4)
-
-        if copy_pos > 0:
-            copy_len += 3
-            if copy_len > copy_pos:
-                # Remember what we have to do left, and the safe
-                # amount to copy next time (which is our length,
-                # since we are about to write that many butes to
-                # the ringbuffer right after reading them).
-                self.pending_copy_amount = copy_len - copy_pos
-                self.pending_copy_pos = self.write_pos
-                self.pending_copy_max = copy_pos
-
-                # Only copy the available bytes
-                copy_len = copy_pos
-
-            copy_pos = self.write_pos - copy_pos
-            while copy_pos < 0:
-                copy_pos += self.ringlength
-            copy_pos = copy_pos % self.ringlength
-            yield from self._ring_read(copy_pos, copy_len)
-        else:
-            self.eof = True
-            return
+        return bytes(memoryview(out)[ringlength:])
 
 
 class Lz77Compress:
@@ -205,218 +117,250 @@ class Lz77Compress:
     A class that can compress arbitrary binary data using the Lz77 protocol.
     Note that this does support overlapped backtracks, so for instance the
     string "abcabcabc" will be compressed properly (see unit tests for examples).
-    Great care has been taken in optimizing this and then we further optimize
-    by using Cython to build, netting us another 40% speed-up. This is important
-    because for any given packet we are decompressing and compressing at least
-    once, and if we use a proxy to direct traffic, possibly a second time.
+    Candidate backrefs are found using hash chains, similar to zlib. Every
+    position is hashed by its first three bytes, head holds the most recent
+    position for each hash and prev links each position to the previous one
+    with the same hash. The chains only need to cover the backref ring, so prev
+    is a fixed size array indexed by position modulo the ring length. This is
+    important because for any given packet we are decompressing and compressing
+    at least once, and if we use a proxy to direct traffic, possibly a second time.
+
+    How hard we try is controlled by the compression level:
+        store - Only output copy flags. This is valid Lz77 that costs next to no CPU.
+        fast - Take the first backref found, looking at only a few candidates.
+        normal - Take the longest backref in the ring.
+        max - Take the longest backref in the ring, but output a copy instead if the
+              next byte starts an even longer backref (lazy matching).
     """
 
     RING_LENGTH: Final[int] = 0x1000
 
-    LOOSE_COMPRESS_THRESHOLD: Final[int] = 1024 * 512
+    HASH_BITS: Final[int] = 15
+    MAX_CHAIN_DEPTH: Final[int] = 0x1000
+    FAST_CHAIN_DEPTH: Final[int] = 8
+
+    MIN_BACKREF: Final[int] = 3
+    MAX_BACKREF: Final[int] = 18
 
     FLAG_COPY: Final[int] = 1
     FLAG_BACKREF: Final[int] = 0
 
-    def __init__(self, data: bytes, backref: Optional[int] = None) -> None:
+    LEVEL_STORE: Final[str] = "store"
+    LEVEL_FAST: Final[str] = "fast"
+    LEVEL_NORMAL: Final[str] = "normal"
+    LEVEL_MAX: Final[str] = "max"
+
+    def __init__(
+        self,
+        data: bytes,
+        backref: Optional[int] = None,
+        max_chain: Optional[int] = None,
+        level: str = LEVEL_NORMAL,
+    ) -> None:
         """
         Initialize the object.
 
         Parameters:
-            data - Binary blob representing the data to be decompressed.
+            data - Binary blob representing the data to be compressed.
+            backref - Optional ring length, defaults to RING_LENGTH.
+            max_chain - Optional maximum number of candidates to look at when searching
+                        for a backref. Defaults to a depth appropriate for the level.
+            level - The compression level, one of the LEVEL_* constants. Defaults
+                    to LEVEL_NORMAL.
         """
+        if level not in {
+            self.LEVEL_STORE,
+            self.LEVEL_FAST,
+            self.LEVEL_NORMAL,
+            self.LEVEL_MAX,
+        }:
+            raise LzException(f"Unknown compression level {level}")
+
         self.data: bytes = data
-        self.read_pos: int = 0
-        self.left: int = len(self.data)
-        self.eof: bool = False
-        self.bytes_written: int = 0
         self.ringlength: int = backref or self.RING_LENGTH
-        self.locations: MutableMapping[int, Set[int]] = defaultdict(set)
-        self.starts: MutableMapping[bytes, Set[int]] = defaultdict(set)
-        self.last_start: Tuple[int, int, int] = (0, 0, 0)
-
-        if len(data) > self.LOOSE_COMPRESS_THRESHOLD:
-            self._ring_write = self._ring_write_starts_only
-        else:
-            self._ring_write = self._ring_write_both
-
-    def _ring_write_starts_only(self, bytedata: bytes) -> None:
+        self.level: str = level
+        self.first_match: bool = level == self.LEVEL_FAST
+        self.lazy: bool = level == self.LEVEL_MAX
+        self.max_chain: int = max_chain or (
+            self.FAST_CHAIN_DEPTH if self.first_match else self.MAX_CHAIN_DEPTH
+        )
+        self.head: array = array("l", [-1]) * (1 << self.HASH_BITS)
+        self.prev: array = array("l", [-1]) * self.ringlength
+        self.inserted: int = 0
+
+    def _find_backref(self, read_pos: int, left: int) -> Tuple[int, int]:
         """
-        Write bytes into the backref ring.
+        Find the best backref for the data at read_pos, respecting the level.
 
         Parameters:
-            byte - A byte to be written at the current write offset
+            read_pos - The position in the data we want to backref from.
+            left - The number of bytes left in the data starting at read_pos.
+
+        Returns:
+            A tuple of the copy amount and the absolute position to copy from.
+            The copy amount is zero if we couldn't find a backref.
         """
-        for byte in bytedata:
-            # Update the start locations hashmap if we're past the beginning
-            self.last_start = (self.last_start[1], self.last_start[2], byte)
-            if self.bytes_written >= 2:
-                self.starts[bytes(self.last_start)].add(self.bytes_written - 2)
+        data = self.data
+        head = self.head
+        prev = self.prev
+        ringlength = self.ringlength
+        mask = (1 << self.HASH_BITS) - 1
+        min_backref = self.MIN_BACKREF
+
+        # Add every position that can be backref'd to into the hash chains.
+        # We only consider backrefs that start at least three bytes back.
+        inserted = self.inserted
+        while inserted <= read_pos - min_backref:
+            hashed = (
+                (data[inserted] << 10) ^ (data[inserted + 1] << 5) ^ data[inserted + 2]
+            ) & mask
+            prev[inserted % ringlength] = head[hashed]
+            head[hashed] = inserted
+            inserted += 1
+        self.inserted = inserted
+
+        # Walk the chain for our first three bytes, most recent first.
+        first = data[read_pos]
+        second = data[read_pos + 1]
+        third = data[read_pos + 2]
+        candidate = head[((first << 10) ^ (second << 5) ^ third) & mask]
+        earliest = max(0, read_pos - (ringlength - 1))
+        backref_amount = min(left, self.MAX_BACKREF)
+        first_match = self.first_match
+        depth = self.max_chain
+        copy_amount = 0
+        copy_pos = 0
+
+        while candidate >= earliest and depth > 0:
+            depth -= 1
+            if (
+                data[candidate + copy_amount] == data[read_pos + copy_amount]
+                and data[candidate] == first
+                and data[candidate + 1] == second
+                and data[candidate + 2] == third
+            ):
+                amount = min_backref
+                while (
+                    amount < backref_amount
+                    and data[candidate + amount] == data[read_pos + amount]
+                ):
+                    amount += 1
+                if amount > copy_amount:
+                    copy_amount = amount
+                    copy_pos = candidate
+                    if first_match or amount == backref_amount:
+                        # Good enough, or can't do any better than this
+                        break
+            candidate = prev[candidate % ringlength]
 
-            # Keep track of the fact that we wrote this byte.
-            self.bytes_written += 1
+        return copy_amount, copy_pos
 
-    def _ring_write_both(self, bytedata: bytes) -> None:
+    def store(self) -> bytes:
         """
-        Write bytes into the backref ring.
+        Output the stream as nothing but copy flags.
 
-        Parameters:
-            byte - A byte to be written at the current write offset
+        Returns:
+            Lz77-compressed binary data.
+        """
+        data = self.data
+        length = len(data)
+        whole = length & ~0x7
+        out = bytearray()
+
+        for pos in range(0, whole, 8):
+            out.append(0xFF)
+            out += data[pos : (pos + 8)]
+
+        # Remaining copies in a partial flag byte, followed by the end of stream marker.
+        remaining = length - whole
+        out.append((1 << remaining) - 1)
+        out += data[whole:]
+        out += b"\x00\x00"
+        return bytes(out)
+
+    def compress(self) -> bytes:
         """
-        for byte in bytedata:
-            # Update the start locations hashmap if we're past the beginning
-            self.last_start = (self.last_start[1], self.last_start[2], byte)
-            if self.bytes_written >= 2:
-                self.starts[bytes(self.last_start)].add(self.bytes_written - 2)
+        Go through the stream, assembling flag bytes each followed by the next
+        8 chunks of compressed data.
 
-            # Update the rest of the location hashmaps
-            self.locations[byte].add(self.bytes_written)
+        Returns:
+            Lz77-compressed binary data.
+        """
+        if self.level == self.LEVEL_STORE:
+            return self.store()
 
-            # Keep track of the fact that we wrote this byte.
-            self.bytes_written += 1
+        data = self.data
+        min_backref = self.MIN_BACKREF
+        max_backref = self.MAX_BACKREF
+        lazy = self.lazy
+        first_match = self.first_match
 
-    def compress_bytes(self) -> Generator[bytes, None, None]:
-        """
-        Given the current stream, go through and assemble the next flag byte
-        followed by the next chunk of compressed data.
-        """
-        while not self.eof:
-            if self.left == 0:
-                # Output a dummy flag and an end of stream marker.
-                self.eof = True
-                yield b"\x00\x00\x00"
-            else:
-                # Need to assemble and return the next chunk, which is a flag
-                # byte and then 8 instructions.
-                flags = 0x0
-                flagpos = -1
-                data: List[bytes] = [b""] * 8
-
-                for _ in range(8):
-                    # Track what flag we're generating data for
-                    flagpos += 1
-
-                    if self.left == 0:
-                        # Output the end of stream marker, set EOF since we've succeeded
-                        # in outputting all flags.
-                        flags |= self.FLAG_BACKREF << flagpos
-                        data[flagpos] = b"\x00\x00"
-                        self.eof = True
-                        break
-                    elif self.left < 3 or self.bytes_written < 3:
-                        # We either don't have enough data written to backref, or we
-                        # don't have enough data in the stream that could be made into
-                        # a backref.
-                        flags |= self.FLAG_COPY << flagpos
-
-                        chunk = self.data[self.read_pos : (self.read_pos + 1)]
-                        data[flagpos] = chunk
-                        self._ring_write(chunk)
-
-                        self.read_pos += 1
-                        self.left -= 1
-                        continue
-
-                    # Figure out the maximum backref we can attempt to find
-                    backref_amount = min(self.left, 18)
-
-                    # Iterate over all spots where the first byte equals, and is in range.
-                    earliest = max(0, self.bytes_written - (self.ringlength - 1))
-                    index = self.data[self.read_pos : (self.read_pos + 3)]
-                    updated_backref_locations: Set[int] = set(
-                        absolute_pos
-                        for absolute_pos in self.starts[index]
-                        if absolute_pos >= earliest
-                    )
-                    self.starts[index] = updated_backref_locations
-                    possible_backref_locations: List[int] = list(
-                        updated_backref_locations
+        out = bytearray()
+        left = len(data)
+        read_pos = 0
+
+        # A backref that was already found for the next position while lazy matching.
+        pending: Optional[Tuple[int, int, int]] = None
+
+        while True:
+            # Need to assemble the next chunk, which is a flag byte and then
+            # 8 instructions.
+            flags = 0x0
+            flag_loc = len(out)
+            out.append(0)
+
+            for flagpos in range(8):
+                if left == 0:
+                    # Output the end of stream marker, which is a backref flag
+                    # with a zero position.
+                    out += b"\x00\x00"
+                    out[flag_loc] = flags
+                    return bytes(out)
+
+                copy_amount = 0
+                if left >= min_backref and read_pos >= min_backref:
+                    if pending is not None and pending[0] == read_pos:
+                        _, copy_amount, copy_pos = pending
+                    else:
+                        copy_amount, copy_pos = self._find_backref(read_pos, left)
+                    pending = None
+
+                    if (
+                        lazy
+                        and copy_amount
+                        and copy_amount < max_backref
+                        and left > min_backref
+                    ):
+                        # See if holding off a byte gets us a longer backref.
+                        next_amount, next_pos = self._find_backref(
+                            read_pos + 1, left - 1
+                        )
+                        if next_amount > copy_amount:
+                            pending = (read_pos + 1, next_amount, next_pos)
+                            copy_amount = 0
+
+                if copy_amount:
+                    backref_pos = read_pos - copy_pos
+                    out.append((backref_pos >> 4) & 0xFF)
+                    out.append(
+                        ((copy_amount - min_backref) & 0xF) | ((backref_pos & 0xF) << 4)
                     )
+                    read_pos += copy_amount
+                    left -= copy_amount
+                    if first_match:
+                        # Don't bother hashing the positions we just skipped over.
+                        self.inserted = max(self.inserted, read_pos - min_backref)
+                    continue
 
-                    # Output the data as a copy if we couldn't find a backref
-                    if not possible_backref_locations:
-                        flags |= self.FLAG_COPY << flagpos
-
-                        chunk = self.data[self.read_pos : (self.read_pos + 1)]
-                        data[flagpos] = chunk
-                        self._ring_write(chunk)
-
-                        self.read_pos += 1
-                        self.left -= 1
-                        continue
-
-                    # Now, find the longest actual backref of our possibilities. We know
-                    # we're going to write at least these three bytes, so append it to the
-                    # output buffer.
-                    start_write_size = self.bytes_written
-                    self._ring_write(index)
-                    copy_amount = 3
-                    while copy_amount < backref_amount:
-                        # First, let's see if we have any 3-wide chunks to consume.
-                        index = self.data[
-                            (self.read_pos + copy_amount) : (
-                                self.read_pos + copy_amount + 3
-                            )
-                        ]
-                        locations = self.starts[index]
-                        new_backref_locations: List[int] = [
-                            absolute_pos
-                            for absolute_pos in possible_backref_locations
-                            if absolute_pos + copy_amount in locations
-                        ]
-
-                        if new_backref_locations:
-                            # Mark that we're copying an extra byte from the backref.
-                            self._ring_write(index)
-                            copy_amount += 3
-                            possible_backref_locations = new_backref_locations
-                        else:
-                            # Check our existing locations to figure out if we still have
-                            # longest prefixes of 1 or 2 left.
-                            while copy_amount < backref_amount:
-                                locations = self.locations[
-                                    self.data[self.read_pos + copy_amount]
-                                ]
-                                new_backref_locations = [
-                                    absolute_pos
-                                    for absolute_pos in possible_backref_locations
-                                    if absolute_pos + copy_amount in locations
-                                ]
-
-                                # If we have no longest prefixes, that means that any of the
-                                # previous prefixes are good enough.
-                                if not new_backref_locations:
-                                    break
-
-                                # Mark that we're copying an extra byte from the backref.
-                                self._ring_write(
-                                    self.data[
-                                        (self.read_pos + copy_amount) : (
-                                            self.read_pos + copy_amount + 1
-                                        )
-                                    ]
-                                )
-                                copy_amount += 1
-                                possible_backref_locations = new_backref_locations
-
-                            # Either we looped above in the inner while, or we didn't. Either way,
-                            # we don't have any more to check since there were no more 3-long backref
-                            # locations.
-                            break
-
-                    # Now that we have a list of candidates, arbitrarily pick the
-                    # first one as our candidate and output it.
-                    absolute_pos = possible_backref_locations[0]
-                    backref_pos = start_write_size - absolute_pos
-
-                    lo = (copy_amount - 3) & 0xF | ((backref_pos & 0xF) << 4)
-                    hi = (backref_pos >> 4) & 0xFF
-                    flags |= self.FLAG_BACKREF << flagpos
-                    data[flagpos] = bytes([hi, lo])
-                    self.read_pos += copy_amount
-                    self.left -= copy_amount
-
-                yield bytes([flags]) + b"".join(data)
+                # We either don't have enough data written to backref, don't have enough
+                # data in the stream that could be made into a backref, or couldn't find
+                # a backref, so output the data as a copy.
+                flags |= self.FLAG_COPY << flagpos
+                out.append(data[read_pos])
+                read_pos += 1
+                left -= 1
+
+            out[flag_loc] = flags
 
 
 class Lz77:
@@ -424,6 +368,11 @@ class Lz77:
     A wrapper class encapsulating Lz77 encoding and decoding.
     """
 
+    LEVEL_STORE: Final[str] = Lz77Compress.LEVEL_STORE
+    LEVEL_FAST: Final[str] = Lz77Compress.LEVEL_FAST
+    LEVEL_NORMAL: Final[str] = Lz77Compress.LEVEL_NORMAL
+    LEVEL_MAX: Final[str] = Lz77Compress.LEVEL_MAX
+
     def __init__(self, backref: Optional[int] = None) -> None:
         """
         Initialize the object.
@@ -442,18 +391,20 @@ class Lz77:
         """
 
         lz = Lz77Decompress(data, backref=self.backref)
-        return b"".join(lz.decompress_bytes())
+        return lz.decompress()
 
-    def compress(self, data: bytes) -> bytes:
+    def compress(self, data: bytes, level: str = LEVEL_NORMAL) -> bytes:
         """
         Given a binary blob, return a new binary blob representing the compressed data.
 
         Parameters:
             data - Raw binary data.
+            level - The compression level, one of the LEVEL_* constants. Defaults to
+                    LEVEL_NORMAL.
 
         Returns:
             L7zz-compressed binary data.
         """
 
-        lz = Lz77Compress(data, backref=self.backref)
-        return b"".join(lz.compress_bytes())
+        lz = Lz77Compress(data, backref=self.backref, level=level)
+        return lz.compress()
@@ -1,6 +1,6 @@
-import copy
 import struct
-from typing import Any, Dict, List, Optional, Union
+from array import array
+from typing import Any, Dict, FrozenSet, List, Optional
 
 from typing_extensions import Final
 
@@ -21,11 +21,35 @@ class Node:
     string attributes, and either a value or zero or more children. Note that it is possible and
     supported for a node to not have a value or children. This also includes a decent amount of
     constructor helper classmethods to make constructing a tree from source code easier.
+
+    Nodes are kept compact, since decoded trees can have thousands of them. Values are
+    stored natively (ints, floats, bools, bytes for ip4 and array.array for numeric
+    arrays) and are only formatted to strings when a tree is printed.
     """
 
+    __slots__ = (
+        "__name",
+        "__array",
+        "__translated_type",
+        "__type",
+        "__kind",
+        "__length",
+        "__attrs",
+        "__value",
+        "__children",
+    )
+
     NODE_NAME_CHARS: Final[str] = (
         "0123456789:ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
     )
+    __NAME_CHAR_SET: Final[FrozenSet[str]] = frozenset(NODE_NAME_CHARS)
+
+    # How values of a given type name are stored. Anything not listed is stored as given.
+    KIND_INT: Final[str] = "int"
+    KIND_FLOAT: Final[str] = "float"
+    KIND_BOOL: Final[str] = "bool"
+    KIND_IP4: Final[str] = "ip4"
+    KIND_RAW: Final[str] = "raw"
 
     NODE_TYPE_VOID: Final[int] = 1
     NODE_TYPE_S8: Final[int] = 2
@@ -566,6 +590,8 @@ class Node:
         self.__array = False
         self.__translated_type: Optional[Dict[str, Any]] = None
         self.__type: Optional[int] = None
+        self.__kind = Node.KIND_RAW
+        self.__length: Optional[int] = None
         self.__attrs: Dict[str, str] = {}
         self.__value: Any = None
         self.__children: List[Node] = []
@@ -586,9 +612,8 @@ class Node:
                 NODE_NAME_CHARS characters.
         """
         # Ensure it isn't a violation
-        for char in name:
-            if char not in Node.NODE_NAME_CHARS:
-                raise NodeException(f"Invalid node name {name}")
+        if not Node.__NAME_CHAR_SET.issuperset(name):
+            raise NodeException(f"Invalid node name {name}")
 
         self.__name = name
 
@@ -623,11 +648,26 @@ class Node:
             self.__array = True
 
         try:
-            self.__translated_type = Node.NODE_TYPES[type & (~Node.ARRAY_BIT)]
-            self.__type = type
+            translated_type = Node.NODE_TYPES[type & (~Node.ARRAY_BIT)]
         except KeyError:
             raise NodeException(f"Unknown node type {type} on node name {self.__name}")
 
+        self.__translated_type = translated_type
+        self.__type = type
+
+        name = translated_type["name"]
+        if name in {"bool", "float", "ip4"}:
+            self.__kind = name
+        elif translated_type["int"]:
+            self.__kind = Node.KIND_INT
+        else:
+            self.__kind = Node.KIND_RAW
+
+        if name in {"bin", "str"}:
+            self.__length = None
+        else:
+            self.__length = struct.calcsize(translated_type["enc"])
+
     @property
     def type(self) -> int:
         """
@@ -668,9 +708,7 @@ class Node:
             raise Exception(
                 "Logic error, tried to fetch data length before setting type!"
             )
-        if self.__translated_type["name"] in {"bin", "str"}:
-            return None
-        return struct.calcsize(self.__translated_type["enc"])
+        return self.__length
 
     @property
     def data_encoding(self) -> str:
@@ -836,40 +874,145 @@ class Node:
                 f"Input {'is' if is_array else 'is not'} array, expected {'array' if self.__array else 'scalar'}"
             )
 
-        def val_to_str(val: Any) -> Union[str, bytes]:
-            if translated_type["name"] == "bool":
-                # Support user-built boolean types
-                if val is True:
-                    return "true"
-                if val is False:
-                    return "false"
+        if is_array:
+            self.__value = self.__to_array(val)
+        elif translated_type["composite"]:
+            self.__value = [self.__to_native(v) for v in val]
+        else:
+            self.__value = self.__to_native(val)
+
+    def __to_native(self, val: Any) -> Any:
+        """
+        Convert a single value to how it is stored for this node's type. Values that
+        can't be stored natively are kept as a string, so that any error surfaces when
+        the value is read, the same as it always has.
+
+        Parameters:
+            val - A mixed value to convert.
 
+        Returns:
+            The value to store.
+        """
+        kind = self.__kind
+        if kind == Node.KIND_INT:
+            if type(val) is int:
+                return val
+            string = str(val)
+            try:
+                if str(int(string)) == string:
+                    return int(string)
+            except ValueError:
+                pass
+            return string
+        elif kind == Node.KIND_BOOL:
+            # Support user-built boolean types, as well as construction from binary
+            if val is True or val is False:
+                return val
+            return True if val != 0 else False
+        elif kind == Node.KIND_FLOAT:
+            if type(val) is _renamed_float:
+                return val
+            return str(val)
+        elif kind == Node.KIND_IP4:
+            try:
                 # Support construction from binary
-                return "true" if val != 0 else "false"
-            elif translated_type["name"] == "float":
-                return str(val)
-            elif translated_type["name"] == "ip4":
+                return bytes(struct.unpack("BBBB", val))
+            except (struct.error, TypeError):
+                # Assume that its user-built string?
+                if isinstance(val, str):
+                    parts = val.split(".")
+                    if len(parts) == 4:
+                        try:
+                            ip = bytes(int(part) for part in parts)
+                            if ".".join(str(i) for i in ip) == val:
+                                return ip
+                        except ValueError:
+                            pass
+                        return val
+
+                raise NodeException(f"Invalid value {val} for IP4 type")
+        else:
+            # This could be either a string or bytes.
+            return val
+
+    def __to_array(self, vals: Any) -> Any:
+        """
+        Convert an array value to how it is stored for this node's type. Numeric arrays
+        are kept in an array.array where possible.
+
+        Parameters:
+            vals - A list or tuple of mixed values to convert.
+
+        Returns:
+            The array to store.
+        """
+        kind = self.__kind
+        if kind == Node.KIND_INT:
+            if all(type(v) is int for v in vals):
                 try:
-                    # Support construction from binary
-                    ip = struct.unpack("BBBB", val)
-                    return f"{ip[0]}.{ip[1]}.{ip[2]}.{ip[3]}"
-                except (struct.error, TypeError):
-                    # Assume that its user-built string?
-                    if isinstance(val, str):
-                        if len(val.split(".")) == 4:
-                            return val
-
-                    raise NodeException(f"Invalid value {val} for IP4 type")
-            elif translated_type["int"]:
-                return str(val)
-            else:
-                # This could return either a string or bytes.
+                    return array(self.data_encoding, vals)
+                except OverflowError:
+                    # Out of range, this will fail when encoded instead
+                    pass
+        elif kind == Node.KIND_FLOAT:
+            if all(type(v) is _renamed_float for v in vals):
+                return array("d", vals)
+
+        return [self.__to_native(v) for v in vals]
+
+    def __from_native(self, val: Any) -> Any:
+        """
+        Convert a single stored value back to a value of the correct data type.
+
+        Parameters:
+            val - A stored value, as returned by __to_native.
+
+        Returns:
+            A mixed value.
+        """
+        kind = self.__kind
+        if kind == Node.KIND_INT:
+            return val if type(val) is int else int(val)
+        elif kind == Node.KIND_BOOL:
+            return val is True
+        elif kind == Node.KIND_FLOAT:
+            return val if type(val) is _renamed_float else _renamed_float(val)
+        elif kind == Node.KIND_IP4:
+            if isinstance(val, bytes):
                 return val
+            if not isinstance(val, str):
+                raise Exception("Logic error, expected a string!")
+            ip = [int(tup) for tup in val.split(".")]
+            return struct.pack("BBBB", ip[0], ip[1], ip[2], ip[3])
+        else:
+            # At this point, we could be a string or bytes.
+            return val
+
+    def __format(self, val: Any) -> Any:
+        """
+        Convert a single stored value to the string used to represent it when printed.
 
-        if is_array or translated_type["composite"]:
-            self.__value = [val_to_str(v) for v in val]
+        Parameters:
+            val - A stored value, as returned by __to_native.
+
+        Returns:
+            A string, or the value as stored for types that are stored as given.
+        """
+        kind = self.__kind
+        if kind == Node.KIND_BOOL:
+            if val is None:
+                return val
+            return "true" if val else "false"
+        elif kind == Node.KIND_IP4:
+            if isinstance(val, bytes):
+                return f"{val[0]}.{val[1]}.{val[2]}.{val[3]}"
+            return val
+        elif kind == Node.KIND_INT or kind == Node.KIND_FLOAT:
+            if val is None:
+                return val
+            return str(val)
         else:
-            self.__value = val_to_str(val)
+            return val
 
     @property
     def value(self) -> Any:
@@ -881,28 +1024,14 @@ class Node:
         """
         if self.__translated_type is None:
             raise Exception("Logic error, tried to get value before setting type!")
-        translated_type: Dict[str, Any] = self.__translated_type
-
-        def str_to_val(string: Union[str, bytes]) -> Any:
-            if translated_type["name"] == "bool":
-                return string == "true"
-            elif translated_type["name"] == "float":
-                return float(string)
-            elif translated_type["name"] == "ip4":
-                if not isinstance(string, str):
-                    raise Exception("Logic error, expected a string!")
-                ip = [int(tup) for tup in string.split(".")]
-                return struct.pack("BBBB", ip[0], ip[1], ip[2], ip[3])
-            elif translated_type["int"]:
-                return int(string)
-            else:
-                # At this point, we could be a string or bytes.
-                return string
 
-        if self.__array or translated_type["composite"]:
-            return [str_to_val(v) for v in self.__value]
+        value = self.__value
+        if self.__array or self.__translated_type["composite"]:
+            if isinstance(value, array):
+                return value.tolist()
+            return [self.__from_native(v) for v in value]
         else:
-            return str_to_val(self.__value)
+            return self.__from_native(value)
 
     def __to_xml(self, depth: int) -> str:
         """
@@ -921,7 +1050,7 @@ class Node:
             )
         translated_type: Dict[str, Any] = self.__translated_type
 
-        attrs_dict = copy.deepcopy(self.__attrs)
+        attrs_dict = dict(self.__attrs)
         order = sorted(attrs_dict.keys())
         if self.data_length != 0:
             # Represent type and length
@@ -961,7 +1090,7 @@ class Node:
                 if self.__value is None:
                     vals = ""
                 else:
-                    vals = " ".join([val for val in self.__value])
+                    vals = " ".join([self.__format(val) for val in self.__value])
             elif translated_type["name"] == "str":
                 vals = escape(self.__value)
             elif translated_type["name"] == "bin":
@@ -974,7 +1103,7 @@ class Node:
 
                 vals = "".join([bin_to_hex(v) for v in self.__value])
             else:
-                vals = str(self.__value)
+                vals = str(self.__format(self.__value))
             return vals
 
         if self.__children:
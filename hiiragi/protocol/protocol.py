@@ -1,12 +1,15 @@
 import binascii
 import hashlib
-from typing import Optional
+import time
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
 
 from typing_extensions import Final
 
 from .binary import BinaryEncoding
 from .lz77 import Lz77
 from .node import Node
+from .rc4 import Rc4
 from .xml import XmlEncoding
 
 
@@ -16,9 +19,49 @@ class EAmuseException(Exception):
     """
 
 
+class EAmuseContext:
+    """
+    Everything learned from decoding a single request, so that the response can be
+    encoded the same way without keeping any per-request state on the protocol object.
+    """
+
+    def __init__(
+        self,
+        tree: Node,
+        text_encoding: str,
+        packet_encoding: int,
+        compression: Optional[str] = None,
+        encryption: Optional[str] = None,
+    ) -> None:
+        """
+        Initialize the context.
+
+        Parameters:
+            tree - The decoded Node tree of the request.
+            text_encoding - The text encoding the request used. See EAmuseProtocol for values.
+            packet_encoding - The packet encoding the request used. Should be EAmuseProtocol.XML
+                              or EAmuseProtocol.BINARY.
+            compression - The compression the request used, or None if it wasn't compressed.
+            encryption - The encryption key the request used, or None if it wasn't encrypted.
+        """
+        self.tree = tree
+        self.text_encoding = text_encoding
+        self.packet_encoding = packet_encoding
+        self.compression = compression
+        self.encryption = encryption
+
+        # How long each decoding stage took and how many bytes it produced, if timed
+        self.stages: Dict[str, Tuple[float, int]] = {}
+
+
 class EAmuseProtocol:
     """
     A wrapper object that encapsulates encoding/decoding the E-Amusement protocol by Konami.
+
+    The decode_context() and encode(context=...) APIs keep no state on this object, so a
+    single instance can be shared between any number of concurrent requests and threads.
+    The older decode() and encode() without a context remember the encodings of the last
+    decoded packet on the object, and so are only safe to use one request at a time.
     """
 
     SHARED_SECRET: Final[bytes] = (
@@ -41,6 +84,12 @@ class EAmuseProtocol:
         """
         self.last_text_encoding: Optional[str] = None
         self.last_packet_encoding: Optional[int] = None
+        self.__rc4 = Rc4()
+
+        # None of these keep any state between calls, so they're shared by every call
+        self.__lz = Lz77()
+        self.__binary = BinaryEncoding()
+        self.__xml = XmlEncoding()
 
     def _rc4_crypt(self, data: bytes, key: bytes) -> bytes:
         """
@@ -53,24 +102,31 @@ class EAmuseProtocol:
         Returns:
             binary string representing the encrypted/decrypted data
         """
-        S = list(range(256))
-        j = 0
-        out = []
+        return self.__rc4.crypt(data, key)
 
-        # KSA Phase
-        for i in range(256):
-            j = (j + S[i] + key[i % len(key)]) & 0xFF
-            S[i], S[j] = S[j], S[i]
+    @staticmethod
+    @lru_cache(maxsize=Rc4.CACHE_SIZE)
+    def _derive_key(encryption_key: str) -> bytes:
+        """
+        Given an encryption key as returned from a HTTP request, derive the RC4 key.
 
-        # PRGA Phase
-        i = j = 0
-        for char in data:
-            i = (i + 1) & 0xFF
-            j = (j + S[i]) & 0xFF
-            S[i], S[j] = S[j], S[i]
-            out.append(char ^ S[(S[i] + S[j]) & 0xFF])
+        Parameters:
+            encryption_key - A string encryption key in the form 1-xxyyzzww-aabb.
 
-        return bytes(out)
+        Returns:
+            binary string representing the RC4 key
+        """
+        # Key is concatenated with the shared secret above
+        version, first, second = encryption_key.split("-")
+        key = (
+            binascii.unhexlify((first + second).encode("ascii"))
+            + EAmuseProtocol.SHARED_SECRET
+        )
+
+        # Next, key is sent through MD5 to derive the real key
+        m = hashlib.md5()
+        m.update(key)
+        return m.digest()
 
     def __decrypt(self, encryption_key: Optional[str], data: bytes) -> bytes:
         """
@@ -85,23 +141,9 @@ class EAmuseProtocol:
         Returns:
             binary string representing transformed data
         """
-        key: Optional[bytes] = None
         if encryption_key:
-            # Key is concatenated with the shared secret above
-            version, first, second = encryption_key.split("-")
-            key = (
-                binascii.unhexlify((first + second).encode("ascii"))
-                + EAmuseProtocol.SHARED_SECRET
-            )
-
-            # Next, key is sent through MD5 to derive the real key
-            m = hashlib.md5()
-            m.update(key)
-            key = m.digest()
-
-        if key:
             # This is an encrypted old-style packet
-            return self._rc4_crypt(data, key)
+            return self._rc4_crypt(data, EAmuseProtocol._derive_key(encryption_key))
 
         # No encryption
         return data
@@ -140,12 +182,13 @@ class EAmuseProtocol:
             return data
         elif compression == "lz77":
             # This is a compressed new-style packet
-            lz = Lz77()
-            return lz.decompress(data)
+            return self.__lz.decompress(data)
         else:
             raise EAmuseException(f"Unknown compression {compression}")
 
-    def __compress(self, compression: Optional[str], data: bytes) -> bytes:
+    def __compress(
+        self, compression: Optional[str], data: bytes, level: Optional[str] = None
+    ) -> bytes:
         """
         Given data and an optional compression scheme, compress the data.
 
@@ -154,6 +197,7 @@ class EAmuseProtocol:
                           be of the form 'l7zz' or 'none'. The python value
                           None will also be recognized as 'none'.
             data - Binary string representing data to transform.
+            level - An optional compression level, one of the Lz77.LEVEL_* constants.
 
         Returns:
             binary string representing transformed data
@@ -163,12 +207,11 @@ class EAmuseProtocol:
             return data
         elif compression == "lz77":
             # This is a compressed new-style packet
-            lz = Lz77()
-            return lz.compress(data)
+            return self.__lz.compress(data, level=level or Lz77.LEVEL_NORMAL)
         else:
             raise EAmuseException(f"Unknown compression {compression}")
 
-    def __decode(self, data: bytes) -> Node:
+    def __decode(self, data: bytes) -> Tuple[Node, str, int]:
         """
         Given data, decode the data into a Node tree.
 
@@ -176,29 +219,23 @@ class EAmuseProtocol:
             data - Binary string representing data to decode.
 
         Returns:
-            Node tree on success or None on failure.
+            A tuple of the Node tree, the text encoding and the packet encoding on success.
         """
         # Assume it's a binary page
-        binary = BinaryEncoding()
-        ret = binary.decode(data, skip_on_exceptions=True)
+        binary = self.__binary.decode_packet(data, skip_on_exceptions=True)
 
-        if ret is not None:
+        if binary is not None:
             # We got a result, it was binary
-            self.last_text_encoding = binary.encoding
-            self.last_packet_encoding = EAmuseProtocol.BINARY
-
-            return ret
+            tree, text_encoding, _ = binary
+            return tree, text_encoding, EAmuseProtocol.BINARY
 
         # Assume its XML
-        xml = XmlEncoding()
-        ret = xml.decode(data, skip_on_exceptions=True)
+        xml = self.__xml.decode_packet(data, skip_on_exceptions=True)
 
-        if ret is not None:
+        if xml is not None and xml[0] is not None:
             # We got a result, it was XML
-            self.last_text_encoding = xml.encoding
-            self.last_packet_encoding = EAmuseProtocol.XML
-
-            return ret
+            tree, text_encoding = xml
+            return tree, text_encoding, EAmuseProtocol.XML
 
         # Couldn't decode
         raise EAmuseException("Unknown packet encoding")
@@ -220,16 +257,15 @@ class EAmuseProtocol:
         """
         if packet_encoding == EAmuseProtocol.BINARY:
             # It's binary, encode it
-            binary = BinaryEncoding()
-            return binary.encode(tree, encoding=text_encoding)
+            return self.__binary.encode(tree, encoding=text_encoding)
         elif packet_encoding == EAmuseProtocol.BINARY_DECOMPRESSED:
             # It's binary, encode it
-            binary = BinaryEncoding()
-            return binary.encode(tree, encoding=text_encoding, compressed=False)
+            return self.__binary.encode(
+                tree, encoding=text_encoding, compressed=False
+            )
         elif packet_encoding == EAmuseProtocol.XML:
             # It's XML, encode it
-            xml = XmlEncoding()
-            return xml.encode(tree, encoding=text_encoding)
+            return self.__xml.encode(tree, encoding=text_encoding)
         else:
             raise EAmuseException(f"Invalid packet encoding {packet_encoding}")
 
@@ -249,9 +285,60 @@ class EAmuseProtocol:
         Returns:
             A Node tree structure representing the parsed request, or None on failure.
         """
-        data = self.__decrypt(encryption, data)
-        data = self.__decompress(compression, data)
-        return self.__decode(data)
+        context = self.decode_context(compression, encryption, data)
+        self.last_text_encoding = context.text_encoding
+        self.last_packet_encoding = context.packet_encoding
+        return context.tree
+
+    def decode_context(
+        self,
+        compression: Optional[str],
+        encryption: Optional[str],
+        data: bytes,
+        timed: bool = False,
+    ) -> EAmuseContext:
+        """
+        Given a request with optional compression and encryption set, decrypt,
+        decompress and decode the data, returning a context that can be passed to
+        encode() to respond the same way. This does not touch any state on this object.
+
+        Parameters:
+            compression - A string specifying the compression type, should be 'lz77' or 'none'.
+                          The python value None can also be passed in.
+            encryption - A string specifying the encryption key, or None if no encryption.
+            data - A binary string of data to parse.
+            timed - Whether to record how long each stage took in the context's stages.
+
+        Returns:
+            An EAmuseContext holding the parsed request tree and how it was sent.
+        """
+        stages: Dict[str, Tuple[float, int]] = {}
+        if not timed:
+            data = self.__decrypt(encryption, data)
+            data = self.__decompress(compression, data)
+            tree, text_encoding, packet_encoding = self.__decode(data)
+        else:
+            start = time.perf_counter()
+            data = self.__decrypt(encryption, data)
+            mark = time.perf_counter()
+            stages["decrypt"] = (mark - start, len(data))
+
+            data = self.__decompress(compression, data)
+            start, mark = mark, time.perf_counter()
+            stages["decompress"] = (mark - start, len(data))
+
+            tree, text_encoding, packet_encoding = self.__decode(data)
+            stages["parse"] = (time.perf_counter() - mark, len(data))
+
+        context = EAmuseContext(
+            tree,
+            text_encoding,
+            packet_encoding,
+            compression=None if compression == "none" else compression,
+            encryption=encryption or None,
+        )
+        context.stages = stages
+        return context
 
     def encode(
         self,
@@ -260,6 +347,8 @@ class EAmuseProtocol:
         tree: Node,
         text_encoding: Optional[str] = None,
         packet_encoding: Optional[int] = None,
+        level: Optional[str] = None,
+        context: Optional[EAmuseContext] = None,
     ) -> bytes:
         """
         Given a response with optional compression and encryption set, encode, compress
@@ -274,25 +363,62 @@ class EAmuseProtocol:
                             last decoded packet. See __encode for values.
             packet_encpding - A packet encoding to use. If not provided, uses the packet encoding
                               of the last decoded packet. See __encode for values.
+            level - An optional compression level, one of the Lz77.LEVEL_* constants. Use
+                    Lz77.LEVEL_FAST for latency sensitive calls and Lz77.LEVEL_MAX for
+                    large responses. Defaults to Lz77.LEVEL_NORMAL.
+            context - The context returned by decode_context() for the request being
+                      responded to. If provided, the text and packet encoding default to
+                      the request's and no state on this object is used or changed.
 
         Returns:
             A blob of data representing the encoded packet.
         """
         # Either auto-set response based on request, or explicitly override in parameters
-        if text_encoding is None:
-            text_encoding = self.last_text_encoding
+        if context is not None:
+            if text_encoding is None:
+                text_encoding = context.text_encoding
+            if packet_encoding is None:
+                packet_encoding = context.packet_encoding
+        else:
+            if text_encoding is None:
+                text_encoding = self.last_text_encoding
+            if packet_encoding is None:
+                packet_encoding = self.last_packet_encoding
+
         if text_encoding is None:
             raise EAmuseException("Unknown text encoding")
-
-        if packet_encoding is None:
-            packet_encoding = self.last_packet_encoding
         if packet_encoding is None:
             raise EAmuseException("Unknown packet encoding")
 
-        # Clear last packet since we sent a response
-        self.last_text_encoding = None
-        self.last_packet_encoding = None
+        if context is None:
+            # Clear last packet since we sent a response
+            self.last_text_encoding = None
+            self.last_packet_encoding = None
 
         data = self.__encode(tree, text_encoding, packet_encoding)
-        data = self.__compress(compression, data)
+        return self.wrap(compression, encryption, data, level=level)
+
+    def wrap(
+        self,
+        compression: Optional[str],
+        encryption: Optional[str],
+        data: bytes,
+        level: Optional[str] = None,
+    ) -> bytes:
+        """
+        Given an already encoded packet with optional compression and encryption set,
+        compress and encrypt the data. This allows a caller to look at the encoded
+        packet before deciding how it should be sent.
+
+        Parameters:
+            compression - A string specifying the compression type, should be 'lz77' or 'none'.
+                          The python value None can also be passed in.
+            encryption - A string specifying the encryption key, or None if no encryption.
+            data - A binary string representing an encoded packet.
+            level - An optional compression level, one of the Lz77.LEVEL_* constants.
+
+        Returns:
+            A blob of data representing the packet suitable for forwarding on a network.
+        """
+        data = self.__compress(compression, data, level=level)
         return self.__encrypt(encryption, data)
@@ -0,0 +1,88 @@
+from functools import lru_cache
+from typing import Tuple
+
+from typing_extensions import Final
+
+
+class Rc4:
+    """
+    A table-driven RC4 engine. The post-KSA state for a key is kept in an LRU cache,
+    so a key that is seen again, such as when the same request is decrypted twice,
+    only has to run the PRGA. The keystream is generated into a preallocated buffer
+    and then XOR'd against the data in one go instead of byte by byte.
+
+    Keystream itself isn't cached. Every response is encrypted with a new key, so it
+    would never be reused, and would only push the keys of requests out of the cache.
+    """
+
+    CACHE_SIZE: Final[int] = 256
+
+    @staticmethod
+    @lru_cache(maxsize=CACHE_SIZE)
+    def schedule(key: bytes) -> Tuple[int, ...]:
+        """
+        Run the key scheduling algorithm for a key.
+
+        Parameters:
+            key - Binary string representing the key to use
+
+        Returns:
+            A tuple of 256 integers representing the initial permutation. This is
+            shared between callers, so it must be copied before being modified.
+        """
+        S = list(range(256))
+        keylen = len(key)
+        j = 0
+
+        for i in range(256):
+            j = (j + S[i] + key[i % keylen]) & 0xFF
+            S[i], S[j] = S[j], S[i]
+
+        return tuple(S)
+
+    def keystream(self, key: bytes, length: int) -> bytes:
+        """
+        Generate length bytes of keystream for a key.
+
+        Parameters:
+            key - Binary string representing the key to use
+            length - Number of keystream bytes to generate
+
+        Returns:
+            A binary string of keystream bytes.
+        """
+        S = list(Rc4.schedule(key))
+        stream = bytearray(length)
+        i = 0
+        j = 0
+
+        for pos in range(length):
+            i = (i + 1) & 0xFF
+            si = S[i]
+            j = (j + si) & 0xFF
+            sj = S[j]
+            S[i] = sj
+            S[j] = si
+            stream[pos] = S[(si + sj) & 0xFF]
+
+        return bytes(stream)
+
+    def crypt(self, data: bytes, key: bytes) -> bytes:
+        """
+        Given a data blob and a key blob, perform RC4 encryption/decryption.
+
+        Parameters:
+            data - Binary string representing data to be encrypted/decrypted
+            key - Binary string representing the key to use
+
+        Returns:
+            binary string representing the encrypted/decrypted data
+        """
+        length = len(data)
+        if length == 0:
+            return b""
+
+        stream = self.keystream(key, length)
+        return (
+            int.from_bytes(data, "little") ^ int.from_bytes(stream, "little")
+        ).to_bytes(length, "little")
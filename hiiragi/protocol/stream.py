@@ -1,5 +1,9 @@
+import re
 import struct
-from typing import List, Optional
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple, Union
+
+from typing_extensions import Final
 
 
 class StreamError(Exception):
@@ -12,21 +16,139 @@ class InputStream:
     """
     A class that treats a binary blob as a stream of bytes to be emitted.
     Makes stream-like algorithms much easier to implement. All accessor
-    functions that read data will advance the current position. It is not
-    rewindable.
+    functions that read data will advance the current position, except for
+    the peek functions. It is not rewindable.
+
+    Reads work directly on the underlying blob through a memoryview and
+    precompiled structs, so nothing is copied unless a caller asks for bytes.
     """
 
-    def __init__(self, data: bytes) -> None:
+    # Struct formats for each integer size, keyed by size and signedness.
+    FORMATS: Final[Dict[Tuple[int, bool], str]] = {
+        (1, True): "B",
+        (1, False): "b",
+        (2, True): "H",
+        (2, False): "h",
+        (4, True): "I",
+        (4, False): "i",
+    }
+    STRUCTS: Final[Dict[Tuple[int, bool], struct.Struct]] = {
+        key: struct.Struct(">" + fmt) for key, fmt in FORMATS.items()
+    }
+
+    def __init__(self, data: Union[bytes, bytearray, memoryview]) -> None:
         """
         Initialize the object. Given a data blob, will set this as the stream
         and set the location to the beginning of the data blob.
 
         Parameters:
-            data - A binary blob to read from.
+            data - A binary blob to read from. It is not copied, so it should not
+                   be modified while the stream is in use.
         """
         self.data = data
+        self.view = memoryview(data).cast("B")
         self.pos = 0
-        self.left = len(self.data)
+        self.left = len(self.view)
+
+    @staticmethod
+    def __struct(size: int, is_unsigned: bool) -> struct.Struct:
+        try:
+            return InputStream.STRUCTS[(size, is_unsigned)]
+        except KeyError:
+            raise StreamError(f"Unsupported size {size}")
+
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def __array_struct(count: int, size: int, is_unsigned: bool) -> struct.Struct:
+        return struct.Struct(f">{count}{InputStream.FORMATS[(size, is_unsigned)]}")
+
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def __delimiter(delimiter: bytes) -> "re.Pattern[bytes]":
+        return re.compile(re.escape(delimiter))
+
+    def skip(self, size: int) -> bool:
+        """
+        Skip over the next size bytes without reading them.
+
+        Parameters:
+            size - An integer representing the number of bytes to skip.
+
+        Returns:
+            True if the bytes were skipped, or False if there weren't enough bytes left.
+        """
+        if size < 0 or size > self.left:
+            return False
+        self.pos += size
+        self.left -= size
+        return True
+
+    def peek_view(self, blob_size: int) -> Optional[memoryview]:
+        """
+        Look at the next blob_size bytes without advancing or copying them.
+
+        Parameters:
+            blob_size - An integer representing the number of bytes to look at.
+
+        Returns:
+            A memoryview over blob_size bytes from the current location, or None if
+            there wasn't enough bytes to satisfy this request.
+        """
+        if blob_size <= 0 or blob_size > self.left:
+            return None
+        return self.view[self.pos : (self.pos + blob_size)]
+
+    def peek_blob(self, blob_size: int) -> Optional[bytes]:
+        """
+        Look at the next blob_size bytes without advancing.
+
+        Parameters:
+            blob_size - An integer representing the number of bytes to look at.
+
+        Returns:
+            A binary string representing blob_size bytes from the current location, or
+            None if there wasn't enough bytes to satisfy this request.
+        """
+        view = self.peek_view(blob_size)
+        if view is None:
+            return None
+        return view.tobytes()
+
+    def peek_int(self, size: int = 1, is_unsigned: bool = True) -> Optional[int]:
+        """
+        Look at the next integer of size 'size' without advancing.
+
+        Parameters:
+            size - Integer representing the integer size to decode. Valid values are
+                   1, 2 and 4 for char, short and int respectively.
+            is_unsigned - An optional boolean specifying whether the integer should be
+                          unsigned. Defaults to True.
+
+        Returns:
+            a python integer representing the big-endian decoding of the current
+            position, or None if there wasn't enough bytes.
+        """
+        st = self.__struct(size, is_unsigned)
+        if size > self.left:
+            return None
+        return st.unpack_from(self.view, self.pos)[0]
+
+    def read_view(self, blob_size: int) -> Optional[memoryview]:
+        """
+        Read the next blob_size bytes without copying them.
+
+        Parameters:
+            blob_size - An integer representing the number of bytes to read.
+
+        Returns:
+            A memoryview over blob_size bytes from the current location, or None if
+            there wasn't enough bytes to satisfy this request.
+        """
+        view = self.peek_view(blob_size)
+        if view is not None:
+            self.pos += blob_size
+            self.left -= blob_size
+        return view
 
     def read_blob(self, blob_size: int) -> Optional[bytes]:
         """
@@ -39,14 +161,10 @@ class InputStream:
             a binary string representing blob_size bytes from the current location, or None
             if there wasn't enough bytes to satisfy this request.
         """
-        if blob_size <= 0:
+        view = self.read_view(blob_size)
+        if view is None:
             return None
-        if blob_size <= self.left:
-            bytedata = self.data[self.pos : (self.pos + blob_size)]
-            self.pos += blob_size
-            self.left -= blob_size
-            return bytedata
-        return None
+        return view.tobytes()
 
     def read_byte(self) -> Optional[bytes]:
         """
@@ -73,36 +191,85 @@ class InputStream:
             a python integer representing the big-endian decoding of the current
             position
         """
-        if size == 1:
-            data = self.read_blob(1)
-            if data is None:
+        if size == 1 and is_unsigned:
+            # Fastpath, just index the view
+            if self.left < 1:
                 return None
+            val = self.view[self.pos]
+            self.pos += 1
+            self.left -= 1
+            return val
 
-            if is_unsigned:
-                # Fastpath, just use python's own decoder
-                return data[0]
-            else:
-                return struct.unpack(">b", data)[0]
-        elif size == 2:
-            data = self.read_blob(2)
-            if data is None:
-                return None
+        st = self.__struct(size, is_unsigned)
+        if size > self.left:
+            return None
+        val = st.unpack_from(self.view, self.pos)[0]
+        self.pos += size
+        self.left -= size
+        return val
 
-            if is_unsigned:
-                return struct.unpack(">H", data)[0]
-            else:
-                return struct.unpack(">h", data)[0]
-        elif size == 4:
-            data = self.read_blob(4)
-            if data is None:
-                return None
+    def read_ints(
+        self, count: int, size: int = 1, is_unsigned: bool = True
+    ) -> Optional[Tuple[int, ...]]:
+        """
+        Grab the next count integers of size 'size' at the current position in one go.
 
-            if is_unsigned:
-                return struct.unpack(">I", data)[0]
-            else:
-                return struct.unpack(">i", data)[0]
+        Parameters:
+            count - The number of integers to decode.
+            size - Integer representing the integer size to decode. Valid values are
+                   1, 2 and 4 for char, short and int respectively.
+            is_unsigned - An optional boolean specifying whether the integers read should
+                          be unsigned. Defaults to True.
+
+        Returns:
+            A tuple of python integers, or None if not enough bytes are available to
+            decode all of them.
+        """
+        self.__struct(size, is_unsigned)
+        if count < 0:
+            return None
+        length = count * size
+        if length > self.left:
+            return None
+        if size == 1 and is_unsigned:
+            vals = tuple(self.view[self.pos : (self.pos + length)])
         else:
-            raise StreamError(f"Unsupported size {size}")
+            vals = self.__array_struct(count, size, is_unsigned).unpack_from(
+                self.view, self.pos
+            )
+        self.pos += length
+        self.left -= length
+        return vals
+
+    def read_until(self, delimiter: bytes, include: bool = False) -> Optional[bytes]:
+        """
+        Read up to the next occurence of a delimiter, consuming the delimiter itself.
+
+        Parameters:
+            delimiter - The bytes to look for.
+            include - Whether to include the delimiter in the returned blob.
+
+        Returns:
+            A binary string of everything up to (and optionally including) the delimiter,
+            or None if the delimiter doesn't appear in the rest of the stream.
+        """
+        obj = self.view.obj
+        if isinstance(obj, (bytes, bytearray)) and len(obj) == self.view.nbytes:
+            # The view is over the whole object, so positions in both are the same
+            end = obj.find(delimiter, self.pos)
+        else:
+            # A slice of something, which regular expressions can search in place
+            match = self.__delimiter(delimiter).search(self.view, self.pos)
+            end = match.start() if match is not None else -1
+        if end < 0:
+            return None
+
+        length = end - self.pos + len(delimiter)
+        stop = end + len(delimiter) if include else end
+        blob = self.view[self.pos : stop].tobytes()
+        self.pos += length
+        self.left -= length
+        return blob
 
 
 class OutputStream:
@@ -110,24 +277,65 @@ class OutputStream:
     A class that treats a binary blob as a stream of bytes to be constructed.
     Makes stream-like algorithms much easier to implement. All accessor
     functions that write data will advance the current position. It is not
-    rewindable. When finished writing, access the finished blob by copying from
-    data.
+    rewindable, but already written data can be overwritten in place with the
+    patch functions, for example to fill in a length once it is known. When
+    finished writing, access the finished blob by copying from data.
+
+    Everything is written with pack_into into a single bytearray which grows
+    geometrically, so reserving the final size up front means no reallocation
+    at all.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, capacity: int = 0) -> None:
         """
         Initialize the object.
+
+        Parameters:
+            capacity - The number of bytes to reserve up front.
         """
-        self.__data: List[bytes] = []
+        self.__data = bytearray(capacity)
         self.__data_len = 0
         self.__formatted_data: Optional[bytes] = None
 
     @property
     def data(self) -> bytes:
         if self.__formatted_data is None:
-            self.__formatted_data = b"".join(self.__data)
+            if self.__data_len == len(self.__data):
+                self.__formatted_data = bytes(self.__data)
+            else:
+                with memoryview(self.__data) as view:
+                    self.__formatted_data = view[: self.__data_len].tobytes()
         return self.__formatted_data
 
+    @property
+    def length(self) -> int:
+        return self.__data_len
+
+    def reserve(self, size: int) -> None:
+        """
+        Make sure there is room for size more bytes without growing the buffer.
+
+        Parameters:
+            size - The number of bytes that are about to be written.
+        """
+        needed = self.__data_len + size
+        capacity = len(self.__data)
+        if needed > capacity:
+            self.__data.extend(bytes(max(needed, capacity * 2) - capacity))
+
+    def __advance(self, size: int) -> int:
+        """
+        Reserve room for size bytes at the end of the stream.
+
+        Returns:
+            The offset of the reserved bytes.
+        """
+        self.reserve(size)
+        offset = self.__data_len
+        self.__data_len += size
+        self.__formatted_data = None
+        return offset
+
     def write_blob(self, blob: bytes) -> int:
         """
         Write a binary blob of data to the stream
@@ -138,9 +346,10 @@ class OutputStream:
         Returns:
             the number of bytes written
         """
-        self.__data.append(blob)
-        self.__data_len += len(blob)
-        return len(blob)
+        length = len(blob)
+        offset = self.__advance(length)
+        self.__data[offset : (offset + length)] = blob
+        return length
 
     def write_byte(self, byte: bytes) -> None:
         """
@@ -149,9 +358,7 @@ class OutputStream:
         Parameters:
             A byte that should be appended to the current stream.
         """
-        self.__data.append(byte)
-        self.__data_len = self.__data_len + 1
-        self.__formatted_data = None
+        self.write_blob(byte)
 
     def write_int(self, integer: int, size: int = 1, is_unsigned: bool = True) -> None:
         """
@@ -164,27 +371,38 @@ class OutputStream:
             is_unsigned - Whether the integer should be written unsigned or
                          signed. Defaults to True.
         """
-        if size == 1:
-            if is_unsigned:
-                self.__data.append(struct.pack(">B", integer))
-            else:
-                self.__data.append(struct.pack(">b", integer))
-            self.__data_len = self.__data_len + 1
-        elif size == 2:
-            if is_unsigned:
-                self.__data.append(struct.pack(">H", integer))
-            else:
-                self.__data.append(struct.pack(">h", integer))
-            self.__data_len = self.__data_len + 2
-        elif size == 4:
-            if is_unsigned:
-                self.__data.append(struct.pack(">I", integer))
-            else:
-                self.__data.append(struct.pack(">i", integer))
-            self.__data_len = self.__data_len + 4
-        else:
-            raise StreamError(f"Unsupported size {size}")
-        self.__formatted_data = None
+        st = self.__struct(size, is_unsigned)
+        st.pack_into(self.__data, self.__advance(size), integer)
+
+    def write_struct(self, st: struct.Struct, *values: Any) -> int:
+        """
+        Pack values with a struct at the end of the output stream.
+
+        Parameters:
+            st - The struct to pack with.
+            values - The values to pack.
+
+        Returns:
+            The offset the values were written at.
+        """
+        offset = self.__advance(st.size)
+        st.pack_into(self.__data, offset, *values)
+        return offset
+
+    def write_zeros(self, size: int) -> int:
+        """
+        Write size zero bytes to the end of the output stream, for example to hold
+        the place of a value that is patched in later.
+
+        Parameters:
+            size - The number of bytes to write.
+
+        Returns:
+            The offset the zeros were written at.
+        """
+        offset = self.__advance(size)
+        self.__data[offset : (offset + size)] = bytes(size)
+        return offset
 
     def write_pad(self, pad_to: int) -> None:
         """
@@ -196,7 +414,44 @@ class OutputStream:
             two padding. After calling this, the next write_byte or write_int will
             be placed on a boundary compatible with the pad_to parameter.
         """
-        while (self.__data_len & (pad_to - 1)) != 0:
-            self.__data.append(b"\0")
-            self.__data_len = self.__data_len + 1
+        padding = -self.__data_len & (pad_to - 1)
+        if padding:
+            self.write_zeros(padding)
+
+    def patch_at(
+        self, offset: int, integer: int, size: int = 1, is_unsigned: bool = True
+    ) -> None:
+        """
+        Overwrite an integer that was already written to the stream.
+
+        Parameters:
+            offset - The offset of the integer in the stream.
+            integer - The integer that should be written.
+            size - The byte size of the integer. Supports 1, 2 and 4 byte
+                   integer types.
+            is_unsigned - Whether the integer should be written unsigned or
+                         signed. Defaults to True.
+        """
+        self.pack_at(offset, self.__struct(size, is_unsigned), integer)
+
+    def pack_at(self, offset: int, st: struct.Struct, *values: Any) -> None:
+        """
+        Overwrite data that was already written to the stream by packing values
+        with a struct.
+
+        Parameters:
+            offset - The offset to write at.
+            st - The struct to pack with.
+            values - The values to pack.
+        """
+        if offset < 0 or offset + st.size > self.__data_len:
+            raise StreamError(f"Cannot patch {st.size} bytes at offset {offset}")
+        st.pack_into(self.__data, offset, *values)
         self.__formatted_data = None
+
+    @staticmethod
+    def __struct(size: int, is_unsigned: bool) -> struct.Struct:
+        try:
+            return InputStream.STRUCTS[(size, is_unsigned)]
+        except KeyError:
+            raise StreamError(f"Unsupported size {size}")
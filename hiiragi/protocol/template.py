@@ -0,0 +1,311 @@
+import copy
+import struct
+from typing import Any, Dict, List, Optional, Tuple
+
+from .binary import BinaryEncoding, PackedOrdering
+from .node import Node
+from .protocol import EAmuseException, EAmuseProtocol
+from .xml import XmlEncoding
+
+
+class TemplateException(Exception):
+    """
+    An exception that is thrown when a template is given fields it cannot patch.
+    """
+
+
+class Template:
+    """
+    A response tree that only differs from call to call in a handful of fields, such as
+    a timestamp. The tree is encoded once per text and packet encoding, remembering where
+    each marked field ended up, and every later response is a copy of that packet with
+    the fields patched in. Fixed width binary values are overwritten in place, strings
+    are overwritten in place as long as they encode to the same length, and XML values
+    are spliced between the unchanged parts of the document. Anything that can't be
+    patched, such as a binary string changing length and thus moving everything laid
+    out after it, falls back to encoding a copy of the tree as usual.
+    """
+
+    def __init__(
+        self, tree: Node, fields: Dict[str, Tuple[Node, Optional[str]]]
+    ) -> None:
+        """
+        Initialize the template.
+
+        Parameters:
+            tree - The tree to encode, holding placeholder values for the marked fields. It
+                   must not be modified after creating the template.
+            fields - The fields that change between responses, mapping a field name to a node
+                     in the tree and an attribute name, or None to patch the node's value.
+        """
+        self.tree = tree
+        self.fields = fields
+
+        # Where each node sits in the tree, so fields can be found in a copy of it
+        self.__index: Dict[int, int] = {}
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            self.__index[id(node)] = len(self.__index)
+            stack.extend(reversed(node.children))
+
+        for name, (node, attr) in fields.items():
+            if id(node) not in self.__index:
+                raise TemplateException(f"Field {name} is not part of the tree")
+            if attr is not None:
+                if node.attribute(attr) is None:
+                    raise TemplateException(
+                        f"Field {name} refers to missing attribute {attr}"
+                    )
+            elif (
+                node.data_length == 0
+                or node.is_array
+                or node.is_composite
+                or node.data_type in ("bin", "ip4")
+            ):
+                raise TemplateException(
+                    f"Field {name} must be a string or a single number"
+                )
+
+        self.__compiled: Dict[Tuple[str, int], Tuple[Any, ...]] = {}
+
+    def fill(self, **values: Any) -> "FilledTemplate":
+        """
+        Fill in every field of this template.
+
+        Parameters:
+            values - The value for each field, as would be given to set_attribute() or
+                     set_value() on the marked node.
+
+        Returns:
+            A FilledTemplate that can be encoded like a tree.
+        """
+        if values.keys() != self.fields.keys():
+            missing = sorted(set(self.fields) ^ set(values))
+            raise TemplateException(f"Fields {missing} are missing or unknown")
+        return FilledTemplate(self, values)
+
+    def encode(
+        self, values: Dict[str, Any], text_encoding: str, packet_encoding: int
+    ) -> bytes:
+        """
+        Encode this template with the given field values.
+
+        Parameters:
+            values - The value for each field.
+            text_encoding - The text encoding for any strings that will be encoded.
+            packet_encoding - The encoding used for the packet. Should be EAmuseProtocol.XML,
+                              EAmuseProtocol.BINARY or EAmuseProtocol.BINARY_DECOMPRESSED.
+
+        Returns:
+            The encoded packet, identical to encoding the filled in tree.
+        """
+        key = (text_encoding, packet_encoding)
+        compiled = self.__compiled.get(key)
+        if compiled is None:
+            compiled = self.__compile(text_encoding, packet_encoding)
+            self.__compiled[key] = compiled
+
+        if packet_encoding == EAmuseProtocol.XML:
+            data = self.__patch_xml(compiled, values)
+        else:
+            data = self.__patch_binary(compiled, values)
+
+        if data is None:
+            data = self.__encode_tree(values, text_encoding, packet_encoding)
+        return data
+
+    def __compile(self, text_encoding: str, packet_encoding: int) -> Tuple[Any, ...]:
+        """
+        Encode the tree, recording where each field ended up.
+
+        Parameters:
+            text_encoding - The text encoding for any strings that will be encoded.
+            packet_encoding - The encoding used for the packet.
+
+        Returns:
+            For XML, a tuple of the parts of the document around the fields, the field
+            names in document order and the encoder. For binary, a tuple of the packet,
+            the offset and struct (or None for strings) of each field and the string
+            encoding.
+        """
+        if packet_encoding == EAmuseProtocol.XML:
+            marks = {(id(node), attr) for node, attr in self.fields.values()}
+            xml = XmlEncoding().encoder(self.tree, text_encoding, marks=marks)
+            data = xml.get_data()
+
+            order = sorted(
+                self.fields,
+                key=lambda name: xml.spans[
+                    (id(self.fields[name][0]), self.fields[name][1])
+                ],
+            )
+            parts: List[bytes] = []
+            pos = 0
+            for name in order:
+                node, attr = self.fields[name]
+                start, end = xml.spans[(id(node), attr)]
+                parts.append(data[pos:start])
+                pos = end
+            parts.append(data[pos:])
+            return parts, order, xml
+
+        if packet_encoding == EAmuseProtocol.BINARY:
+            compressed = True
+        elif packet_encoding == EAmuseProtocol.BINARY_DECOMPRESSED:
+            compressed = False
+        else:
+            raise EAmuseException(f"Invalid packet encoding {packet_encoding}")
+
+        prefix, binary = BinaryEncoding().encoder(self.tree, text_encoding, compressed)
+        data = prefix + binary.get_data()
+        if binary.layout is None:
+            raise Exception("Logic error, encoder did not lay out the body")
+
+        # The layout has an offset for every value, in body ordering
+        base = len(prefix) + binary.body_offset
+        offsets: Dict[Tuple[int, Optional[str]], int] = {}
+        for entry, offset in zip(
+            PackedOrdering.node_to_body_ordering(self.tree), binary.layout.offsets
+        ):
+            attr = entry["name"] if entry["type"] == "attribute" else None
+            offsets[(id(entry["node"]), attr)] = base + offset
+
+        slots: List[Tuple[str, int, Optional[struct.Struct]]] = []
+        for name, (node, attr) in self.fields.items():
+            if attr is not None or node.data_type == "str":
+                slots.append((name, offsets[(id(node), attr)], None))
+            else:
+                slots.append(
+                    (
+                        name,
+                        offsets[(id(node), None)],
+                        struct.Struct(">" + node.data_encoding),
+                    )
+                )
+        return data, slots, binary.encoding
+
+    def __value(self, name: str, value: Any) -> Any:
+        """
+        Validate a field value, converting it the same way the marked node would.
+
+        Parameters:
+            name - The name of the field.
+            value - The value to give it.
+
+        Returns:
+            The value as stored by the node.
+        """
+        node, attr = self.fields[name]
+        if attr is not None or node.data_type == "str":
+            if not isinstance(value, str):
+                raise TemplateException(f"Field {name} has non-string value!")
+            return value
+        return Node(name=node.name, type=node.type, value=value).value
+
+    def __patch_xml(self, compiled: Tuple[Any, ...], values: Dict[str, Any]) -> bytes:
+        """
+        Splice the field values into the XML document.
+        """
+        parts, order, xml = compiled
+        out = [parts[0]]
+        for i, name in enumerate(order):
+            node, attr = self.fields[name]
+            value = self.__value(name, values[name])
+            if attr is not None:
+                out.append(xml.escape(value, attr=True))
+            else:
+                out.append(
+                    xml.encode_value(Node(name=node.name, type=node.type, value=value))
+                )
+            out.append(parts[i + 1])
+        return b"".join(out)
+
+    def __patch_binary(
+        self, compiled: Tuple[Any, ...], values: Dict[str, Any]
+    ) -> Optional[bytes]:
+        """
+        Write the field values over a copy of the binary packet, returning None if one
+        of them can't be written in place.
+        """
+        data, slots, encoding = compiled
+        out = bytearray(data)
+        for name, offset, st in slots:
+            value = self.__value(name, values[name])
+            if st is None:
+                try:
+                    encoded = value.encode(encoding) + b"\0"
+                except UnicodeEncodeError:
+                    return None
+
+                # Strings keep their length in front, so only one that encodes to the
+                # same length can be written without moving everything after it
+                length = struct.unpack_from(">I", out, offset)[0]
+                if len(encoded) != length:
+                    return None
+                out[(offset + 4) : (offset + 4 + length)] = encoded
+            else:
+                if isinstance(value, bool):
+                    value = 1 if value else 0
+                st.pack_into(out, offset, value)
+        return bytes(out)
+
+    def __encode_tree(
+        self, values: Dict[str, Any], text_encoding: str, packet_encoding: int
+    ) -> bytes:
+        """
+        Encode a filled in copy of the tree the usual way.
+        """
+        tree = copy.deepcopy(self.tree)
+        nodes: List[Node] = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(reversed(node.children))
+
+        for name, (node, attr) in self.fields.items():
+            target = nodes[self.__index[id(node)]]
+            if attr is not None:
+                target.set_attribute(attr, values[name])
+            else:
+                target.set_value(values[name])
+
+        if packet_encoding == EAmuseProtocol.XML:
+            return XmlEncoding().encode(tree, encoding=text_encoding)
+        return BinaryEncoding().encode(
+            tree,
+            encoding=text_encoding,
+            compressed=packet_encoding != EAmuseProtocol.BINARY_DECOMPRESSED,
+        )
+
+
+class FilledTemplate:
+    """
+    A template along with the values of its fields, which a plugin can return in place
+    of a tree to have the response patched rather than encoded from scratch.
+    """
+
+    def __init__(self, template: Template, values: Dict[str, Any]) -> None:
+        """
+        Initialize the object.
+
+        Parameters:
+            template - The template to fill in.
+            values - The value of each field.
+        """
+        self.template = template
+        self.values = values
+
+    def encode(self, text_encoding: str, packet_encoding: int) -> bytes:
+        """
+        Encode the filled in template.
+
+        Parameters:
+            text_encoding - The text encoding for any strings that will be encoded.
+            packet_encoding - The encoding used for the packet.
+
+        Returns:
+            The encoded packet.
+        """
+        return self.template.encode(self.values, text_encoding, packet_encoding)
@@ -1,11 +1,10 @@
-import copy
+import re
 import struct
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Pattern, Set, Tuple
 
 from typing_extensions import Final
 
 from .node import Node
-from .stream import InputStream
 
 
 class XmlEncodingException(Exception):
@@ -20,8 +19,19 @@ class XmlDecoder:
     game data or from legacy game traffic. I did consider using lxml and other
     data stores, but they insist on mangling data inside binary/string blobs
     making them unsuitable for a protocol with exact specifications.
+
+    Rather than a character at a time, the document is split into text and
+    elements with bytes.find(), and element attributes are pulled out with a
+    precompiled regex that mirrors the old state machine.
     """
 
+    # An attribute is a name up to the first equals sign, then a value in single
+    # or double quotes. Anything between the equals sign and the quote is ignored.
+    ATTRIBUTE: Final[Pattern[bytes]] = re.compile(
+        rb"\s*(\S[^=]*)=[^\"']*(?:\"([^\"]*)\"|'([^']*)')"
+    )
+    WHITESPACE: Final[Pattern[bytes]] = re.compile(rb"\s")
+
     def __init__(self, data: bytes, encoding: str) -> None:
         """
         Initialize the XML decoder.
@@ -30,7 +40,7 @@ class XmlDecoder:
             data - String XML data which should be decoded into Nodes.
             encoding - The expected encoding of the XML.
         """
-        self.stream = InputStream(data)
+        self.data = data
         self.root: Optional[Node] = None
         self.current: List[Node] = []
         self.encoding = encoding
@@ -98,19 +108,31 @@ class XmlDecoder:
             parent = self.current[-1]
             parent.add_child(node)
 
-    def __yield_values(self, text: str) -> Iterator[str]:
-        value = ""
+    def __unescape(self, value: str, attribute: bool = False) -> str:
+        """
+        Replace XML entities in a decoded string with the characters they represent.
 
-        for c in text:
-            if c.isspace():
-                if len(value) > 0:
-                    yield value
-                    value = ""
-            else:
-                value = value + c
+        Parameters:
+            value - The decoded string to unescape.
+            attribute - Whether this is an attribute value, which can also contain
+                        escaped carriage returns and newlines.
 
-        if len(value) > 0:
-            yield value
+        Returns:
+            The unescaped string.
+        """
+        if "&" not in value:
+            # Nothing to replace, the common case
+            return value
+
+        value = value.replace("&amp;", "&")
+        value = value.replace("&lt;", "<")
+        value = value.replace("&gt;", ">")
+        value = value.replace("&apos;", "'")
+        value = value.replace("&quot;", '"')
+        if attribute:
+            value = value.replace("&#13;", "\r")
+            value = value.replace("&#10;", "\n")
+        return value
 
     def __text(self, text: bytes) -> None:
         """
@@ -126,55 +148,38 @@ class XmlDecoder:
             raise XmlEncodingException("Failed to decode text node with given encoding")
 
         if len(self.current) > 0:
-            data_type = self.current[-1].data_type
-            composite = self.current[-1].is_composite
-            array = self.current[-1].is_array
+            node = self.current[-1]
+            data_type = node.data_type
 
             if data_type == "void":
                 # We can't handle this
                 return
 
             if data_type == "str":
-                # Do nothing, already fine
-                value = value.replace("&amp;", "&")
-                value = value.replace("&lt;", "<")
-                value = value.replace("&gt;", ">")
-                value = value.replace("&apos;", "'")
-                value = value.replace("&quot;", '"')
-                if self.current[-1].value is None:
-                    self.current[-1].set_value(value)
+                value = self.__unescape(value)
+                if node.value is None:
+                    node.set_value(value)
                 else:
-                    self.current[-1].set_value(self.current[-1].value + value)
+                    node.set_value(node.value + value)
             elif data_type == "bin":
-                # Convert from a hex string
-                def hex_to_bin(hexval: str) -> bytes:
-                    intval = int(hexval, 16)
-                    return struct.pack(">B", intval)
-
-                # Remove any spaces first
-                value = "".join([c for c in value if not c.isspace()])
-                if self.current[-1].value is None:
-                    self.current[-1].set_value(
-                        b"".join(
-                            [
-                                hex_to_bin(value[i : (i + 2)])
-                                for i in range(0, len(value), 2)
-                            ]
-                        )
+                # Remove any spaces first, then convert from a hex string
+                value = "".join(value.split())
+                try:
+                    binary = bytes.fromhex(value)
+                except ValueError:
+                    # Odd length or otherwise unusual, convert a byte at a time
+                    binary = b"".join(
+                        struct.pack(">B", int(value[i : (i + 2)], 16))
+                        for i in range(0, len(value), 2)
                     )
+
+                if node.value is None:
+                    node.set_value(binary)
                 else:
-                    self.current[-1].set_value(
-                        self.current[-1].value
-                        + b"".join(
-                            [
-                                hex_to_bin(value[i : (i + 2)])
-                                for i in range(0, len(value), 2)
-                            ]
-                        )
-                    )
+                    node.set_value(node.value + binary)
             elif data_type == "ip4":
                 # Do nothing, already fine
-                self.current[-1].set_value(value)
+                node.set_value(value)
             elif data_type == "bool":
 
                 def conv_bool(val: str) -> bool:
@@ -183,26 +188,20 @@ class XmlDecoder:
                     else:
                         return True
 
-                if array or composite:
-                    self.current[-1].set_value(
-                        [conv_bool(v) for v in self.__yield_values(value)]
-                    )
+                if node.is_array or node.is_composite:
+                    node.set_value([conv_bool(v) for v in value.split()])
                 else:
-                    self.current[-1].set_value(conv_bool(value))
+                    node.set_value(conv_bool(value))
             elif data_type == "float":
-                if array or composite:
-                    self.current[-1].set_value(
-                        [float(v) for v in self.__yield_values(value)]
-                    )
+                if node.is_array or node.is_composite:
+                    node.set_value([float(v) for v in value.split()])
                 else:
-                    self.current[-1].set_value(float(value))
+                    node.set_value(float(value))
             else:
-                if array or composite:
-                    self.current[-1].set_value(
-                        [int(v) for v in self.__yield_values(value)]
-                    )
+                if node.is_array or node.is_composite:
+                    node.set_value([int(v) for v in value.split()])
                 else:
-                    self.current[-1].set_value(int(value))
+                    node.set_value(int(value))
 
     def __parse_attributes(self, attributes: bytes) -> Dict[str, str]:
         """
@@ -213,81 +212,33 @@ class XmlDecoder:
             A dictionary keyed by the attribute name and who's values are unescaped strings.
             If no attributes exist, this returns an empty dictionary.
         """
-        attr_stream = InputStream(attributes)
         parsed_attrs: Dict[str, str] = {}
-        state = "space"
-        attr = b""
-        val = b""
-
-        def unescape(value: bytes) -> str:
-            val = value.decode(self.encoding)
-            val = val.replace("&amp;", "&")
-            val = val.replace("&lt;", "<")
-            val = val.replace("&gt;", ">")
-            val = val.replace("&apos;", "'")
-            val = val.replace("&quot;", '"')
-            val = val.replace("&#13;", "\r")
-            return val.replace("&#10;", "\n")
+        pos = 0
 
         while True:
-            c = attr_stream.read_byte()
-
-            if c is None:
+            match = XmlDecoder.ATTRIBUTE.match(attributes, pos)
+            if match is None:
+                # Either we're done or the rest is malformed, ignore it
                 return parsed_attrs
-            if state == "space":
-                if not c.isspace():
-                    state = "attr"
-                    attr = c
-            elif state == "attr":
-                if c == b"=":
-                    attr = attr.strip()
-                    state = "valstart"
-                else:
-                    attr = attr + c
-            elif state == "valstart":
-                if c == b'"':
-                    state = "valdouble"
-                    val = b""
-                elif c == b"'":
-                    state = "valsingle"
-                    val = b""
-            elif state == "valdouble":
-                if c == b'"':
-                    state = "space"
-                    parsed_attrs[attr.decode("ascii")] = unescape(val)
-                else:
-                    val = val + c
-            elif state == "valsingle":
-                if c == b"'":
-                    state = "space"
-                    parsed_attrs[attr.decode("ascii")] = unescape(val)
-                else:
-                    val = val + c
-
-    def __split_node(self, content: bytes) -> Tuple[bytes, bytes]:
-        node_stream = InputStream(content)
-        tag = b""
-        attributes = b""
-        state = "tag"
 
-        while True:
-            c = node_stream.read_byte()
+            attr, double, single = match.groups()
+            val = double if double is not None else single
+            parsed_attrs[attr.strip().decode("ascii")] = self.__unescape(
+                val.decode(self.encoding), attribute=True
+            )
+            pos = match.end()
 
-            if c is None:
-                break
-            if state == "tag":
-                if c.isspace():
-                    state = "space"
-                else:
-                    tag = tag + c
-            elif state == "space":
-                if not c.isspace():
-                    attributes = c
-                    state = "attributes"
-            elif state == "attributes":
-                attributes = attributes + c
+    def __split_node(self, content: bytes) -> Tuple[bytes, bytes]:
+        """
+        Split the contents of an element into its tag and its attributes.
 
-        return (tag, attributes)
+        Returns:
+            A tuple of the tag and everything after it, minus leading whitespace.
+        """
+        match = XmlDecoder.WHITESPACE.search(content)
+        if match is None:
+            return (content, b"")
+        return (content[: match.start()], content[match.end() :].lstrip())
 
     def __handle_node(self, content: bytes) -> None:
         """
@@ -333,33 +284,52 @@ class XmlDecoder:
         Returns:
             A Node object representing the root of the XML document.
         """
-        state = "text"
-        text = b""
-        node = b""
+        data = self.data
+        pos = 0
 
         while True:
-            c = self.stream.read_byte()
+            start = data.find(b"<", pos)
+            if start < 0:
+                return self.root
+            self.__text(data[pos:start])
 
-            if c is None:
+            end = data.find(b">", start + 1)
+            if end < 0:
                 return self.root
-            elif state == "text":
-                if c == b"<":
-                    self.__text(text)
-                    state = "node"
-                    node = b""
-                else:
-                    text = text + c
-            elif state == "node":
-                if c == b">":
-                    self.__handle_node(node)
-                    state = "text"
-                    text = b""
-                else:
-                    node = node + c
+            self.__handle_node(data[(start + 1) : end])
+            pos = end + 1
 
 
 class XmlEncoder:
-    def __init__(self, tree: Node, encoding: str) -> None:
+    """
+    Encodes a Node tree to XML, walking the tree iteratively and appending everything
+    to a single buffer rather than building and joining a blob for every node.
+    """
+
+    # Characters that need escaping in text, and additionally in attribute values.
+    TEXT_SPECIAL: Final[Pattern[str]] = re.compile("[&<>'\"]")
+    ATTRIBUTE_SPECIAL: Final[Pattern[str]] = re.compile("[&<>'\"\r\n]")
+    TEXT_ESCAPES: Final[Dict[int, str]] = str.maketrans(
+        {"&": "&amp;", "<": "&lt;", ">": "&gt;", "'": "&apos;", '"': "&quot;"}
+    )
+    ATTRIBUTE_ESCAPES: Final[Dict[int, str]] = str.maketrans(
+        {
+            "&": "&amp;",
+            "<": "&lt;",
+            ">": "&gt;",
+            "'": "&apos;",
+            '"': "&quot;",
+            "\r": "&#13;",
+            "\n": "&#10;",
+        }
+    )
+
+    def __init__(
+        self,
+        tree: Node,
+        encoding: str,
+        marks: Optional[Set[Tuple[int, Optional[str]]]] = None,
+    ) -> None:
         """
         Initialize the XML encoder.
 
@@ -367,15 +337,20 @@ class XmlEncoder:
             tree - A binary blob of data to be decoded
             encoding - A string representing the text encoding for string elements. Should be either
                        'shift-jis', 'euc-jp', 'utf-8' or 'ascii'.
+            marks - Values whose position in the output should be recorded in spans, as tuples
+                    of the id() of a node and an attribute name, or None for the node's value.
         """
         self.tree = tree
         self.encoding = encoding
+        self.marks = marks or set()
+        self.spans: Dict[Tuple[int, Optional[str]], Tuple[int, int]] = {}
 
     def get_data(self) -> bytes:
-        magic = f'<?xml version="1.0" encoding="{self.encoding}"?>'.encode("ascii")
-        payload = self.to_xml(self.tree)
-
-        return magic + payload
+        out = bytearray(
+            f'<?xml version="1.0" encoding="{self.encoding}"?>'.encode("ascii")
+        )
+        self.__write(out, self.tree)
+        return bytes(out)
 
     def to_xml(self, node: Node) -> bytes:
         """
@@ -387,126 +362,144 @@ class XmlEncoder:
         Returns:
             Bytes representing the XML-like data for this node and all children.
         """
-        attrs_dict = copy.deepcopy(node.attributes)
-        order = sorted(attrs_dict.keys())
-        if node.data_length != 0:
-            # Represent type and length
-            if node.is_array:
-                if node.value is None:
-                    attrs_dict["__count"] = "0"
+        out = bytearray()
+        self.__write(out, node)
+        return bytes(out)
+
+    def escape(self, val: Any, attr: bool = False) -> bytes:
+        """
+        Escape and encode a text or attribute value.
+
+        Parameters:
+            val - The value to escape. Anything other than a string is converted with str().
+            attr - Whether this is an attribute value, which also needs newlines escaped.
+
+        Returns:
+            The escaped value, encoded in the output encoding.
+        """
+        if isinstance(val, str):
+            if attr:
+                if XmlEncoder.ATTRIBUTE_SPECIAL.search(val) is not None:
+                    val = val.translate(XmlEncoder.ATTRIBUTE_ESCAPES)
+            elif XmlEncoder.TEXT_SPECIAL.search(val) is not None:
+                val = val.translate(XmlEncoder.TEXT_ESCAPES)
+            return val.encode(self.encoding)
+        else:
+            return str(val).encode("ascii")
+
+    def encode_value(self, node: Node) -> bytes:
+        """
+        Encode the value of a node holding data as it appears between its tags.
+
+        Parameters:
+            node - A Node with a value.
+
+        Returns:
+            The encoded value.
+        """
+        data_type = node.data_type
+        if node.is_array or node.is_composite:
+            if node.value is not None:
+                if data_type == "bool":
+                    vals = " ".join([("1" if val else "0") for val in node.value])
                 else:
-                    attrs_dict["__count"] = str(len(node.value))
-                order.insert(0, "__count")
-            attrs_dict["__type"] = node.data_type
-            order.insert(0, "__type")
-
-        def escape(val: Any, attr: bool = False) -> bytes:
-            if isinstance(val, str):
-                val = val.replace("&", "&amp;")
-                val = val.replace("<", "&lt;")
-                val = val.replace(">", "&gt;")
-                val = val.replace("'", "&apos;")
-                val = val.replace('"', "&quot;")
-                if attr:
-                    val = val.replace("\r", "&#13;")
-                    val = val.replace("\n", "&#10;")
-
-                return val.encode(self.encoding)
+                    vals = " ".join([str(val) for val in node.value])
+                return vals.encode("ascii")
+        elif data_type == "str":
+            return self.escape(node.value)
+        elif data_type == "bool":
+            return b"1" if node.value else b"0"
+        elif data_type == "ip4":
+            vals = ".".join([str(val) for val in node.value])
+            return vals.encode("ascii")
+        elif data_type == "bin":
+            # Convert to a hex string
+            value = node.value
+            if isinstance(value, (bytes, bytearray)):
+                return value.hex().encode("ascii")
             else:
-                return str(val).encode("ascii")
-
-        if attrs_dict:
-            attrs = b" " + b" ".join(
-                [
-                    b"".join(
-                        [
-                            attr.encode("ascii"),
-                            b'="',
-                            escape(attrs_dict[attr], attr=True),
-                            b'"',
-                        ]
-                    )
-                    for attr in order
-                ]
-            )
-        else:
-            attrs = b""
-
-        if node.children:
-            # Has children nodes
-            children = [self.to_xml(child) for child in node.children]
-            string = b"".join(
-                [
-                    b"<",
-                    node.name.encode("ascii"),
-                    attrs,
-                    b">",
-                    b"".join(children),
-                    b"</",
-                    node.name.encode("ascii"),
-                    b">",
-                ]
-            )
+
+                def bin_to_hex(binary: int) -> str:
+                    val = hex(binary)[2:]
+                    while len(val) < 2:
+                        val = "0" + val
+                    return val
+
+                return "".join([bin_to_hex(v) for v in value]).encode("ascii")
         else:
-            # Doesn't have children nodes
-            if node.data_length == 0:
-                # Void node
-                string = b"".join(
-                    [
-                        b"<",
-                        node.name.encode("ascii"),
-                        attrs,
-                        b"/>",
-                    ]
-                )
-            else:
-                # Node with values
-                if node.is_array or node.is_composite:
-                    if node.value is None:
-                        vals = ""
-                    else:
-                        if node.data_type == "bool":
-                            vals = " ".join(
-                                [("1" if val else "0") for val in node.value]
-                            )
+            return str(node.value).encode("ascii")
+        return b""
+
+    def __write(self, out: bytearray, root: Node) -> None:
+        """
+        Append the XML for a node, attributes and all children to a buffer.
+
+        Parameters:
+            out - The buffer to append to.
+            root - A Node representing the root of the tree to be encoded.
+        """
+        # Either a node still to be written, or the closing tag of a node with children
+        stack: List[Any] = [root]
+        marks = self.marks
+
+        while stack:
+            node = stack.pop()
+            if isinstance(node, bytes):
+                out += node
+                continue
+
+            name = node.name.encode("ascii")
+            has_data = node.data_length != 0
+            out += b"<"
+            out += name
+
+            if node.attributes or has_data:
+                attributes = node.attributes
+                order = sorted(attributes)
+                if has_data:
+                    # Represent type and length
+                    attributes = dict(attributes)
+                    if node.is_array:
+                        if node.value is None:
+                            attributes["__count"] = "0"
                         else:
-                            vals = " ".join([str(val) for val in node.value])
-                    binary = vals.encode("ascii")
-                elif node.data_type == "str":
-                    binary = escape(node.value)
-                elif node.data_type == "bool":
-                    binary = b"1" if node.value else b"0"
-                elif node.data_type == "ip4":
-                    vals = ".".join([str(val) for val in node.value])
-                    binary = vals.encode("ascii")
-                elif node.data_type == "bin":
-                    # Convert to a hex string
-                    def bin_to_hex(binary: int) -> str:
-                        val = hex(binary)[2:]
-                        while len(val) < 2:
-                            val = "0" + val
-                        return val
-
-                    vals = "".join([bin_to_hex(v) for v in node.value])
-                    binary = vals.encode("ascii")
-                else:
-                    vals = str(node.value)
-                    binary = vals.encode("ascii")
-
-                string = b"".join(
-                    [
-                        b"<",
-                        node.name.encode("ascii"),
-                        attrs,
-                        b">",
-                        binary,
-                        b"</",
-                        node.name.encode("ascii"),
-                        b">",
-                    ]
-                )
+                            attributes["__count"] = str(len(node.value))
+                        order.insert(0, "__count")
+                    attributes["__type"] = node.data_type
+                    order.insert(0, "__type")
+
+                for attr in order:
+                    out += b" "
+                    out += attr.encode("ascii")
+                    out += b'="'
+                    start = len(out)
+                    out += self.escape(attributes[attr], attr=True)
+                    if marks and (id(node), attr) in marks:
+                        self.spans[(id(node), attr)] = (start, len(out))
+                    out += b'"'
+
+            if node.children:
+                # Has children nodes
+                out += b">"
+                stack.append(b"</" + name + b">")
+                stack.extend(reversed(node.children))
+                continue
+
+            if not has_data:
+                # Void node
+                out += b"/>"
+                continue
 
-        return string
+            # Node with values
+            out += b">"
+            start = len(out)
+            out += self.encode_value(node)
+            if marks and (id(node), None) in marks:
+                self.spans[(id(node), None)] = (start, len(out))
+
+            out += b"</"
+            out += name
+            out += b">"
 
 
 class XmlEncoding:
@@ -556,12 +549,32 @@ class XmlEncoding:
         # Always assume this, unless we get told otherwise in the XML
         self.encoding = "shift-jis"
 
-        # Decode property/value
+        ret = self.decode_packet(data, skip_on_exceptions=skip_on_exceptions)
+        if ret is None:
+            return None
+
+        tree, self.encoding = ret
+        return tree
+
+    def decode_packet(
+        self, data: bytes, skip_on_exceptions: bool = False
+    ) -> Optional[Tuple[Optional[Node], str]]:
+        """
+        Given a data blob, decode the data without touching this object's state, so
+        that one instance can be shared between any number of threads.
+
+        Parameters:
+            data - Blob of text representing the data to decode.
+
+        Returns:
+            A tuple of the Node object representing the root of the decoded tree (which
+            is None for an empty document) and the text encoding, or None if we couldn't
+            decode the object for some reason.
+        """
+        # Decode property/value, always assuming this unless we get told otherwise in the XML
         try:
-            xml = XmlDecoder(data, self.encoding)
-            tree = xml.get_tree()
-            self.encoding = xml.encoding
-            return tree
+            xml = XmlDecoder(data, "shift-jis")
+            return xml.get_tree(), xml.encoding
         except XmlEncodingException:
             if skip_on_exceptions:
                 return None
@@ -586,10 +599,28 @@ class XmlEncoding:
         if encoding is None:
             raise XmlEncodingException("Unknown encoding")
 
+        return self.encoder(tree, encoding).get_data()
+
+    def encoder(
+        self,
+        tree: Node,
+        encoding: str,
+        marks: Optional[Set[Tuple[int, Optional[str]]]] = None,
+    ) -> XmlEncoder:
+        """
+        Create an encoder for a tree, without encoding anything yet.
+
+        Parameters:
+            tree - Node tree representing the data to encode
+            encoding - The text encoding to use.
+            marks - Values whose position in the output should be recorded, see XmlEncoder.
+
+        Returns:
+            An XmlEncoder for the tree.
+        """
         encoding = self.__fix_encoding(encoding)
         if encoding not in XmlEncoding.ACCEPTED_ENCODINGS:
             # XML pages only support a few encodings.
             raise XmlEncodingException(f"Invalid text encoding {encoding}")
 
-        xml = XmlEncoder(tree, encoding)
-        return xml.get_data()
+        return XmlEncoder(tree, encoding, marks=marks)
@@ -3,6 +3,8 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 
 from hiiragi.backend import route
+from hiiragi.backend.codec import executor
+from hiiragi.database import database
 from hiiragi.log import logger
 from hiiragi.plugin import PluginManager
 
@@ -13,8 +15,11 @@ async def lifespan(app: FastAPI):
     PluginManager.loadPlugins()
     logger.info("Hiiragi is loaded!")
     yield
+    executor.shutdown()
+    database.close()
 
 
 app = FastAPI(lifespan=lifespan)
 
 app.include_router(route.router)
+app.include_router(route.metricsRouter)
@@ -1,14 +1,32 @@
 import time
+from functools import partial
 
 from fastapi import Request
 
+from hiiragi.database import Database
 from hiiragi.plugin import Plugin
+from hiiragi.protocol.lz77 import Lz77
 from hiiragi.protocol.node import Node
+from hiiragi.protocol.template import Template
 
 name = "Hiiragi BeatStream Plugin"
 game = "NBT"
 version = "2025.06.17"
 
+# Applied in order when the plugin is loaded, only ever add to the end
+migrations = [
+    """
+    CREATE TABLE nbt_pcbevent (
+        id INTEGER PRIMARY KEY,
+        pcbid TEXT NOT NULL,
+        name TEXT NOT NULL,
+        value INTEGER,
+        time INTEGER
+    );
+    CREATE INDEX nbt_pcbevent_pcbid ON nbt_pcbevent (pcbid, time);
+    """,
+]
+
 
 async def getServices(request: Request, node: Node):
     response = Node.void("response")
@@ -68,19 +86,31 @@ async def getServices(request: Request, node: Node):
     return response
 
 
-async def alivePCBTracker(request: Request, node: Node):
+def buildPCBTracker() -> Template:
     response = Node.void("response")
     pcbtracker = Node.void("pcbtracker")
     pcbtracker.set_attribute("status", "0")
     pcbtracker.set_attribute("expire", "1200")
-    pcbtracker.set_attribute("ecenable", node.attribute("ecflag", "1"))
+    pcbtracker.set_attribute("ecenable", "1")
     pcbtracker.set_attribute("eclimit", "0")
     pcbtracker.set_attribute("limit", "0")
-    pcbtracker.set_attribute("time", str(round(time.time())))
+    pcbtracker.set_attribute("time", "0000000000")
 
     response.add_child(pcbtracker)
 
-    return response
+    # Only these change between heartbeats, the rest is encoded once
+    return Template(
+        response, {"ecenable": (pcbtracker, "ecenable"), "time": (pcbtracker, "time")}
+    )
+
+
+pcbTracker = buildPCBTracker()
+
+
+async def alivePCBTracker(request: Request, node: Node):
+    return pcbTracker.fill(
+        ecenable=node.attribute("ecflag", "1"), time=str(round(time.time()))
+    )
 
 
 async def getMessage(request: Request, node: Node):
@@ -158,7 +188,26 @@ async def getFacility(request: Request, node: Node):
     return response
 
 
-async def putPCBevent(request: Request, node: Node):
+async def putPCBevent(db: Database, request: Request, node: Node):
+    event = node.child("pcbevent")
+    if event is not None:
+        rows = [
+            (
+                node.attribute("srcid", ""),
+                item.child_value("name"),
+                item.child_value("value"),
+                item.child_value("time"),
+            )
+            for item in event.children
+            if item.name == "item" and item.child_value("name") is not None
+        ]
+        if rows:
+            await db.executeMany(
+                "INSERT INTO nbt_pcbevent (pcbid, name, value, time) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
     response = Node.void("response")
 
     pcbevent = Node.void("pcbevent")
@@ -182,9 +231,9 @@ async def packageList(request: Request, node: Node):
 
 
 def load(plugin: Plugin):
-    plugin.dispatch("services.get", getServices)
-    plugin.dispatch("pcbtracker.alive", alivePCBTracker)
-    plugin.dispatch("message.get", getMessage)
-    plugin.dispatch("facility.get", getFacility)
-    plugin.dispatch("pcbevent.put", putPCBevent)
-    plugin.dispatch("package.list", packageList)
+    plugin.dispatch("services.get", getServices, cacheable=True)
+    plugin.dispatch("pcbtracker.alive", alivePCBTracker, level=Lz77.LEVEL_FAST)
+    plugin.dispatch("message.get", getMessage, cacheable=True)
+    plugin.dispatch("facility.get", getFacility, cacheable=True)
+    plugin.dispatch("pcbevent.put", partial(putPCBevent, plugin.db))
+    plugin.dispatch("package.list", packageList, cacheable=True)
@@ -1,15 +1,79 @@
+import importlib.util
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Mapping, Tuple
+
 import httpx
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
 
+from hiiragi.capture import CaptureRecord, CaptureWriter
+from hiiragi.log import logger
 from hiiragi.protocol.node import Node
 from hiiragi.protocol.protocol import EAmuseProtocol
 
-app = FastAPI()
-
 TARGET_BASE_URL = "http://localhost:8082"
 
+# Upstream connection pool, see the README for what each of these does
+MAX_CONNECTIONS = int(os.environ.get("HIIRAGI_PROXY_MAX_CONNECTIONS", 100))
+MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("HIIRAGI_PROXY_MAX_KEEPALIVE_CONNECTIONS", 20)
+)
+KEEPALIVE_EXPIRY = float(os.environ.get("HIIRAGI_PROXY_KEEPALIVE_EXPIRY", 30))
+TIMEOUT = float(os.environ.get("HIIRAGI_PROXY_TIMEOUT", 10))
+HTTP2 = os.environ.get("HIIRAGI_PROXY_HTTP2", "").lower() in ("1", "true", "yes", "on")
+if HTTP2 and importlib.util.find_spec("h2") is None:
+    # httpx would only fail once the first request is sent
+    logger.warning(
+        "HIIRAGI_PROXY_HTTP2 is on but the h2 package isn't installed, "
+        'falling back to HTTP/1.1 (pip install "httpx[http2]" to use HTTP/2)'
+    )
+    HTTP2 = False
+
+# Modules whose responses modify() rewrites, every other call is passed through as is
+REWRITE_MODULES = {"services"}
+
+# Only meaningful for a single connection, so these aren't forwarded upstream
+HOP_BY_HOP_HEADERS = {
+    "host",
+    "connection",
+    "keep-alive",
+    "content-length",
+    "transfer-encoding",
+    "te",
+    "trailer",
+    "upgrade",
+    "proxy-authorization",
+    "proxy-connection",
+}
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One client for every request, so upstream connections are kept alive and reused
+    app.state.client = httpx.AsyncClient(
+        base_url=TARGET_BASE_URL,
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        timeout=TIMEOUT,
+        http2=HTTP2,
+    )
+    capture.start()
+    yield
+    await app.state.client.aclose()
+    await capture.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
 protocol = EAmuseProtocol()
 
+capture = CaptureWriter.fromEnvironment()
+
 
 def modify(node: Node) -> Node:
     if node.name != "response":
@@ -37,42 +101,124 @@ def modify(node: Node) -> Node:
     return None
 
 
+def decode(headers: Mapping[str, str], body: bytes) -> Node:
+    compress = "lz77" if headers.get("x-compress", "none") != "none" else None
+    return protocol.decode_context(compress, headers.get("x-eamuse-info"), body).tree
+
+
+def forwarded(
+    headers: Mapping[str, str], keep: Tuple[str, ...] = ()
+) -> Dict[str, str]:
+    return {
+        key: value
+        for key, value in headers.items()
+        if key.lower() not in HOP_BY_HOP_HEADERS or key.lower() in keep
+    }
+
+
+async def passthrough(
+    request: Request, target_url: str, f: str, arrived: float
+) -> Response:
+    """
+    Stream a call to the upstream server and its response back without decoding
+    either, keeping the original headers, compression and encryption. The call is
+    captured once the response has been sent, with the time the request arrived.
+    """
+    client: httpx.AsyncClient = request.app.state.client
+    sent = bytearray()
+    received = bytearray()
+
+    async def upload():
+        async for chunk in request.stream():
+            if capture.enabled:
+                sent.extend(chunk)
+            yield chunk
+
+    # Keeping the length means the body isn't sent chunked
+    upstream = client.build_request(
+        method=request.method,
+        url=target_url,
+        headers=forwarded(request.headers, keep=("content-length",)),
+        content=upload(),
+    )
+    response = await client.send(upstream, stream=True)
+
+    async def download():
+        try:
+            # Raw, so that the bytes and content-length are exactly what was sent
+            async for chunk in response.aiter_raw():
+                if capture.enabled:
+                    received.extend(chunk)
+                yield chunk
+        finally:
+            await response.aclose()
+
+        capture.capture(
+            CaptureRecord(
+                f,
+                request.method,
+                target_url,
+                request.headers,
+                bytes(sent),
+                response.status_code,
+                response.headers,
+                bytes(received),
+                timestamp=arrived,
+            )
+        )
+
+    return StreamingResponse(
+        download(),
+        status_code=response.status_code,
+        headers=forwarded(response.headers, keep=("content-length",)),
+    )
+
+
 @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
 async def proxy(request: Request, path: str, f: str):
-    target_url = f"{TARGET_BASE_URL}/{path}"
-    body = await request.body()
-
-    compress = "lz77" if request.headers.get("x-compress", "none") != "none" else None
-    req = protocol.decode(compress, request.headers.get("x-eamuse-info"), body)
+    # Captured calls are replayed with the gaps between their arrivals
+    arrived = time.time()
+    target_url = f"/{path}"
 
     # Get query parameter
     query_string = request.url.query
     if query_string:
         target_url += f"?{query_string}"
 
-    # Proxing
-    async with httpx.AsyncClient() as client:
-        response = await client.request(
-            method=request.method,
-            url=target_url,
-            headers={
-                key: value
-                for key, value in request.headers.items()
-                if key.lower() != "host"
-            },
-            content=body,
-        )
+    if f.split(".", 1)[0] not in REWRITE_MODULES:
+        return await passthrough(request, target_url, f, arrived)
+
+    body = await request.body()
 
-    headers = dict(response.headers)
+    # Proxing
+    client: httpx.AsyncClient = request.app.state.client
+    response = await client.request(
+        method=request.method,
+        url=target_url,
+        headers=forwarded(request.headers),
+        content=body,
+    )
 
-    compress = "lz77" if response.headers.get("x-compress", "none") != "none" else None
-    res = protocol.decode(
-        compress, response.headers.get("x-eamuse-info"), response.content
+    # The body is re-encoded, so its length and transfer encoding are set again
+    headers = forwarded(response.headers)
+
+    capture.capture(
+        CaptureRecord(
+            f,
+            request.method,
+            target_url,
+            request.headers,
+            body,
+            response.status_code,
+            response.headers,
+            response.content,
+            timestamp=arrived,
+        )
     )
 
-    with open(f"./responses/{f}.txt", "w") as fp:
-        fp.write(str(req) + "\n\n" + str(res))
+    res = decode(response.headers, response.content)
 
+    compress = "lz77" if response.headers.get("x-compress", "none") != "none" else None
     res = modify(res) or res
     data = protocol.encode(
         compress,
@@ -83,7 +229,6 @@ async def proxy(request: Request, path: str, f: str):
     )
 
     # return
-    del headers["content-length"]
     return Response(data, headers=headers)
 
 
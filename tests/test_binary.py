@@ -0,0 +1,286 @@
+import random
+import unittest
+from typing import List, Optional, Tuple
+from unittest import mock
+
+from hiiragi.protocol.binary import (
+    BinaryDecoder,
+    BinaryEncoder,
+    BinaryEncoding,
+    PackedOrdering,
+)
+from hiiragi.protocol.node import Node
+
+ENCODING = "shift-jis"
+
+# What the encoder produced for packet() before layouts were cached
+GOLDEN_COMPRESSED = bytes.fromhex(
+        "a042807f000000700104a26c712e05cb4a6ac42e05e37a2ea40106d719beab702e06caae"
+        "6dd2900302e880fe0403e01180fe03019cfe0603e03080fe3404af19acfe0503e81180fe"
+        "0b04ce6caafe0202e080fe0903e86100fe0c02bb50fe0a039eecc0fe4804e06138fe4303"
+        "e88e00fe0d01e4fefefeff00000000880000000f4e42543a4a3a413a413a323032300000"
+        "000000153031323046454443424139383736353433323130000000000000000467657400"
+        "c80701fbfffefffffffe79600000000982d082a282e782ac00000000ffffffffffffffff"
+        "c0a8000100000003010203000000001080000000000000007fffffffffffffff00000003"
+        "010203006553f100"
+)
+GOLDEN_UNCOMPRESSED = bytes.fromhex(
+        "a045807f00000078014363616c6c2e446d6f64656c2e4473726369640145706c61796572"
+        "2e456d6574686f6403417538fe0442733136fe034062fe0642733332fe3443666c6167fe"
+        "0542753136fe0b436e616d65fe02417338fe0942753634fe0c416970fe0a4262696efe48"
+        "4373363473fe4342753873fe0d4074fefefeff00000000880000000f4e42543a4a3a413a"
+        "413a32303230000000000015303132304645444342413938373635343332313000000000"
+        "0000000467657400c80701fbfffefffffffe79600000000982d082a282e782ac00000000"
+        "ffffffffffffffffc0a8000100000003010203000000001080000000000000007fffffff"
+        "ffffffff00000003010203006553f100"
+)
+
+
+def packet() -> Node:
+    """
+    A request mixing sizes, so that the body needs byte and short holes filled in.
+    """
+    root = Node.void("call")
+    root.set_attribute("model", "NBT:J:A:A:2020")
+    root.set_attribute("srcid", "0120FEDCBA9876543210")
+    body = Node.void("player")
+    body.set_attribute("method", "get")
+    body.add_child(Node.u8("u8", 200))
+    body.add_child(Node.s16("s16", -2))
+    body.add_child(Node.u8("b", 7))
+    body.add_child(Node.s32("s32", -100000))
+    body.add_child(Node.bool("flag", True))
+    body.add_child(Node.u16("u16", 65535))
+    body.add_child(Node.string("name", "ひいらぎ"))
+    body.add_child(Node.s8("s8", -5))
+    body.add_child(Node.u64("u64", 2**64 - 1))
+    body.add_child(Node.ipv4("ip", "192.168.0.1"))
+    body.add_child(Node.binary("bin", b"\x01\x02\x03"))
+    body.add_child(Node.s64_array("s64s", [-(2**63), 2**63 - 1]))
+    body.add_child(Node.u8_array("u8s", [1, 2, 3]))
+    body.add_child(Node.time("t", 1700000000))
+    root.add_child(body)
+    return root
+
+
+def arrays(offset: int) -> Node:
+    """
+    An array of every numeric type, with values that depend on offset so that trees
+    of the same shape can be told apart.
+    """
+    root = Node.void("response")
+    root.add_child(Node.s8_array("s8", [-128, offset % 100, 127]))
+    root.add_child(Node.u8_array("u8", [0, offset % 200, 255]))
+    root.add_child(Node.s16_array("s16", [-32768, offset, 32767]))
+    root.add_child(Node.u16_array("u16", [0, offset, 65535]))
+    root.add_child(Node.s32_array("s32", [-(2**31), offset, 2**31 - 1]))
+    root.add_child(Node.u32_array("u32", [0, offset, 2**32 - 1]))
+    root.add_child(Node.s64_array("s64", [-(2**63), offset, 2**63 - 1]))
+    root.add_child(Node.u64_array("u64", [0, offset, 2**64 - 1]))
+    root.add_child(Node.float_array("float", [0.5, float(offset), -2.25]))
+    root.add_child(Node.bool_array("bool", [True, offset % 2 == 0, False]))
+    root.add_child(Node.time_array("time", [0, offset, 2**32 - 1]))
+    root.add_child(Node.u8("after", offset % 256))
+    return root
+
+
+class TestBinaryEncoding(unittest.TestCase):
+    def setUp(self):
+        BinaryEncoder.LAYOUTS.clear()
+        BinaryDecoder.SCHEMAS.clear()
+        self.binary = BinaryEncoding()
+
+    def roundtrip(self, tree: Node, compressed: bool = True) -> bytes:
+        data = self.binary.encode(tree, ENCODING, compressed=compressed)
+        self.assertEqual(self.binary.decode(data), tree)
+        return data
+
+    def test_golden(self):
+        # Twice each, the second time from the cached layout and schema
+        for _ in range(2):
+            self.assertEqual(self.roundtrip(packet()), GOLDEN_COMPRESSED)
+            self.assertEqual(
+                self.roundtrip(packet(), compressed=False), GOLDEN_UNCOMPRESSED
+            )
+        self.assertEqual(len(BinaryEncoder.LAYOUTS), 2)
+        self.assertEqual(len(BinaryDecoder.SCHEMAS), 2)
+
+    def test_arrays(self):
+        first = self.roundtrip(arrays(1))
+        # Same shape, so the layout is reused with the new values
+        second = self.roundtrip(arrays(2))
+        self.assertEqual(len(BinaryEncoder.LAYOUTS), 1)
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.binary.decode(second), arrays(2))
+
+    def test_shape_changes(self):
+        # A different array length is a different shape, not a stale layout
+        short = Node.void("response")
+        short.add_child(Node.s32_array("a", [1, 2]))
+        long = Node.void("response")
+        long.add_child(Node.s32_array("a", [1, 2, 3]))
+        self.roundtrip(short)
+        self.roundtrip(long)
+        self.roundtrip(short)
+        self.assertEqual(len(BinaryEncoder.LAYOUTS), 2)
+
+    def test_eviction(self):
+        encoder = mock.patch.object(BinaryEncoder, "LAYOUT_CACHE_SIZE", 4)
+        decoder = mock.patch.object(BinaryDecoder, "SCHEMA_CACHE_SIZE", 4)
+        with encoder, decoder:
+            # A new name is a new header as well as a new layout
+            for count in range(1, 10):
+                tree = Node.void("response")
+                tree.add_child(Node.u16_array(f"a{count}", list(range(count))))
+                self.roundtrip(tree)
+            self.assertEqual(len(BinaryEncoder.LAYOUTS), 4)
+            self.assertEqual(len(BinaryDecoder.SCHEMAS), 4)
+
+
+class ReferenceOrdering:
+    """
+    The hole-fill algorithm as it was before PackedOrdering kept track of free chunks,
+    which scanned every byte. PackedOrdering has to place everything where this does.
+    """
+
+    def __init__(self, size: int, allow_expansion: bool = False) -> None:
+        self.order: List[Optional[int]] = [None] * size
+        self.expand = allow_expansion
+        self.lastbyte = 0
+        self.lastshort = 0
+        self.lastint = 0
+
+    def pad(self) -> None:
+        if self.expand:
+            while len(self.order) & 3:
+                self.order.append(None)
+
+    def mark_used(self, size: int, offset: int, round_to: int = 1) -> None:
+        while size & (round_to - 1):
+            size += 1
+        if self.expand:
+            while len(self.order) < size + offset:
+                self.order.append(None)
+        for i in range(size):
+            self.order[i + offset] = size
+
+    def get_next_byte(self) -> Optional[int]:
+        self.pad()
+        for i in range(self.lastbyte, len(self.order), 4):
+            if self.order[i] is not None:
+                for j in range(4):
+                    if self.order[i + j] == 1:
+                        continue
+                    elif self.order[i + j] is None:
+                        self.lastbyte = i
+                        return i + j
+                    else:
+                        break
+            else:
+                self.lastbyte = i
+                return i
+        if self.expand:
+            self.lastbyte = len(self.order)
+            return len(self.order)
+        return None
+
+    def get_next_short(self) -> Optional[int]:
+        self.pad()
+        for i in range(self.lastshort, len(self.order), 4):
+            if self.order[i] is not None:
+                for j in range(0, 4, 2):
+                    if self.order[i + j] == 2 and self.order[i + j + 1] == 2:
+                        continue
+                    elif self.order[i + j] is None and self.order[i + j + 1] is None:
+                        self.lastshort = i
+                        return i + j
+                    else:
+                        break
+            else:
+                self.lastshort = i
+                return i
+        if self.expand:
+            self.lastshort = len(self.order)
+            return len(self.order)
+        return None
+
+    def get_next_int(self) -> Optional[int]:
+        self.pad()
+        for i in range(self.lastint, len(self.order), 4):
+            if all(self.order[i + j] is None for j in range(4)):
+                self.lastint = i
+                return i
+        if self.expand:
+            self.lastint = len(self.order)
+            return len(self.order)
+        return None
+
+
+# (size, round_to) of a u8, u16, s32, u64, and strings or arrays with their length
+SIZES = [(1, 1), (2, 1), (4, 1), (8, 1), (4 + 3, 4), (4 + 6, 4), (4 + 16, 4)]
+
+
+def place(ordering, sizes: List[Tuple[int, int]]) -> List[Optional[int]]:
+    """
+    Place values the way the encoder and decoder do, returning where each one went.
+    """
+    offsets = []
+    for size, round_to in sizes:
+        if size == 1:
+            offset = ordering.get_next_byte()
+        elif size == 2:
+            offset = ordering.get_next_short()
+        else:
+            offset = ordering.get_next_int()
+        offsets.append(offset)
+        if offset is None:
+            break
+        ordering.mark_used(size, offset, round_to=round_to)
+    return offsets
+
+
+class TestPackedOrdering(unittest.TestCase):
+    def assertSamePlaces(self, sizes: List[Tuple[int, int]]) -> None:
+        encoded = place(PackedOrdering(0, allow_expansion=True), sizes)
+        reference = ReferenceOrdering(0, allow_expansion=True)
+        self.assertEqual(encoded, place(reference, sizes))
+
+        # Decoding finds the same places in a body of the final size
+        length = len(reference.order)
+        self.assertEqual(place(PackedOrdering(length), sizes), encoded)
+        self.assertEqual(place(ReferenceOrdering(length), sizes), encoded)
+
+    def test_docstring_examples(self):
+        self.assertEqual(
+            place(PackedOrdering(0, allow_expansion=True), [(1, 1), (1, 1), (4, 1)]),
+            [0, 1, 4],
+        )
+        self.assertEqual(
+            place(
+                PackedOrdering(0, allow_expansion=True),
+                [(1, 1), (4 + 3, 4), (2, 1), (1, 1)],
+            ),
+            [0, 4, 12, 1],
+        )
+
+    def test_interleaved(self):
+        self.assertSamePlaces(
+            [(1, 1), (2, 1), (4, 1), (1, 1), (1, 1), (2, 1), (2, 1), (1, 1), (4, 1)]
+            + [(1, 1), (4 + 3, 4), (2, 1), (1, 1), (8, 1), (2, 1), (1, 1), (1, 1)]
+        )
+
+    def test_random(self):
+        rng = random.Random(7)
+        for _ in range(500):
+            count = rng.randrange(1, 64)
+            self.assertSamePlaces([rng.choice(SIZES) for _ in range(count)])
+
+    def test_runs_out_of_room(self):
+        # Decoding never places anything past the end of the body
+        sizes = [(1, 1), (2, 1), (4, 1), (2, 1)]
+        self.assertEqual(place(PackedOrdering(8), sizes), [0, 4, None])
+        self.assertEqual(place(ReferenceOrdering(8), sizes), [0, 4, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from hiiragi.database import Database, DatabaseException, splitStatements
+
+MIGRATIONS = [
+    "CREATE TABLE tst_score (id INTEGER PRIMARY KEY, name TEXT NOT NULL, score INT);"
+    "CREATE INDEX tst_score_name ON tst_score (name);",
+    lambda connection: connection.execute(
+        "INSERT INTO tst_score (name, score) VALUES ('seed', 1)"
+    ),
+]
+
+
+class TestDatabase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "test.db")
+        self.database = self.open()
+
+    def open(self) -> Database:
+        database = Database(self.path, connections=2)
+        self.addCleanup(database.close)
+        return database
+
+    async def version(self, namespace: str = "tst") -> int:
+        row = await self.database.fetchOne(
+            "SELECT version FROM hiiragi_migrations WHERE namespace = ?", (namespace,)
+        )
+        return 0 if row is None else row["version"]
+
+    async def test_migrate_twice(self):
+        self.database.migrate("tst", MIGRATIONS)
+        self.database.migrate("tst", MIGRATIONS)
+        # And again from another process, as on a restart
+        self.open().migrate("tst", MIGRATIONS)
+
+        self.assertEqual(await self.version(), 2)
+        rows = await self.database.fetchAll("SELECT name FROM tst_score")
+        self.assertEqual([row["name"] for row in rows], ["seed"])
+
+    async def test_migrate_added(self):
+        self.database.migrate("tst", MIGRATIONS[:1])
+        self.assertEqual(await self.version(), 1)
+        self.database.migrate("tst", MIGRATIONS)
+        self.assertEqual(await self.version(), 2)
+
+        with self.assertRaises(DatabaseException):
+            self.database.migrate("tst", MIGRATIONS[:1])
+
+    async def test_migrate_failure(self):
+        self.database.migrate("tst", MIGRATIONS)
+        broken = MIGRATIONS + [
+            "CREATE TABLE tst_new (id INTEGER PRIMARY KEY);"
+            "INSERT INTO tst_score (name, score) VALUES ('new', 2);"
+            "INSERT INTO tst_missing VALUES (1);"
+        ]
+        with self.assertRaises(DatabaseException):
+            self.database.migrate("tst", broken)
+
+        # Nothing the failed migration did before the bad statement was kept
+        self.assertEqual(await self.version(), 2)
+        self.assertIsNone(
+            await self.database.fetchOne(
+                "SELECT name FROM sqlite_master WHERE name = 'tst_new'"
+            )
+        )
+        rows = await self.database.fetchAll("SELECT name FROM tst_score")
+        self.assertEqual([row["name"] for row in rows], ["seed"])
+
+        # Once fixed, it can be applied, and the writer still works afterwards
+        broken[-1] = broken[-1].replace("INSERT INTO tst_missing VALUES (1);", "")
+        self.database.migrate("tst", broken)
+        self.assertEqual(await self.version(), 3)
+        await self.database.execute("INSERT INTO tst_new (id) VALUES (?)", (1,))
+
+    async def test_namespaces(self):
+        self.database.migrate("tst", MIGRATIONS)
+        self.database.migrate("other", ["CREATE TABLE other_thing (id INTEGER);"])
+        self.assertEqual(await self.version("tst"), 2)
+        self.assertEqual(await self.version("other"), 1)
+
+    async def test_readers_see_commits(self):
+        self.database.migrate("tst", MIGRATIONS)
+        self.assertEqual(
+            (await self.database.fetchOne("PRAGMA journal_mode"))[0], "wal"
+        )
+
+        # Reads right after each write, on every reader thread, see it
+        for score in range(20):
+            result = await self.database.execute(
+                "INSERT INTO tst_score (name, score) VALUES (?, ?)", ("player", score)
+            )
+            rows = await asyncio.gather(
+                *(
+                    self.database.fetchOne(
+                        "SELECT score FROM tst_score WHERE id = ?", (result.lastrowid,)
+                    )
+                    for _ in range(4)
+                )
+            )
+            self.assertEqual([row["score"] for row in rows], [score] * 4)
+
+        # As does another connection to the same file
+        other = self.open()
+        row = await other.fetchOne(
+            "SELECT COUNT(*) AS count FROM tst_score WHERE name = ?", ("player",)
+        )
+        self.assertEqual(row["count"], 20)
+
+    async def test_transaction_rollback(self):
+        self.database.migrate("tst", MIGRATIONS)
+
+        def write(connection: sqlite3.Connection) -> None:
+            connection.execute(
+                "INSERT INTO tst_score (name, score) VALUES ('rolled back', 1)"
+            )
+            connection.execute("INSERT INTO tst_score (id, name) VALUES (1, 'clash')")
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            await self.database.transaction(write)
+        rows = await self.database.fetchAll("SELECT name FROM tst_score")
+        self.assertEqual([row["name"] for row in rows], ["seed"])
+
+        result = await self.database.executeMany(
+            "INSERT INTO tst_score (name, score) VALUES (?, ?)",
+            [("a", 1), ("b", 2)],
+        )
+        self.assertEqual(result.rowcount, 2)
+
+    def test_split_statements(self):
+        self.assertEqual(
+            splitStatements(
+                "CREATE TABLE a (b TEXT DEFAULT ';');\n"
+                "CREATE TRIGGER c AFTER INSERT ON a BEGIN SELECT 1; END;"
+            ),
+            [
+                "CREATE TABLE a (b TEXT DEFAULT ';');",
+                "CREATE TRIGGER c AFTER INSERT ON a BEGIN SELECT 1; END;",
+            ],
+        )
+        with self.assertRaises(DatabaseException):
+            splitStatements("CREATE TABLE a (b TEXT)")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import random
+import unittest
+
+from hiiragi.protocol.lz77 import Lz77
+
+LEVELS = [Lz77.LEVEL_STORE, Lz77.LEVEL_FAST, Lz77.LEVEL_NORMAL, Lz77.LEVEL_MAX]
+WINDOW = 0x1000
+
+
+class TestLz77(unittest.TestCase):
+    def setUp(self):
+        self.lz = Lz77()
+
+    def roundtrip(self, data: bytes):
+        for level in LEVELS:
+            with self.subTest(level=level, length=len(data)):
+                compressed = self.lz.compress(data, level=level)
+                self.assertEqual(self.lz.decompress(compressed), data)
+
+    def test_empty(self):
+        self.roundtrip(b"")
+
+    def test_short(self):
+        # Shorter than the shortest backref
+        for data in [b"a", b"ab", b"aa", b"\x00\xff"]:
+            self.roundtrip(data)
+
+    def test_long_run(self):
+        # A single run longer than the whole window
+        data = b"a" * (WINDOW * 3 + 17)
+        self.roundtrip(data)
+        for level in LEVELS[1:]:
+            self.assertLess(len(self.lz.compress(data, level=level)), len(data) // 8)
+
+    def test_ring_wrap(self):
+        rng = random.Random(1)
+        # A block just under the window size repeated, so matches reach back across
+        # where the ring wraps
+        block = bytes(rng.randrange(256) for _ in range(WINDOW - 5))
+        self.roundtrip(block * 3)
+        # Matches that overlap their own output, across the wrap
+        self.roundtrip(b"x" * (WINDOW - 2) + b"abc" * 2000)
+        self.roundtrip(bytes(rng.randrange(4) for _ in range(WINDOW * 2 + 3)))
+
+    def test_incompressible(self):
+        rng = random.Random(2)
+        self.roundtrip(bytes(rng.randrange(256) for _ in range(WINDOW + 100)))
+
+    def test_text(self):
+        self.roundtrip(("本日のメンテナンスは終了しました。" * 300).encode("shift-jis"))
+
+
+if __name__ == "__main__":
+    unittest.main()
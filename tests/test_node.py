@@ -0,0 +1,175 @@
+import unittest
+
+from hiiragi.protocol.binary import BinaryEncoding
+from hiiragi.protocol.node import Node, NodeException
+from hiiragi.protocol.xml import XmlEncoding
+
+# Constructor, value given and value read back, which are the same as when values
+# were kept as strings
+VALUES = [
+    ("string", "ひいらぎ", "ひいらぎ"),
+    ("binary", b"\x00\xff", b"\x00\xff"),
+    ("float", 1.5, 1.5),
+    ("float", 2, 2.0),
+    ("bool", True, True),
+    ("bool", 0, False),
+    ("bool", 2, True),
+    ("ipv4", "192.168.0.1", b"\xc0\xa8\x00\x01"),
+    ("time", 1700000000, 1700000000),
+    ("u8", 255, 255),
+    ("s8", -128, -128),
+    ("u16", 65535, 65535),
+    ("s16", -32768, -32768),
+    ("u32", 2**32 - 1, 2**32 - 1),
+    ("s32", -(2**31), -(2**31)),
+    ("u64", 2**64 - 1, 2**64 - 1),
+    ("u64", 0, 0),
+    ("s64", -(2**63), -(2**63)),
+    ("s64", 2**63 - 1, 2**63 - 1),
+    ("time_array", [1, 2], [1, 2]),
+    ("float_array", [0.5, 1], [0.5, 1.0]),
+    ("bool_array", [True, 0, 1], [True, False, True]),
+    ("u8_array", [], []),
+    ("u8_array", [0, 255], [0, 255]),
+    ("s8_array", [-128, 127], [-128, 127]),
+    ("u16_array", [0, 65535], [0, 65535]),
+    ("s16_array", [-32768, 32767], [-32768, 32767]),
+    ("u32_array", [0, 2**32 - 1], [0, 2**32 - 1]),
+    ("s32_array", [-(2**31), 2**31 - 1], [-(2**31), 2**31 - 1]),
+    ("u64_array", [0, 2**64 - 1], [0, 2**64 - 1]),
+    ("s64_array", [-(2**63), 2**63 - 1], [-(2**63), 2**63 - 1]),
+    ("fouru8", [1, 2, 3, 4], [1, 2, 3, 4]),
+]
+
+
+def assertSameValue(test: unittest.TestCase, actual, expected) -> None:
+    # 1 == 1.0 == True, so the types have to be compared as well
+    test.assertEqual(actual, expected)
+    test.assertIs(type(actual), type(expected))
+    if isinstance(expected, list):
+        test.assertEqual(
+            [type(value) for value in actual], [type(value) for value in expected]
+        )
+
+
+class TestNodeValues(unittest.TestCase):
+    def test_constructors(self):
+        for constructor, given, expected in VALUES:
+            with self.subTest(constructor=constructor, value=given):
+                node = getattr(Node, constructor)("node", given)
+                assertSameValue(self, node.value, expected)
+
+    def test_set_value(self):
+        for constructor, given, expected in VALUES:
+            with self.subTest(constructor=constructor, value=given):
+                node = getattr(Node, constructor)("node", given)
+                node.set_value(given)
+                assertSameValue(self, node.value, expected)
+
+    def test_replace_value(self):
+        node = Node.ipv4("ip", "1.1.1.1")
+        node.set_value("10.0.0.255")
+        assertSameValue(self, node.value, b"\x0a\x00\x00\xff")
+        node = Node.bool_array("bools", [True])
+        node.set_value([0, 1])
+        assertSameValue(self, node.value, [False, True])
+        node = Node.float("f", 1.0)
+        node.set_value(3)
+        assertSameValue(self, node.value, 3.0)
+
+    def test_composite_and_double(self):
+        for type, array, given, expected in [
+            (Node.NODE_TYPE_DOUBLE, False, 0.25, 0.25),
+            (Node.NODE_TYPE_DOUBLE, True, [0.5, 2.5], [0.5, 2.5]),
+            (Node.NODE_TYPE_2S32, False, [-1, 2], [-1, 2]),
+            (Node.NODE_TYPE_2DOUBLE, False, [0.5, 1.5], [0.5, 1.5]),
+            (Node.NODE_TYPE_3FLOAT, False, [0.5, 1.0, 2.0], [0.5, 1.0, 2.0]),
+            (Node.NODE_TYPE_4U64, False, [0, 1, 2**64 - 1, 3], [0, 1, 2**64 - 1, 3]),
+            (Node.NODE_TYPE_4S8, False, [-128, 127, 0, 1], [-128, 127, 0, 1]),
+        ]:
+            with self.subTest(type=type, array=array):
+                node = Node(name="node", type=type, array=array, value=given)
+                assertSameValue(self, node.value, expected)
+
+        with self.assertRaises(NodeException):
+            Node(name="node", type=Node.NODE_TYPE_2U16, array=True, value=[1, 2, 3])
+
+    def test_out_of_range(self):
+        for constructor, given in [
+            ("u8", 256),
+            ("s8", -129),
+            ("u64", 2**64),
+            ("s64", 2**63),
+            ("u16_array", [65536]),
+        ]:
+            with self.subTest(constructor=constructor, value=given):
+                with self.assertRaises(NodeException):
+                    getattr(Node, constructor)("node", given)
+
+    def test_values_are_copies(self):
+        # Changing a list that was given or read back doesn't change the node
+        given = [1, 2]
+        node = Node.u8_array("node", given)
+        given.append(3)
+        self.assertEqual(node.value, [1, 2])
+        node.value.append(9)
+        self.assertEqual(node.value, [1, 2])
+        node = Node(name="node", type=Node.NODE_TYPE_2S32, value=[1, 2])
+        node.value[0] = 7
+        self.assertEqual(node.value, [1, 2])
+
+
+def tree() -> Node:
+    root = Node.void("response")
+    root.set_attribute("status", "0")
+    player = Node.void("player")
+    player.set_attribute("id", "1")
+    root.add_child(player)
+    for constructor, _, value in VALUES:
+        player.add_child(getattr(Node, constructor)(constructor, value))
+    player.add_child(Node(name="pair", type=Node.NODE_TYPE_2S32, value=[-1, 2]))
+    player.add_child(Node(name="triple", type=Node.NODE_TYPE_3U16, value=[0, 1, 65535]))
+    return root
+
+
+class TestNodeEquality(unittest.TestCase):
+    def test_decoded_trees(self):
+        binary = BinaryEncoding().decode(BinaryEncoding().encode(tree(), "shift-jis"))
+        xml = XmlEncoding().decode(XmlEncoding().encode(tree(), "shift-jis"))
+        self.assertEqual(binary, tree())
+        self.assertEqual(xml, tree())
+        self.assertEqual(binary, xml)
+        pairs = zip(binary.child("player").children, xml.child("player").children)
+        for left, right in pairs:
+            with self.subTest(node=left.name):
+                assertSameValue(self, left.value, right.value)
+
+    def test_floats(self):
+        # The XML decoder only knows single floats, so these are binary only
+        root = Node.void("response")
+        root.add_child(Node(name="d", type=Node.NODE_TYPE_DOUBLE, value=0.25))
+        root.add_child(
+            Node(name="ds", type=Node.NODE_TYPE_DOUBLE, array=True, value=[0.5, 2.5])
+        )
+        root.add_child(Node(name="pd", type=Node.NODE_TYPE_2DOUBLE, value=[0.5, 1.5]))
+        root.add_child(Node(name="tf", type=Node.NODE_TYPE_3FLOAT, value=[0.5] * 3))
+        decoded = BinaryEncoding().decode(BinaryEncoding().encode(root, "shift-jis"))
+        self.assertEqual(decoded, root)
+
+    def test_differences(self):
+        self.assertNotEqual(Node.u8("a", 1), Node.s8("a", 1))
+        self.assertNotEqual(Node.u8_array("a", [1]), Node.u8("a", 1))
+        self.assertNotEqual(Node.u8_array("a", [1]), Node.u8_array("a", [1, 1]))
+        self.assertNotEqual(Node.string("a", "x"), Node.string("b", "x"))
+        # Same as when every value was kept as a string, 2 isn't 2.0
+        self.assertNotEqual(Node.float("a", 2), Node.float("a", 2.0))
+        changed = tree()
+        changed.child("player").child("s64_array").set_value([0, 0])
+        self.assertNotEqual(changed, tree())
+        changed = tree()
+        changed.child("player").set_attribute("id", "2")
+        self.assertNotEqual(changed, tree())
+
+
+if __name__ == "__main__":
+    unittest.main()
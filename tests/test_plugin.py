@@ -0,0 +1,250 @@
+import types
+import unittest
+from typing import Dict, List, Optional
+from unittest import mock
+
+from hiiragi.backend import route
+from hiiragi.plugin import Plugin, PluginManager, ResponseCache
+from hiiragi.protocol.node import Node
+from hiiragi.protocol.protocol import EAmuseProtocol
+
+protocol = EAmuseProtocol()
+
+MODEL = "TST:J:A:A:2020"
+
+
+class FakeRequest:
+    """
+    Just enough of a request for route.handle() and cache keys.
+    """
+
+    def __init__(self, body: bytes, headers: Dict[str, str]):
+        self.headers = headers
+        self.__body = body
+
+    async def body(self) -> bytes:
+        return self.__body
+
+
+def load(plugin: Plugin) -> None:
+    """
+    Set up a plugin whose actions count how often they are called.
+    """
+
+    async def get(request, node: Node) -> Node:
+        plugin.calls.append("get")
+        response = Node.void("response")
+        game = Node.void("game")
+        game.add_child(Node.string("name", "ひいらぎ"))
+        # Big enough to be compressed when the request was
+        game.add_child(Node.u32_array("data", list(range(128))))
+        response.add_child(game)
+        return response
+
+    async def card(request, node: Node) -> Node:
+        plugin.calls.append("card")
+        response = Node.void("response")
+        response.add_child(Node.string("card", node.child_value("card/id")))
+        return response
+
+    plugin.calls = []
+    plugin.dispatch("game.get", get, cacheable=True)
+    plugin.dispatch(
+        "card.get",
+        card,
+        cacheable=True,
+        ttl=60,
+        key=lambda request, node: node.child_value("card/id"),
+    )
+
+
+def makePlugin() -> Plugin:
+    module = types.ModuleType("plugins.Test.plugin")
+    module.name = "Test"
+    module.version = "1.0"
+    module.game = "TST"
+    module.load = load
+    return Plugin(module)
+
+
+class TestResponseCache(unittest.TestCase):
+    def put(self, cache: ResponseCache, data: bytes, **kwargs) -> None:
+        arguments = {
+            "textEncoding": "shift-jis",
+            "packetEncoding": EAmuseProtocol.BINARY,
+            "compression": None,
+            **kwargs,
+        }
+        cache.put(None, Node.void("call"), data=data, compressed=None, **arguments)
+
+    def get(self, cache: ResponseCache, **kwargs) -> Optional[bytes]:
+        arguments = {
+            "textEncoding": "shift-jis",
+            "packetEncoding": EAmuseProtocol.BINARY,
+            "compression": None,
+            **kwargs,
+        }
+        entry = cache.get(None, Node.void("call"), **arguments)
+        return None if entry is None else entry[0]
+
+    def test_encodings_kept_apart(self):
+        cache = ResponseCache()
+        variants: List[Dict] = [
+            {},
+            {"textEncoding": "utf-8"},
+            {"packetEncoding": EAmuseProtocol.XML},
+            {"packetEncoding": EAmuseProtocol.BINARY_DECOMPRESSED},
+            {"compression": "lz77"},
+        ]
+        for i, variant in enumerate(variants):
+            self.assertIsNone(self.get(cache, **variant))
+            self.put(cache, bytes([i]), **variant)
+        for i, variant in enumerate(variants):
+            self.assertEqual(self.get(cache, **variant), bytes([i]))
+
+    def test_ttl(self):
+        cache = ResponseCache(ttl=10)
+        with mock.patch("hiiragi.plugin.time.monotonic", return_value=100.0):
+            self.put(cache, b"response")
+        with mock.patch("hiiragi.plugin.time.monotonic", return_value=109.0):
+            self.assertEqual(self.get(cache), b"response")
+        with mock.patch("hiiragi.plugin.time.monotonic", return_value=111.0):
+            self.assertIsNone(self.get(cache))
+
+        # Without a TTL, responses are kept until invalidated
+        cache = ResponseCache()
+        self.put(cache, b"response")
+        with mock.patch("hiiragi.plugin.time.monotonic", return_value=10.0**12):
+            self.assertEqual(self.get(cache), b"response")
+        cache.invalidate()
+        self.assertIsNone(self.get(cache))
+
+    def test_eviction(self):
+        cache = ResponseCache(key=lambda request, node: node.attribute("id"))
+        with mock.patch.object(ResponseCache, "MAX_ENTRIES", 3):
+            for i in range(5):
+                node = Node.void("call")
+                node.set_attribute("id", str(i))
+                cache.put(None, node, "shift-jis", 2, None, bytes([i]), None)
+            # Replacing an entry that is already there doesn't evict anything
+            cache.put(None, node, "shift-jis", 2, None, b"again", None)
+
+            found = []
+            for i in range(5):
+                node = Node.void("call")
+                node.set_attribute("id", str(i))
+                entry = cache.get(None, node, "shift-jis", 2, None)
+                found.append(None if entry is None else entry[0])
+        self.assertEqual(found, [None, None, b"\x02", b"\x03", b"again"])
+
+
+class TestPlugin(unittest.TestCase):
+    def test_invalidate(self):
+        plugin = makePlugin()
+        node = Node.void("call")
+        for action in ("game.get", "card.get"):
+            self.assertIsNotNone(plugin.cache(action))
+            plugin.cache(action).put(None, node, "utf-8", 2, None, b"x", None)
+
+        plugin.invalidate("game.get")
+        self.assertIsNone(plugin.cache("game.get").get(None, node, "utf-8", 2, None))
+        self.assertIsNotNone(plugin.cache("card.get").get(None, node, "utf-8", 2, None))
+
+        plugin.invalidate()
+        self.assertIsNone(plugin.cache("card.get").get(None, node, "utf-8", 2, None))
+        # Unknown and uncached actions are fine too
+        plugin.invalidate("unknown.get")
+
+    def test_dispatch_uncached(self):
+        plugin = makePlugin()
+        plugin.dispatch("game.get", plugin.get("game.get"))
+        self.assertIsNone(plugin.cache("game.get"))
+
+
+class TestCachedRoute(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.plugin = makePlugin()
+        PluginManager.games["TST"] = self.plugin
+        self.addCleanup(PluginManager.games.pop, "TST", None)
+
+    async def call(
+        self,
+        action: str,
+        text_encoding: str = "shift-jis",
+        packet_encoding: int = EAmuseProtocol.BINARY,
+        compress: Optional[str] = None,
+        encryption: Optional[str] = None,
+        card: str = "E004000000000000",
+    ):
+        request = Node.void("call")
+        request.set_attribute("model", MODEL)
+        body = Node.void(action.split(".")[0])
+        body.set_attribute("method", "get")
+        body.add_child(Node.string("id", card))
+        request.add_child(body)
+
+        headers = {}
+        if compress is not None:
+            headers["x-compress"] = compress
+        if encryption is not None:
+            headers["x-eamuse-info"] = encryption
+        data = protocol.encode(
+            compress, encryption, request, text_encoding, packet_encoding
+        )
+        response = await route.handle(
+            FakeRequest(data, headers), model=MODEL, f=action
+        )
+
+        compressed = response.headers["X-Compress"]
+        context = protocol.decode_context(
+            None if compressed == "none" else compressed,
+            response.headers.get("X-Eamuse-Info"),
+            response.body,
+        )
+        self.assertEqual(context.text_encoding, text_encoding)
+        self.assertEqual(context.packet_encoding, packet_encoding)
+        return response, context.tree
+
+    async def test_encodings(self):
+        for text_encoding in ("shift-jis", "euc-jp", "utf-8"):
+            for packet_encoding in (EAmuseProtocol.XML, EAmuseProtocol.BINARY):
+                for compress in (None, "lz77"):
+                    for _ in range(2):
+                        _, tree = await self.call(
+                            "game.get",
+                            text_encoding=text_encoding,
+                            packet_encoding=packet_encoding,
+                            compress=compress,
+                        )
+                        self.assertEqual(tree.child_value("game/name"), "ひいらぎ")
+        # Called once for each way of asking, then answered from the cache
+        self.assertEqual(self.plugin.calls, ["get"] * 12)
+
+    async def test_encryption(self):
+        # Encryption is applied to the cached response every time, with a new key
+        plain, tree = await self.call("game.get", compress="lz77")
+        self.assertNotIn("X-Eamuse-Info", plain.headers)
+        for encryption in ("1-5f000000-0001", "1-5f000000-0002"):
+            encrypted, encryptedTree = await self.call(
+                "game.get", compress="lz77", encryption=encryption
+            )
+            self.assertIn("X-Eamuse-Info", encrypted.headers)
+            self.assertNotEqual(encrypted.body, plain.body)
+            self.assertEqual(encryptedTree, tree)
+        again, _ = await self.call("game.get", compress="lz77")
+        self.assertEqual(again.body, plain.body)
+        self.assertEqual(self.plugin.calls, ["get"])
+
+    async def test_keys(self):
+        for card in ("E004000000000001", "E004000000000002", "E004000000000001"):
+            _, tree = await self.call("card.get", card=card)
+            self.assertEqual(tree.child_value("card"), card)
+        self.assertEqual(self.plugin.calls, ["card", "card"])
+
+        self.plugin.invalidate("card.get")
+        await self.call("card.get", card="E004000000000001")
+        self.assertEqual(self.plugin.calls, ["card", "card", "card"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import struct
+import unittest
+
+from hiiragi.protocol.stream import InputStream
+
+
+class TestInputStream(unittest.TestCase):
+    # Every kind of blob a stream can be over, including a slice the way the binary
+    # decoder passes packets
+    def blobs(self, data: bytes):
+        return [
+            data,
+            bytearray(data),
+            memoryview(data),
+            memoryview(b"\xff\xff" + data)[2:],
+        ]
+
+    def test_peek_int(self):
+        for blob in self.blobs(b"\x80\x01\xff"):
+            stream = InputStream(blob)
+            self.assertEqual(stream.peek_int(), 0x80)
+            self.assertEqual(stream.peek_int(1, is_unsigned=False), -128)
+            self.assertEqual(stream.peek_int(2), 0x8001)
+            self.assertIsNone(stream.peek_int(4))
+            # Peeking doesn't move
+            self.assertEqual(stream.read_int(), 0x80)
+            self.assertEqual(stream.peek_int(2, is_unsigned=False), 0x01FF)
+
+    def test_read_ints(self):
+        data = struct.pack(">3h", -1, 2, -3) + b"\x01\x02"
+        for blob in self.blobs(data):
+            stream = InputStream(blob)
+            self.assertEqual(stream.read_ints(3, 2, is_unsigned=False), (-1, 2, -3))
+            self.assertIsNone(stream.read_ints(3))
+            self.assertEqual(stream.read_ints(2), (1, 2))
+            self.assertEqual(stream.read_ints(0), ())
+
+    def test_read_until(self):
+        for blob in self.blobs(b"ab\x00cd\x00\x00ef"):
+            stream = InputStream(blob)
+            self.assertEqual(stream.read_until(b"\x00"), b"ab")
+            self.assertEqual(
+                stream.read_until(b"\x00\x00", include=True), b"cd\x00\x00"
+            )
+            # Not found, so nothing is consumed
+            self.assertIsNone(stream.read_until(b"\x00"))
+            self.assertEqual(stream.read_blob(2), b"ef")
+
+    def test_read_until_slice(self):
+        # The delimiter before the slice mustn't be found
+        stream = InputStream(memoryview(b"x\x00yz\x00")[2:])
+        self.assertEqual(stream.read_until(b"\x00"), b"yz")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,179 @@
+import random
+import struct
+import unittest
+from typing import Any, Dict, Tuple
+from unittest import mock
+
+from hiiragi.protocol.node import Node
+from hiiragi.protocol.protocol import EAmuseProtocol
+from hiiragi.protocol.template import Template, TemplateException
+
+ENCODINGS = ["shift-jis", "euc-jp", "utf-8"]
+PACKET_ENCODINGS = [
+    EAmuseProtocol.XML,
+    EAmuseProtocol.BINARY,
+    EAmuseProtocol.BINARY_DECOMPRESSED,
+]
+
+DEFAULTS: Dict[str, Any] = {
+    "ecenable": "1",
+    "time": "1700000000",
+    "count": 5,
+    "balance": -(2**40),
+    "name": "abc",
+    "enabled": True,
+    "rate": 1.5,
+    "level": 7,
+}
+
+
+def build(**values: Any) -> Tuple[Node, Dict[str, Tuple[Node, Any]]]:
+    """
+    A pcbtracker style response, along with the fields that change in it.
+    """
+    values = {**DEFAULTS, **values}
+    response = Node.void("response")
+    tracker = Node.void("pcbtracker")
+    tracker.set_attribute("status", "0")
+    tracker.set_attribute("ecenable", values["ecenable"])
+    tracker.set_attribute("time", values["time"])
+    response.add_child(tracker)
+
+    fields: Dict[str, Tuple[Node, Any]] = {
+        "ecenable": (tracker, "ecenable"),
+        "time": (tracker, "time"),
+    }
+    for name, node in [
+        ("count", Node.u32("count", values["count"])),
+        ("balance", Node.s64("balance", values["balance"])),
+        ("name", Node.string("name", values["name"])),
+        ("enabled", Node.bool("enabled", values["enabled"])),
+        ("rate", Node.float("rate", values["rate"])),
+        ("level", Node.u8("level", values["level"])),
+    ]:
+        tracker.add_child(node)
+        # Fixed nodes between the fields, so that they pack around each other
+        tracker.add_child(Node.u16_array(f"{name}s", [1, 2, 3]))
+        fields[name] = (node, None)
+    return response, fields
+
+
+class TestTemplate(unittest.TestCase):
+    def setUp(self):
+        self.protocol = EAmuseProtocol()
+        tree, fields = build()
+        self.template = Template(tree, fields)
+
+    def assertSameAsProtocol(self, **values: Any) -> None:
+        expected, _ = build(**values)
+        filled = self.template.fill(**{**DEFAULTS, **values})
+        for text_encoding in ENCODINGS:
+            for packet_encoding in PACKET_ENCODINGS:
+                with self.subTest(
+                    values=values,
+                    text_encoding=text_encoding,
+                    packet_encoding=packet_encoding,
+                ):
+                    self.assertEqual(
+                        filled.encode(text_encoding, packet_encoding),
+                        self.protocol.encode(
+                            None,
+                            None,
+                            expected,
+                            text_encoding=text_encoding,
+                            packet_encoding=packet_encoding,
+                        ),
+                    )
+
+    def test_placeholders(self):
+        self.assertSameAsProtocol()
+
+    def test_patched(self):
+        rng = random.Random(14)
+        for _ in range(50):
+            self.assertSameAsProtocol(
+                ecenable=rng.choice(["0", "1", "&", "<'>", "あ"]),
+                time=str(rng.randrange(10**9, 10**10)),
+                count=rng.randrange(2**32),
+                balance=rng.randrange(-(2**63), 2**63),
+                name=rng.choice(["abc", "xyz", "a&b", "ひ"]),
+                enabled=rng.random() < 0.5,
+                rate=rng.choice([0.5, -2.25, 1e10]),
+                level=rng.randrange(256),
+            )
+
+    def test_length_changes(self):
+        # These can't be patched in place in a binary packet, so they fall back
+        original = Template._Template__encode_tree
+        with mock.patch.object(
+            Template, "_Template__encode_tree", autospec=True, side_effect=original
+        ) as encode_tree:
+            self.assertSameAsProtocol(name="")
+            self.assertSameAsProtocol(name="a longer name")
+            self.assertSameAsProtocol(time="17000000001")
+            self.assertSameAsProtocol(ecenable="")
+            # Once per text encoding, for each of the two binary packet encodings
+            self.assertEqual(encode_tree.call_count, 4 * 3 * 2)
+
+            encode_tree.reset_mock()
+            self.assertSameAsProtocol(name="xyz", time="1700000001")
+            encode_tree.assert_not_called()
+
+    def test_tree_unchanged(self):
+        self.assertSameAsProtocol(name="a longer name", count=1)
+        self.assertEqual(self.template.tree, build()[0])
+
+    def test_invalid_values(self):
+        with self.assertRaises(TemplateException):
+            self.template.fill(count=1)
+        with self.assertRaises(TemplateException):
+            self.template.fill(**DEFAULTS, unknown=1)
+        with self.assertRaises(TemplateException):
+            self.template.fill(**{**DEFAULTS, "name": 5}).encode(
+                "shift-jis", EAmuseProtocol.BINARY
+            )
+        # The same as reading back the value of a node set to this
+        with self.assertRaises(ValueError):
+            self.template.fill(**{**DEFAULTS, "count": "many"}).encode(
+                "shift-jis", EAmuseProtocol.BINARY
+            )
+
+        # Out of range fails the same way encoding the tree does
+        filled = self.template.fill(**{**DEFAULTS, "level": 256})
+        expected, fields = build()
+        fields["level"][0].set_value(256)
+        self.assertEqual(
+            filled.encode("shift-jis", EAmuseProtocol.XML),
+            self.protocol.encode(None, None, expected, "shift-jis", EAmuseProtocol.XML),
+        )
+        for packet_encoding in (
+            EAmuseProtocol.BINARY,
+            EAmuseProtocol.BINARY_DECOMPRESSED,
+        ):
+            with self.assertRaises(struct.error):
+                self.protocol.encode(None, None, expected, "shift-jis", packet_encoding)
+            with self.assertRaises(struct.error):
+                filled.encode("shift-jis", packet_encoding)
+
+    def test_invalid_fields(self):
+        tree = Node.void("response")
+        for node in [
+            Node.void("void"),
+            Node.u8_array("array", [1]),
+            Node.fouru8("composite", [1, 2, 3, 4]),
+            Node.binary("bin", b"\x00"),
+            Node.ipv4("ip", "127.0.0.1"),
+        ]:
+            tree.add_child(node)
+            with self.subTest(node=node.name):
+                with self.assertRaises(TemplateException):
+                    Template(tree, {"field": (node, None)})
+
+        with self.assertRaises(TemplateException):
+            Template(tree, {"field": (tree, "missing")})
+        with self.assertRaises(TemplateException):
+            Template(tree, {"field": (Node.u8("elsewhere", 1), None)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+import unittest
+
+from hiiragi.protocol.node import Node
+from hiiragi.protocol.xml import XmlEncoding, XmlEncodingException
+
+
+# What the encoder produced for document() before it wrote into a single buffer
+GOLDEN = (
+    '<?xml version="1.0" encoding="{}"?><response status="0">'
+    '<game note="a&lt;b &amp; c&gt;&quot;d&quot; &apos;e&apos;"><empty/>'
+    '<name __type="str">ひいらぎ &lt;&amp;&gt;</name><blank __type="str"></blank>'
+    '<bin __type="bin">0001abff</bin><ip __type="ip4">10.0.0.255</ip>'
+    '<u8 __type="u8">200</u8><s64 __type="s64">-9223372036854775808</s64>'
+    '<u64 __type="u64">18446744073709551615</u64><flag __type="bool">0</flag>'
+    '<f __type="float">1.5</f><s16s __type="s16" __count="3">-1 0 32767</s16s>'
+    '<bools __type="bool" __count="3">1 0 1</bools>'
+    '<u8s __type="u8" __count="0"></u8s><t __type="time">1700000000</t>'
+    "</game></response>"
+)
+
+
+def document() -> Node:
+    root = Node.void("response")
+    root.set_attribute("status", "0")
+    game = Node.void("game")
+    game.set_attribute("note", "a<b & c>\"d\" 'e'")
+    game.add_child(Node.void("empty"))
+    game.add_child(Node.string("name", "ひいらぎ <&>"))
+    game.add_child(Node.string("blank", ""))
+    game.add_child(Node.binary("bin", b"\x00\x01\xab\xff"))
+    game.add_child(Node.ipv4("ip", "10.0.0.255"))
+    game.add_child(Node.u8("u8", 200))
+    game.add_child(Node.s64("s64", -(2**63)))
+    game.add_child(Node.u64("u64", 2**64 - 1))
+    game.add_child(Node.bool("flag", False))
+    game.add_child(Node.float("f", 1.5))
+    game.add_child(Node.s16_array("s16s", [-1, 0, 32767]))
+    game.add_child(Node.bool_array("bools", [True, False, True]))
+    game.add_child(Node.u8_array("u8s", []))
+    game.add_child(Node.time("t", 1700000000))
+    root.add_child(game)
+    return root
+
+
+def children(tree: Node):
+    return [(child.name, child.data_type, child.value) for child in tree.children]
+
+
+class TestXmlDecoder(unittest.TestCase):
+    def decode(self, data: bytes) -> Node:
+        xml = XmlEncoding()
+        tree = xml.decode(data)
+        self.assertIsNotNone(tree)
+        self.encoding = xml.encoding
+        return tree
+
+    def test_attributes_and_empty_elements(self):
+        tree = self.decode(
+            b'<?xml version="1.0"?>\n'
+            b"<call model=\"a&amp;b&lt;&gt;&quot;&apos;\" srcid='x'>\n"
+            b"  <empty/>\n"
+            b"  <spaced />\n"
+            b'  <attributed a="1"/>\n'
+            b'  <s __type="str">a &amp; b</s>\n'
+            b"</call>\n"
+        )
+        self.assertEqual(tree.name, "call")
+        self.assertEqual(tree.attributes, {"model": "a&b<>\"'", "srcid": "x"})
+        self.assertEqual(
+            children(tree),
+            [
+                ("empty", "void", None),
+                ("spaced", "void", None),
+                ("attributed", "void", None),
+                ("s", "str", "a & b"),
+            ],
+        )
+        self.assertEqual(tree.child("attributed").attributes, {"a": "1"})
+
+    def test_arrays(self):
+        tree = self.decode(
+            b"<call>"
+            b'<s32 __type="s32" __count="3">1 -2 3</s32>'
+            b'<bool __type="bool" __count="2">1 0</bool>'
+            b'<none __type="u8" __count="0"></none>'
+            b'<pair __type="2u8">1 2</pair>'
+            b"</call>"
+        )
+        self.assertEqual(
+            children(tree),
+            [
+                ("s32", "s32", [1, -2, 3]),
+                ("bool", "bool", [True, False]),
+                ("none", "u8", []),
+                ("pair", "2u8", [1, 2]),
+            ],
+        )
+        self.assertTrue(tree.child("s32").is_array)
+        self.assertFalse(tree.child("pair").is_array)
+
+    def test_values(self):
+        tree = self.decode(
+            b"<call>"
+            b'<bin __type="bin">00abff</bin>'
+            b'<ip __type="ip4">192.168.0.1</ip>'
+            b'<str __type="str">&lt;tag&gt; &#65;</str>'
+            b'<u64 __type="u64">18446744073709551615</u64>'
+            b'<f __type="float">2.5</f>'
+            b"</call>"
+        )
+        self.assertEqual(
+            children(tree),
+            [
+                ("bin", "bin", b"\x00\xab\xff"),
+                ("ip", "ip4", b"\xc0\xa8\x00\x01"),
+                # Only the five named entities are unescaped
+                ("str", "str", "<tag> &#65;"),
+                ("u64", "u64", 2**64 - 1),
+                ("f", "float", 2.5),
+            ],
+        )
+
+    def test_encodings(self):
+        for encoding, declared in [
+            ("shift-jis", "shift-jis"),
+            ("euc-jp", "euc-jp"),
+            ("utf-8", "utf-8"),
+            ("shift-jis", "SHIFT_JIS"),
+        ]:
+            with self.subTest(encoding=declared):
+                tree = self.decode(
+                    f'<?xml version="1.0" encoding="{declared}"?>'.encode("ascii")
+                    + '<call><name __type="str">ひいらぎ</name></call>'.encode(
+                        encoding
+                    )
+                )
+                self.assertEqual(self.encoding, declared)
+                self.assertEqual(tree.child_value("name"), "ひいらぎ")
+
+    def test_default_encoding(self):
+        # Without a declaration the document is assumed to be shift-jis
+        tree = self.decode('<call><name __type="str">ひ</name></call>'.encode("cp932"))
+        self.assertEqual(self.encoding, "shift-jis")
+        self.assertEqual(tree.child_value("name"), "ひ")
+
+
+class TestXmlEncoder(unittest.TestCase):
+    ENCODINGS = ["shift-jis", "euc-jp", "utf-8"]
+
+    def test_golden(self):
+        for encoding in self.ENCODINGS:
+            with self.subTest(encoding=encoding):
+                self.assertEqual(
+                    XmlEncoding().encode(document(), encoding),
+                    GOLDEN.format(encoding).encode(encoding),
+                )
+
+    def test_roundtrip(self):
+        for encoding in self.ENCODINGS:
+            with self.subTest(encoding=encoding):
+                xml = XmlEncoding()
+                tree = xml.decode(XmlEncoding().encode(document(), encoding))
+                self.assertEqual(xml.encoding, encoding)
+                self.assertEqual(tree, document())
+
+    def test_unescaped_fast_path(self):
+        # Plain values are written as they are, anything special is always escaped
+        tree = Node.void("call")
+        tree.set_attribute("plain", "abc 123")
+        tree.set_attribute("quoted", '"')
+        tree.add_child(Node.string("s", "&&"))
+        self.assertEqual(
+            XmlEncoding().encode(tree, "utf-8"),
+            b'<?xml version="1.0" encoding="utf-8"?><call plain="abc 123" '
+            b'quoted="&quot;"><s __type="str">&amp;&amp;</s></call>',
+        )
+
+    def test_unknown_encoding(self):
+        with self.assertRaises(XmlEncodingException):
+            XmlEncoding().encode(document(), "latin-1")
+
+
+if __name__ == "__main__":
+    unittest.main()